@@ -4,13 +4,31 @@
 # Authorizer code based on https://github.com/awslabs/aws-apigateway-lambda-authorizer-blueprints/blob/master/blueprints/python/api-gateway-authorizer-python.py
 # Token validation code based on https://github.com/awslabs/aws-support-tools/blob/master/Cognito/decode-verify-jwt/decode-verify-jwt.py
 
+import hashlib
+import hmac
 import os
 import re
 import json
 import time
 import urllib.request
+from collections import OrderedDict
 import boto3
 
+# Created once per container, reused by warm invocations
+dynamodb = boto3.resource('dynamodb')
+table_name = os.environ['SESSIONS_TABLE_NAME']
+sessions_table = dynamodb.Table(table_name)
+index_name = 'SessionTokenGSI'
+# Sessions are found by the hash of their token in this table with consistent reads, so sessions are
+# found right after create_session returned. Tokens without a lookup item, of sessions created before the
+# table existed, are looked up in SessionTokenGSI unless TOKEN_LOOKUP_GSI_FALLBACK is false.
+token_lookup_table_name = os.environ.get('TOKEN_LOOKUP_TABLE_NAME')
+token_lookup_table = dynamodb.Table(token_lookup_table_name) if token_lookup_table_name else None
+token_lookup_gsi_fallback = os.environ.get('TOKEN_LOOKUP_GSI_FALLBACK', 'true').lower() == 'true'
+# Set when get_credentials serves cached credentials from the context, which then tells whether the session
+# is the latest one. That costs a consistent query of the sessions table on every token cache miss.
+session_context_enabled = float(os.environ.get('AUTHORIZER_CONTEXT_MAX_AGE_SECONDS', 0)) > 0
+
 def handler(event, context):
     if handler.head_node_secret is None:
         secretsclient = boto3.client('secretsmanager')
@@ -21,53 +39,107 @@ def handler(event, context):
     api_gateway_arn_tmp = tmp[5].split('/')
     region = tmp[3]
     aws_account_id = tmp[4]
-    # validate the incoming token
-    # Query DynamoDB for item with matching session token
-
-    dynamodb = boto3.resource('dynamodb')
-    table_name = os.environ['SESSIONS_TABLE_NAME']
-    index_name = 'SessionTokenGSI'
-
-    def get_item_by_session_token(session_token):
-        table = dynamodb.Table(table_name)
-
-        response = table.query(
-            IndexName=index_name,
-            KeyConditionExpression='SessionToken = :token',
-            ExpressionAttributeValues={
-                ':token': session_token
-            }
-        )
-
-        items = response['Items']
-        return items
     principal_id = event['authorizationToken']
 
     # Sample URI path for reference: /sessions/{id}/cluster/{id}/project/{id}
 
-    # initialize the policy
-    policy = AuthPolicy(principal_id, aws_account_id)
-    policy.restApiId = api_gateway_arn_tmp[0]
-    policy.region = region
-    policy.stage = api_gateway_arn_tmp[1]
-    # Allow paths specific to provided session ID and session token
-    if principal_id == handler.head_node_secret:
-        policy.allow_method(HttpVerb.POST, "sessions")
-        policy.allow_method(HttpVerb.POST, "sessions/")
-        policy.allow_method(HttpVerb.PUT, "sessions/*")
-        policy.allow_method(HttpVerb.DELETE, "sessions/*")
+    # Policies for this API stage, built on the first invocation
+    template = PolicyTemplate.get(region, aws_account_id, api_gateway_arn_tmp[0], api_gateway_arn_tmp[1])
+    context = None
+    # Allow paths specific to provided session ID and session token. The secret is compared in constant
+    # time, so response times do not tell how much of a guess matched.
+    if hmac.compare_digest(principal_id.encode('UTF-8'), handler.head_node_secret.encode('UTF-8')):
+        policy_document = template.head_node
     else:
-        items = get_item_by_session_token(principal_id)
-        if len(items) != 1:
+        # validate the incoming token
+        context = token_cache.get(principal_id)
+        if context is TokenCache.MISSING:
+            items = get_item_by_session_token(principal_id)
+            context = None
+            if len(items) == 1:
+                context = session_context(items[0], is_latest_session(items[0]) if session_context_enabled else None)
+            token_cache.put(principal_id, context)
+        if context is None:
             # No token exists on the database - deny access to all methods
-            policy.deny_all_methods()
+            policy_document = template.deny_all
         else:
-            policy.allow_method(HttpVerb.GET, "sessions/" + items[0]["SessionId"] + "/*")
-
-    # Finally, build the policy and return effective policy
-    auth_response = policy.build()
+            policy_document = template.session(context["SessionId"])
+
+    # Finally, return effective policy
+    auth_response = {
+        'principalId': principal_id,
+        'policyDocument': policy_document
+    }
+    if context is not None:
+        auth_response['context'] = dict(context)
     return auth_response
 
+def get_item_by_session_token(session_token):
+    if token_lookup_table is not None:
+        lookup = token_lookup_table.get_item(
+            Key={'TokenHash': hashlib.sha256(session_token.encode('UTF-8')).hexdigest()},
+            ConsistentRead=True
+        ).get('Item')
+        if lookup is not None:
+            item = sessions_table.get_item(
+                Key={
+                    'ClusterNameSessionId': lookup["ClusterNameSessionId"],
+                    'SubmittedTime': lookup["SubmittedTime"]
+                },
+                ConsistentRead=True
+            ).get('Item')
+            return [item] if item is not None and item["SessionToken"] == session_token else []
+        if not token_lookup_gsi_fallback:
+            return []
+    # Query DynamoDB for item with matching session token
+    response = sessions_table.query(
+        IndexName=index_name,
+        KeyConditionExpression='SessionToken = :token',
+        ExpressionAttributeValues={
+            ':token': session_token
+        }
+    )
+
+    items = response['Items']
+    return items
+
+def is_latest_session(item):
+    # get_credentials only serves the latest session for a cluster and session id
+    response = sessions_table.query(
+        KeyConditionExpression='ClusterNameSessionId = :clusterNameSessionId',
+        ExpressionAttributeValues={
+            ':clusterNameSessionId': item["ClusterNameSessionId"]
+        },
+        ProjectionExpression='SubmittedTime',
+        ConsistentRead=True,
+        ScanIndexForward=False,
+        Limit=1
+    )
+    latest = response['Items']
+    return len(latest) == 1 and latest[0]["SubmittedTime"] == item["SubmittedTime"]
+
+def session_context(item, is_latest):
+    # Passed to get_credentials in requestContext.authorizer, so it can check the session without reading
+    # it again. Context values can only be strings, numbers and booleans. SessionReadAt tells
+    # get_credentials how old the context is, API Gateway may reuse it from its authorizer cache.
+    context = {
+        'ClusterNameSessionId': item["ClusterNameSessionId"],
+        'SessionId': item["SessionId"],
+        'ClusterName': item["ClusterName"],
+        'ProjectId': item["ProjectId"],
+        'SubmittedTime': int(item["SubmittedTime"]),
+        'SessionReadAt': int(time.time() * 1000),
+    }
+    # None when it was not checked, get_credentials then reads the session again
+    if is_latest is not None:
+        context['IsLatest'] = is_latest
+    for name in ['Status', 'RoleArn']:
+        if name in item:
+            context[name] = item[name]
+    if 'RoleMappingVersion' in item:
+        context['RoleMappingVersion'] = str(item['RoleMappingVersion'])
+    return context
+
 class HttpVerb:
     GET = "GET"
     POST = "POST"
@@ -86,8 +158,10 @@ class AuthPolicy(object):
     """The principal used for the policy, this should be a unique identifier for the end user."""
     version = "2012-10-17"
     """The policy version used for the evaluation. This should always be '2012-10-17'"""
-    pathRegex = "^[/.a-zA-Z0-9-\*]+$"
+    pathRegex = r"^[/.a-zA-Z0-9-\*]+$"
     """The regular expression used to validate resource paths for the policy"""
+    pathPattern = re.compile(pathRegex)
+    """pathRegex compiled once for all policies"""
 
     """these are the internal lists of allowed and denied methods. These are lists
     of objects and each object has 2 properties: A resource ARN and a nullable
@@ -124,8 +198,7 @@ class AuthPolicy(object):
         statement can be null."""
         if verb != "*" and not hasattr(HttpVerb, verb):
             raise NameError("Invalid HTTP verb " + verb + ". Allowed verbs in HttpVerb class")
-        resource_pattern = re.compile(self.pathRegex)
-        if not resource_pattern.match(resource):
+        if not self.pathPattern.match(resource):
             raise NameError("Invalid resource path: " + resource + ". Path should match " + self.pathRegex)
 
         if resource[:1] == "/":
@@ -234,5 +307,98 @@ class AuthPolicy(object):
 
         return policy
 
+class PolicyTemplate(object):
+    """Policy documents for one API stage, built with AuthPolicy once per container and reused by warm
+    invocations. Only the session id differs between session policies, it is filled into a copy."""
+    templates = {}
+
+    @classmethod
+    def get(cls, region, aws_account_id, rest_api_id, stage):
+        key = (region, aws_account_id, rest_api_id, stage)
+        template = cls.templates.get(key)
+        if template is None:
+            template = cls(region, aws_account_id, rest_api_id, stage)
+            cls.templates[key] = template
+        return template
+
+    def __init__(self, region, aws_account_id, rest_api_id, stage):
+        def new_policy():
+            policy = AuthPolicy("", aws_account_id)
+            policy.restApiId = rest_api_id
+            policy.region = region
+            policy.stage = stage
+            return policy
+
+        policy = new_policy()
+        policy.allow_method(HttpVerb.POST, "sessions")
+        policy.allow_method(HttpVerb.POST, "sessions/")
+        policy.allow_method(HttpVerb.PUT, "sessions/*")
+        policy.allow_method(HttpVerb.DELETE, "sessions/*")
+        policy.allow_method(HttpVerb.GET, "sessions/revocations")
+        self.head_node = policy.build()['policyDocument']
+
+        policy = new_policy()
+        policy.deny_all_methods()
+        self.deny_all = policy.build()['policyDocument']
+
+        policy = new_policy()
+        policy.allow_method(HttpVerb.GET, "sessions/" + "SESSIONID" + "/*")
+        # Any session token can read the revocation feed, it only lists token hashes
+        policy.allow_method(HttpVerb.GET, "sessions/revocations")
+        self.session_document = policy.build()['policyDocument']
+        self.session_resource = policy.allowMethods[0]['resourceArn'].split("SESSIONID")
+
+    def session(self, session_id):
+        """Returns the policy allowing the paths of session_id"""
+        resource = "sessions/" + session_id + "/*"
+        if not AuthPolicy.pathPattern.match(resource):
+            raise NameError("Invalid resource path: " + resource + ". Path should match " + AuthPolicy.pathRegex)
+        statement = self.session_document['Statement'][0]
+        resources = [self.session_resource[0] + session_id + self.session_resource[1]] + statement['Resource'][1:]
+        return {
+            'Version': self.session_document['Version'],
+            'Statement': [dict(statement, Resource=resources)]
+        }
+
+class TokenCache(object):
+    """Session contexts by session token, so warm containers do not read DynamoDB for every
+    authorization. Unknown tokens are cached for a shorter time, so a storm of bad tokens reaches DynamoDB
+    once per token. Contexts keep the time the session was read, get_credentials reads sessions again
+    once that is too old, so status changes such as INVALIDATED take effect like without this cache."""
+    MISSING = object()
+
+    def __init__(self, max_entries, ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Context, or None for unknown tokens, and the monotonic time it expires at, least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, token):
+        """Returns the cached context for token, None for a cached unknown token, or MISSING"""
+        entry = self.entries.get(token)
+        if entry is None:
+            return self.MISSING
+        if entry[1] <= time.monotonic():
+            del self.entries[token]
+            return self.MISSING
+        self.entries.move_to_end(token)
+        return entry[0]
+
+    def put(self, token, context):
+        ttl = self.ttl if context is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        self.entries[token] = (context, time.monotonic() + ttl)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+token_cache = TokenCache(
+    int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', 10000)),
+    float(os.environ.get('TOKEN_CACHE_TTL_SECONDS', 30)),
+    float(os.environ.get('NEGATIVE_TOKEN_CACHE_TTL_SECONDS', 5))
+)
+
 # Cache head_node_secret
 handler.head_node_secret = None
\ No newline at end of file
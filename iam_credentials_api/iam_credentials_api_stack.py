@@ -5,6 +5,7 @@ from aws_cdk import (
     aws_dynamodb as dynamodb,
     aws_apigateway as apigateway,
     aws_iam as iam,
+    aws_kms as kms,
     CfnOutput,
     aws_secretsmanager as secretsmanager,
     aws_events as events,
@@ -21,6 +22,11 @@ class IamCredentialsApiStack(core.Stack):
         if not env:
             raise Exception("env is not defined")
 
+        def context_value(name, default):
+            # Optional settings passed with --context name=value
+            value = self.node.try_get_context(name)
+            return default if value is None else value
+
         # Secrets manager secret for head node authentication
         head_node_secret = secretsmanager.Secret(self, "HeadNodeSecret", secret_name="IamApi" + env + "-HeadNodeSecret");
 
@@ -51,6 +57,37 @@ class IamCredentialsApiStack(core.Stack):
             removal_policy=core.RemovalPolicy.DESTROY
         )
 
+        # Session key by token hash, read by the authorizer with consistent reads
+        token_lookup_dynamo_table = dynamodb.Table(self, "SessionTokenLookupTable",
+            partition_key=dynamodb.Attribute(
+                name="TokenHash",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            encryption=dynamodb.TableEncryption.AWS_MANAGED,
+            point_in_time_recovery=True,
+            removal_policy=core.RemovalPolicy.DESTROY
+        )
+
+        # Optional cache of issued credentials shared by all GetCredentials containers, with
+        # --context shared_credentials_cache=true. Credentials are stored encrypted with credentials_cache_key.
+        shared_credentials_cache = str(self.node.try_get_context('shared_credentials_cache')).lower() == "true"
+        if shared_credentials_cache:
+            credentials_cache_key = kms.Key(self, "CredentialsCacheKey",
+                enable_key_rotation=True,
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+            credentials_cache_dynamo_table = dynamodb.Table(self, "CredentialsCacheTable",
+                partition_key=dynamodb.Attribute(
+                    name="CacheKey",
+                    type=dynamodb.AttributeType.STRING
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                time_to_live_attribute="ExpiresAt",
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+
         # DynamoDB Global Secondary Indexes
         cluster_name_gsi = sessions_dynamo_table.add_global_secondary_index(
             index_name="ClusterNameGSI",
@@ -104,6 +141,29 @@ class IamCredentialsApiStack(core.Stack):
             ),
             projection_type=dynamodb.ProjectionType.ALL
         )
+        # Revoked sessions by the hour they were revoked and update time, for the revocation feed. Only
+        # revoked sessions have RevokedHour, see src/session_status.py.
+        revoked_hour_gsi = sessions_dynamo_table.add_global_secondary_index(
+            index_name="RevokedHourGSI",
+            partition_key=dynamodb.Attribute(
+                name="RevokedHour",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            sort_key=dynamodb.Attribute(
+                name="LastUpdatedTime",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["SessionToken"]
+        )
+
+        # Seconds API Gateway caches authorizer results by token, 0 disables (API Gateway default: 300)
+        authorizer_cache_ttl = int(context_value('authorizer_cache_ttl', 300))
+        # Seconds each authorizer container caches sessions by token, and unknown tokens
+        token_cache_ttl = str(context_value('token_cache_ttl', 30))
+        negative_token_cache_ttl = str(context_value('negative_token_cache_ttl', 5))
+        # Seconds GetCredentials serves cached credentials from the session the authorizer read, 0 disables
+        authorizer_context_max_age = str(context_value('authorizer_context_max_age', 0))
 
         # Lambda functions
         def create_authorizer():
@@ -114,13 +174,21 @@ class IamCredentialsApiStack(core.Stack):
                 environment={
                     "SESSIONS_TABLE_NAME": sessions_dynamo_table.table_name,
                     "HEAD_NODE_SECRET": head_node_secret.secret_name,
+                    "TOKEN_CACHE_TTL_SECONDS": token_cache_ttl,
+                    "NEGATIVE_TOKEN_CACHE_TTL_SECONDS": negative_token_cache_ttl,
+                    "TOKEN_LOOKUP_TABLE_NAME": token_lookup_dynamo_table.table_name,
+                    # Set token_lookup_gsi_fallback=false once BackfillTokenLookup has run
+                    "TOKEN_LOOKUP_GSI_FALLBACK": str(context_value('token_lookup_gsi_fallback', True)).lower(),
+                    "AUTHORIZER_CONTEXT_MAX_AGE_SECONDS": authorizer_context_max_age,
                 }
             )
             sessions_dynamo_table.grant_read_data(authorizer_lambda)
+            token_lookup_dynamo_table.grant_read_data(authorizer_lambda)
 
             authorizer = apigateway.TokenAuthorizer(self, "Authorizer",
                 handler=authorizer_lambda,
                 identity_source=apigateway.IdentitySource.header("Authorization"),
+                results_cache_ttl=core.Duration.seconds(authorizer_cache_ttl),
             )
             authorizer_lambda.add_to_role_policy(iam.PolicyStatement(
                 actions=["secretsmanager:GetSecretValue"],
@@ -144,7 +212,21 @@ class IamCredentialsApiStack(core.Stack):
             handler="create_session.handler",
             code=lambd.Code.from_asset("src"),
             environment={
-                "SESSIONS_TABLE_NAME": sessions_dynamo_table.table_name
+                "SESSIONS_TABLE_NAME": sessions_dynamo_table.table_name,
+                "IAM_ROLE_MAPPING_TABLE_NAME": iam_role_mapping_dynamo_table.table_name,
+                "TOKEN_LOOKUP_TABLE_NAME": token_lookup_dynamo_table.table_name,
+            }
+        )
+
+        # Invoked by hand once after deploying SessionTokenLookupTable, see README
+        backfill_token_lookup_lambda = lambd.Function(self, "BackfillTokenLookup",
+            runtime=lambd.Runtime.PYTHON_3_8,
+            handler="backfill_token_lookup.handler",
+            code=lambd.Code.from_asset("src"),
+            timeout=core.Duration.minutes(15),
+            environment={
+                "SESSIONS_TABLE_NAME": sessions_dynamo_table.table_name,
+                "TOKEN_LOOKUP_TABLE_NAME": token_lookup_dynamo_table.table_name,
             }
         )
 
@@ -162,6 +244,37 @@ class IamCredentialsApiStack(core.Stack):
             runtime=lambd.Runtime.PYTHON_3_8,
             handler="get_credentials.handler",
             code=lambd.Code.from_asset("src"),
+            environment={
+                "SESSIONS_TABLE_NAME": sessions_dynamo_table.table_name,
+                "IAM_ROLE_MAPPING_TABLE_NAME": iam_role_mapping_dynamo_table.table_name,
+                "CREDENTIALS_CACHE_MARGIN_SECONDS": str(context_value('credentials_cache_margin', 300)),
+                "AUTHORIZER_CONTEXT_MAX_AGE_SECONDS": authorizer_context_max_age,
+            }
+        )
+        if shared_credentials_cache:
+            get_credentials_lambda.add_environment("CREDENTIALS_CACHE_TABLE_NAME", credentials_cache_dynamo_table.table_name)
+            get_credentials_lambda.add_environment("CREDENTIALS_CACHE_KEY_ID", credentials_cache_key.key_arn)
+            credentials_cache_dynamo_table.grant_read_write_data(get_credentials_lambda)
+            credentials_cache_key.grant_encrypt_decrypt(get_credentials_lambda)
+
+        list_revocations_lambda = lambd.Function(self, "ListRevocations",
+            runtime=lambd.Runtime.PYTHON_3_8,
+            handler="list_revocations.handler",
+            code=lambd.Code.from_asset("src"),
+            # API Gateway waits at most 29 seconds for the integration, pages are sized to finish well before
+            timeout=core.Duration.seconds(29),
+            environment={
+                "SESSIONS_TABLE_NAME": sessions_dynamo_table.table_name,
+                "REVOCATION_PAGE_SIZE": str(context_value('revocation_page_size', 1000)),
+            }
+        )
+
+        # Invoked by hand after role mappings change, see README
+        resync_session_roles_lambda = lambd.Function(self, "ResyncSessionRoles",
+            runtime=lambd.Runtime.PYTHON_3_8,
+            handler="resync_session_roles.handler",
+            code=lambd.Code.from_asset("src"),
+            timeout=core.Duration.minutes(15),
             environment={
                 "SESSIONS_TABLE_NAME": sessions_dynamo_table.table_name,
                 "IAM_ROLE_MAPPING_TABLE_NAME": iam_role_mapping_dynamo_table.table_name,
@@ -205,8 +318,15 @@ class IamCredentialsApiStack(core.Stack):
         sessions_dynamo_table.grant_read_write_data(create_session_lambda)
         sessions_dynamo_table.grant_read_write_data(delete_user_sessions_lambda)
         sessions_dynamo_table.grant_read_data(get_credentials_lambda)
+        sessions_dynamo_table.grant_read_data(list_revocations_lambda)
+        sessions_dynamo_table.grant_read_write_data(resync_session_roles_lambda)
         sessions_dynamo_table.grant_read_write_data(update_session_lambda)
+        sessions_dynamo_table.grant_read_data(backfill_token_lookup_lambda)
+        token_lookup_dynamo_table.grant_read_write_data(create_session_lambda)
+        token_lookup_dynamo_table.grant_read_write_data(backfill_token_lookup_lambda)
         iam_role_mapping_dynamo_table.grant_read_data(cleanup_session_revocations_lambda)
+        iam_role_mapping_dynamo_table.grant_read_data(create_session_lambda)
+        iam_role_mapping_dynamo_table.grant_read_data(resync_session_roles_lambda)
         iam_role_mapping_dynamo_table.grant_read_data(delete_user_sessions_lambda)
         iam_role_mapping_dynamo_table.grant_read_data(get_credentials_lambda)
 
@@ -240,6 +360,11 @@ class IamCredentialsApiStack(core.Stack):
             apigateway.LambdaIntegration(create_session_lambda),
             authorizer=auth,
         )
+        session_resource.add_resource("revocations").add_method(
+            "GET",
+            apigateway.LambdaIntegration(list_revocations_lambda),
+            authorizer=auth,
+        )
         session_resource_child = session_resource.add_resource("users").add_resource("{userId}")
         session_resource_child.add_method(
             "DELETE",
@@ -267,3 +392,5 @@ class IamCredentialsApiStack(core.Stack):
         CfnOutput(self, 'SessionseTableName', value=sessions_dynamo_table.table_name)
         CfnOutput(self, 'GetCredentialsLambdaRoleArn', value=get_credentials_lambda.role.role_arn)
         CfnOutput(self, 'HeadNodeSecretArn', value=head_node_secret.secret_arn)
+        CfnOutput(self, 'ResyncSessionRolesFunctionName', value=resync_session_roles_lambda.function_name)
+        CfnOutput(self, 'BackfillTokenLookupFunctionName', value=backfill_token_lookup_lambda.function_name)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Warm-invoke latency of authorizer.handler against a local DynamoDB stand-in over plain HTTP. Measures token
+# cache hits, misses that read SessionTokenLookupTable and the session, and the head node, and what building
+# the boto3 resource and tables in every invocation, as the handler did before, added to each of them.
+# Run from the repository root: python3 -m load_test.bench_authorizer --invocations 500
+import argparse, sys
+import hashlib
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import boto3
+
+METHOD_ARN = 'arn:aws:execute-api:us-east-1:123456789012:apiid/prod/GET/sessions/1/cluster/cluster/project/project'
+HEAD_NODE_SECRET = 'bench-head-node-secret'
+TOKEN_LOOKUP_TABLE_NAME = 'SessionTokenLookupTable'
+
+def session_item(token):
+    return {
+        'ClusterNameSessionId': {'S': 'cluster-1'},
+        'SessionId': {'S': '1'},
+        'ProjectId': {'S': 'project'},
+        'ClusterName': {'S': 'cluster'},
+        'SessionToken': {'S': token},
+        'Status': {'S': 'ACTIVE'},
+        'RoleArn': {'S': 'arn:aws:iam::123456789012:role/bench'},
+        'SubmittedTime': {'N': '1700000000'},
+    }
+
+class StubDynamoDBHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, do not let Nagle hold the body back on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))))
+        if self.headers.get('X-Amz-Target', '').endswith('.GetItem'):
+            if request['TableName'] == TOKEN_LOOKUP_TABLE_NAME:
+                # Sessions are keyed by the token hash here, so the session read can tell which token it was
+                token_hash = request['Key']['TokenHash']['S']
+                response = {'Item': {'TokenHash': {'S': token_hash}, 'ClusterNameSessionId': {'S': token_hash}, 'SubmittedTime': {'N': '1700000000'}}}
+            else:
+                response = {'Item': session_item(self.server.tokens[request['Key']['ClusterNameSessionId']['S']])}
+        elif request.get('IndexName') == 'SessionTokenGSI':
+            token = request['ExpressionAttributeValues'][':token']['S']
+            response = {'Items': [session_item(token)]}
+        else:
+            # Latest session query, every session is the latest one
+            response = {'Items': [{'SubmittedTime': {'N': '1700000000'}}]}
+        body = json.dumps(response).encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+class StubDynamoDBServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+def measure(httpd, authorizer, invocations, token_for, per_invocation_table):
+    for i in range(invocations):
+        httpd.tokens[hashlib.sha256(token_for(i).encode('UTF-8')).hexdigest()] = token_for(i)
+    latencies = []
+    for i in range(invocations):
+        event = {'authorizationToken': token_for(i), 'methodArn': METHOD_ARN}
+        start = time.perf_counter()
+        if per_invocation_table:
+            # What every invocation paid before the resource and tables were built at module scope
+            dynamodb = boto3.resource('dynamodb')
+            authorizer.sessions_table = dynamodb.Table(authorizer.table_name)
+            authorizer.token_lookup_table = dynamodb.Table(TOKEN_LOOKUP_TABLE_NAME)
+        authorizer.handler(event, None)
+        latencies.append(time.perf_counter() - start)
+    return percentiles(latencies)
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Measure warm authorizer invocations')
+    parser.add_argument('--invocations', dest='invocations', type=int, default=500)
+    args = parser.parse_args(argv)
+    httpd = StubDynamoDBServer(('127.0.0.1', 0), StubDynamoDBHandler)
+    httpd.tokens = {}
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    # The stand-in does not check signatures, any credentials do
+    os.environ['AWS_ENDPOINT_URL_DYNAMODB'] = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('SESSIONS_TABLE_NAME', 'SessionsTable')
+    os.environ['TOKEN_LOOKUP_TABLE_NAME'] = TOKEN_LOOKUP_TABLE_NAME
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'authorizer'))
+    import authorizer
+    authorizer.handler.head_node_secret = HEAD_NODE_SECRET
+    authorizer.token_cache = authorizer.TokenCache(args.invocations * 4, 3600, 3600)
+
+    # Unique tokens miss the token cache, the same token hits it after the first invocation
+    scenarios = {
+        "token_cache_hit": lambda label, i: 'cached-token',
+        "token_cache_miss": lambda label, i: '{}-{}'.format(label, i),
+        "head_node": lambda label, i: HEAD_NODE_SECRET,
+    }
+    results = {}
+    try:
+        measure(httpd, authorizer, 1, lambda i: 'cached-token', False)
+        for per_invocation_table in [False, True]:
+            for name, token_for in scenarios.items():
+                label = name + ("_table_per_invocation" if per_invocation_table else "")
+                results[label] = measure(httpd, authorizer, args.invocations, lambda i: token_for(label, i), per_invocation_table)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
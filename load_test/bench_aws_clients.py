@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Warm-invoke latency of the STS call in get_credentials with a new boto3 client per invocation, as before
+# src/aws_clients.py, and with the client it shares across invocations. STS is a local stub over plain HTTP,
+# so the saved TLS handshakes to the real endpoint come on top of the difference shown here.
+# Run from the repository root: python3 -m load_test.bench_aws_clients --invocations 200
+import argparse, sys
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import aws_clients
+
+ASSUME_ROLE_RESPONSE = b'''<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleResult>
+    <Credentials>
+      <AccessKeyId>ASIASTUB</AccessKeyId>
+      <SecretAccessKey>stub-secret</SecretAccessKey>
+      <SessionToken>stub-token</SessionToken>
+      <Expiration>2030-01-01T00:00:00Z</Expiration>
+    </Credentials>
+    <AssumedRoleUser>
+      <AssumedRoleId>AROASTUB:bench</AssumedRoleId>
+      <Arn>arn:aws:sts::123456789012:assumed-role/stub/bench</Arn>
+    </AssumedRoleUser>
+  </AssumeRoleResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</AssumeRoleResponse>'''
+
+class StubSTSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, do not let Nagle hold the body back on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', len(ASSUME_ROLE_RESPONSE))
+        self.end_headers()
+        self.wfile.write(ASSUME_ROLE_RESPONSE)
+
+    def log_message(self, format, *args):
+        return
+
+class StubSTSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def invoke(sts_client):
+    sts_client.assume_role(RoleArn='arn:aws:iam::123456789012:role/stub', RoleSessionName='bench')
+
+def measure(httpd, invocations, new_client_per_invoke):
+    url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    httpd.connections = set()
+    shared = aws_clients.new_client('sts', endpoint_url=url, region_name='us-east-1')
+    latencies = []
+    for i in range(invocations):
+        start = time.perf_counter()
+        if new_client_per_invoke:
+            invoke(boto3.client('sts', endpoint_url=url, region_name='us-east-1'))
+        else:
+            invoke(shared)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "connections": len(httpd.connections),
+    }
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Compare per-invocation and shared boto3 clients')
+    parser.add_argument('--invocations', dest='invocations', type=int, default=200)
+    args = parser.parse_args(argv)
+    # The stub does not check signatures, any credentials do
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+    httpd = StubSTSServer(('127.0.0.1', 0), StubSTSHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        results = {
+            "client_per_invocation": measure(httpd, args.invocations, True),
+            "shared_client": measure(httpd, args.invocations, False),
+        }
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Microbenchmark of CacheContainer operations at 10^3 to 10^6 cached keys.
+# Run from the repository root: python3 -m load_test.bench_cache
+import argparse, sys
+import time
+from localhost_proxy import CacheContainer, CacheEntry, deadline_after
+
+def per_op_ns(fn, count):
+    start = time.perf_counter_ns()
+    fn()
+    return (time.perf_counter_ns() - start) / count
+
+def run(size):
+    cache = CacheContainer("store", size)
+    # Spread expirations so inserts land all over the heap
+    values = [CacheEntry(200, b'', str(i).encode(), deadline_after(3600 + (i * 7919) % 3600)) for i in range(size)]
+    keys = ['token{}https://example.com/prod/sessions/{}/cluster/a/project/b'.format(i, i) for i in range(size)]
+
+    def fill():
+        for key, value in zip(keys, values):
+            cache.put(key, value)
+
+    def hits():
+        for key in keys:
+            cache.get(key)
+
+    def misses():
+        for key in keys:
+            cache.get(key + 'missing')
+
+    def evicting_puts():
+        # Cache is full, every put evicts the least recently used key
+        for i, value in enumerate(values):
+            cache.put(keys[i] + 'new', value)
+
+    return {
+        "put_ns": per_op_ns(fill, size),
+        "get_hit_ns": per_op_ns(hits, size),
+        "get_miss_ns": per_op_ns(misses, size),
+        "evicting_put_ns": per_op_ns(evicting_puts, size),
+    }
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark CacheContainer')
+    parser.add_argument('--max_exponent', dest='max_exponent', type=int, default=6)
+    args = parser.parse_args(argv)
+    for exponent in range(3, args.max_exponent + 1):
+        result = run(10 ** exponent)
+        print('{:>8} keys  put {put_ns:7.0f} ns  get hit {get_hit_ns:7.0f} ns  get miss {get_miss_ns:7.0f} ns  evicting put {evicting_put_ns:7.0f} ns'.format(10 ** exponent, **result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# Memory held per cached credentials entry: the requests.Response the cache used to keep against CacheEntry.
+# Run from the repository root: python3 -m load_test.bench_cache_memory
+import argparse, sys
+import gc
+import tracemalloc
+import requests
+from localhost_proxy import CacheEntry, response_head, deadline_after
+from load_test.stub_upstream import StubUpstream
+
+def measure(build, count):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entries = [build(i) for i in range(count)]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(entries)
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Measure memory per cached entry')
+    parser.add_argument('--entries', dest='entries', type=int, default=2000)
+    args = parser.parse_args(argv)
+    stub = StubUpstream().start()
+    session = requests.Session()
+    url = 'http://{}/prod/sessions/1/cluster/a/project/b?roleSessionName=n'.format(stub.hostname)
+    deadline = deadline_after(3600)
+    try:
+        responses = measure(lambda i: {"content": session.get(url), "expiration": deadline}, args.entries)
+        def build_entry(i):
+            resp = session.get(url)
+            return CacheEntry(resp.status_code, response_head(resp.status_code, resp.headers, len(resp.content), False, date=False), resp.content, deadline)
+        entries = measure(build_entry, args.entries)
+    finally:
+        stub.stop()
+    print('requests.Response entry  {:8.0f} bytes'.format(responses))
+    print('CacheEntry               {:8.0f} bytes'.format(entries))
+
+if __name__ == '__main__':
+    main()
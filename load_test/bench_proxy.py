@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of localhost_proxy.py against the local stub API, for comparing releases.
+# Covers a cold-start burst, steady state on a warm cache and an expiry storm, and prints the results as JSON.
+# Run from the repository root: python3 -m load_test.bench_proxy --output results.json
+import argparse, sys
+import asyncio
+import json
+import subprocess
+import time
+from load_test.stub_upstream import StubUpstream
+from load_test.bench_server_modes import start_proxy
+
+PATH = '/prod/sessions/{}/cluster/a/project/b?roleSessionName=n'
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+async def client(port, path, token, requests_count, deadline, latencies, errors):
+    # One kept-alive connection per client, sending requests back to back until it sent requests_count, or
+    # until deadline when one is given
+    request = 'GET {} HTTP/1.1\r\nHost: localhost\r\nAuthorization: {}\r\n\r\n'.format(path, token).encode()
+    reader = writer = None
+    sent = 0
+    while time.perf_counter() < deadline if deadline is not None else sent < requests_count:
+        sent += 1
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            await writer.drain()
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            await reader.readexactly(length)
+            if b'Connection: close' in head:
+                writer.close()
+                writer = None
+            if not head.startswith(b'HTTP/1.1 200'):
+                errors.append(head.split(b'\r\n', 1)[0].decode())
+        except (OSError, asyncio.IncompleteReadError) as e:
+            errors.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+        latencies.append(time.perf_counter() - start)
+    if writer is not None:
+        writer.close()
+
+async def drive(port, clients, tokens, requests_per_client, duration=None):
+    # Client i uses session i % tokens, so clients sharing a session share its cache entry
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    deadline = start + duration if duration is not None else None
+    await asyncio.gather(*[client(port, PATH.format(i % tokens), 'token{}'.format(i % tokens), requests_per_client, deadline, latencies, errors)
+                           for i in range(clients)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "p999_ms": percentile(latencies, 0.999),
+    }
+
+def run_scenario(stub, port, clients, tokens, requests_per_client, duration=None):
+    calls = stub.calls
+    result = asyncio.run(drive(port, clients, tokens, requests_per_client, duration))
+    # Every request that reached the stub was a cache miss, coalesced or not
+    result["upstream_calls"] = stub.calls - calls
+    result["hit_ratio"] = 1 - result["upstream_calls"] / result["requests"] if result["requests"] else 0
+    return result
+
+def with_proxy(args, lifetime, scenario):
+    stub = StubUpstream(latency=args.upstream_latency, lifetime=lifetime).start()
+    # Credentials live only seconds here, do not stop serving them a minute before they expire
+    proxy, port = start_proxy(args.server_mode, stub, ['--expiry_margin', '0'] + args.proxy_args.split())
+    try:
+        return scenario(stub, port)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        stub.stop()
+
+def cold_start(args):
+    # Every client asks for its credentials at once against an empty cache, like ranks starting on a node
+    return with_proxy(args, 3600, lambda stub, port: run_scenario(stub, port, args.clients, args.tokens, 1))
+
+def steady_state(args):
+    def scenario(stub, port):
+        run_scenario(stub, port, args.tokens, args.tokens, 1)
+        return run_scenario(stub, port, args.clients, args.tokens, args.requests_per_client)
+    return with_proxy(args, 3600, scenario)
+
+def expiry_storm(args):
+    # All credentials are fetched together and expire together while the clients keep polling
+    def scenario(stub, port):
+        run_scenario(stub, port, args.tokens, args.tokens, 1)
+        return run_scenario(stub, port, args.clients, args.tokens, 0, args.storm_lifetime * 2.5)
+    return with_proxy(args, args.storm_lifetime, scenario)
+
+SCENARIOS = {
+    "cold_start": cold_start,
+    "steady_state": steady_state,
+    "expiry_storm": expiry_storm,
+}
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='End-to-end localhost proxy benchmark')
+    parser.add_argument('--scenarios', dest='scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated scenarios to run (default: {})'.format(','.join(SCENARIOS)))
+    parser.add_argument('--server_mode', dest='server_mode', default='threaded', choices=['threaded', 'asyncio'])
+    parser.add_argument('--proxy_args', dest='proxy_args', default='',
+                        help='Extra flags passed to localhost_proxy.py, for example "--refresh_ahead_fraction 0.75"')
+    parser.add_argument('--clients', dest='clients', type=int, default=500)
+    parser.add_argument('--tokens', dest='tokens', type=int, default=50,
+                        help='Distinct sessions spread over the clients (default: 50)')
+    parser.add_argument('--requests_per_client', dest='requests_per_client', type=int, default=20)
+    parser.add_argument('--upstream_latency', dest='upstream_latency', type=float, default=0.05,
+                        help='Seconds each stub API request takes (default: 0.05)')
+    parser.add_argument('--storm_lifetime', dest='storm_lifetime', type=float, default=2,
+                        help='Seconds until credentials expire in the expiry storm (default: 2)')
+    parser.add_argument('--output', dest='output', default=None,
+                        help='File to write the JSON results to (default: stdout)')
+    args = parser.parse_args(argv)
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key != 'output'},
+        "git_revision": subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip(),
+        "scenarios": {},
+    }
+    for name in args.scenarios.split(','):
+        results["scenarios"][name] = SCENARIOS[name](args)
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
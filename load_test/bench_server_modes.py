@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Throughput and latency of the threaded and asyncio proxy server modes under many concurrent clients.
+# Run from the repository root: python3 -m load_test.bench_server_modes --clients 1000
+import argparse, sys
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import time
+from load_test.stub_upstream import StubUpstream
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_proxy(mode, stub, extra_args=()):
+    port = free_port()
+    proxy = subprocess.Popen(
+        [sys.executable, 'localhost_proxy.py', '--port', str(port), '--server_mode', mode,
+         '--upstream_scheme', 'http', '--hostname', stub.hostname] + list(extra_args),
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proxy, port
+        except OSError:
+            time.sleep(0.05)
+    proxy.kill()
+    raise Exception('Proxy did not start')
+
+async def client(port, token, requests_count, latencies, errors):
+    # One kept-alive connection per client, like an SDK process polling for credentials
+    path = '/prod/sessions/1/cluster/a/project/b?roleSessionName=n'
+    request = 'GET {} HTTP/1.1\r\nHost: localhost\r\nAuthorization: {}\r\n\r\n'.format(path, token).encode()
+    reader = writer = None
+    for i in range(requests_count):
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            await writer.drain()
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            await reader.readexactly(length)
+            if b'Connection: close' in head:
+                writer.close()
+                writer = None
+            if not head.startswith(b'HTTP/1.1 200'):
+                errors.append(head.split(b'\r\n', 1)[0].decode())
+        except (OSError, asyncio.IncompleteReadError) as e:
+            errors.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+        latencies.append(time.perf_counter() - start)
+    if writer is not None:
+        writer.close()
+
+async def drive(port, clients, requests_per_client, tokens):
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, 'token{}'.format(i % tokens), requests_per_client, latencies, errors) for i in range(clients)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Compare proxy server modes')
+    parser.add_argument('--clients', dest='clients', type=int, default=1000)
+    parser.add_argument('--requests_per_client', dest='requests_per_client', type=int, default=20)
+    parser.add_argument('--tokens', dest='tokens', type=int, default=16,
+                        help='Distinct Authorization tokens spread over the clients (default: 16)')
+    parser.add_argument('--upstream_latency', dest='upstream_latency', type=float, default=0.05,
+                        help='Seconds each stub API request takes (default: 0.05)')
+    args = parser.parse_args(argv)
+    results = {}
+    for mode in ['threaded', 'asyncio']:
+        stub = StubUpstream(latency=args.upstream_latency).start()
+        proxy, port = start_proxy(mode, stub)
+        try:
+            results[mode] = asyncio.run(drive(port, args.clients, args.requests_per_client, args.tokens))
+            results[mode]["upstream_calls"] = stub.calls
+        finally:
+            proxy.terminate()
+            proxy.wait()
+            stub.stop()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Cost of writing and reloading the proxy cache snapshot, and proxy startup time with and without it.
+# Run from the repository root: python3 -m load_test.bench_snapshot --entries 100000
+import argparse, sys
+import gc
+import os
+import socket
+import subprocess
+import tempfile
+import time
+import localhost_proxy
+from localhost_proxy import CacheContainer, CacheEntry, write_snapshot, load_snapshot, deadline_after
+
+def fill_cache(count):
+    localhost_proxy.cache = CacheContainer("store", 0)
+    head = b'HTTP/1.1 200 OK\r\nServer: BaseHTTP/0.6 Python/3\r\nContent-Type: application/json\r\nx-amzn-RequestId: 5f3c2a8e-7a5e-4bc1-9a55-2f3b1d7f0e6a\r\nContent-Length: 1100\r\n\r\n'
+    body = b'x' * 1100
+    deadline = deadline_after(3600)
+    for i in range(count):
+        localhost_proxy.cache.put('{}https://example.com/prod/sessions/{}/cluster/a/project/b?roleSessionName=n'.format(i, i), CacheEntry(200, head, body, deadline))
+
+def startup_seconds(extra_args):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    start = time.monotonic()
+    proxy = subprocess.Popen([sys.executable, 'localhost_proxy.py', '--port', str(port)] + extra_args,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return time.monotonic() - start
+            except OSError:
+                time.sleep(0.005)
+    finally:
+        proxy.kill()
+        proxy.wait()
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark cache snapshot write and reload')
+    parser.add_argument('--entries', dest='entries', type=int, default=100000)
+    parser.add_argument('--dir', dest='dir', type=str, default='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        path = os.path.join(tmpdir, 'cache.snapshot')
+        fill_cache(args.entries)
+        start = time.monotonic()
+        write_snapshot(path)
+        write_seconds = time.monotonic() - start
+        localhost_proxy.cache = CacheContainer("store", 0)
+        start = time.monotonic()
+        loaded = load_snapshot(path)
+        load_seconds = time.monotonic() - start
+        # Free the benchmark's own copy so it does not slow down starting the proxy processes
+        localhost_proxy.cache = None
+        gc.collect()
+        print('entries {}  file {:.1f} MB'.format(loaded, os.path.getsize(path) / 1e6))
+        print('write  {:.3f} s'.format(write_seconds))
+        print('reload {:.3f} s'.format(load_seconds))
+        print('startup without snapshot {:.3f} s'.format(startup_seconds([])))
+        print('startup with snapshot    {:.3f} s'.format(startup_seconds(['--snapshot_file', path])))
+
+if __name__ == '__main__':
+    main()
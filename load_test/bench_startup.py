@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Startup time and resident memory of localhost_proxy.py, checked against a budget.
+# Exits with status 1 when any measured configuration goes over the budget, so it can gate releases.
+# Run from the repository root: python3 -m load_test.bench_startup
+import argparse, sys
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import time
+from load_test.stub_upstream import StubUpstream
+from load_test.bench_server_modes import free_port
+
+def rss_kb(pid):
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def measure(stub, upstream_client, server_mode, requests_count):
+    port = free_port()
+    start = time.perf_counter()
+    proxy = subprocess.Popen(
+        [sys.executable, 'localhost_proxy.py', '--port', str(port), '--server_mode', server_mode, '--upstream_client', upstream_client,
+         '--upstream_scheme', 'http', '--hostname', stub.hostname],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Started once the first request is answered, the listening socket alone does not prove it can serve
+        while True:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/prod/sessions/1/cluster/a/project/b?roleSessionName=n', headers={'Authorization': 'token0'})
+                conn.getresponse().read()
+                break
+            except OSError:
+                if time.perf_counter() - start > 10:
+                    raise Exception('Proxy did not start')
+                time.sleep(0.005)
+        startup = time.perf_counter() - start
+        startup_rss = rss_kb(proxy.pid)
+        # Fill the cache with credentials for distinct tokens, as on a busy node
+        for i in range(1, requests_count):
+            conn.request('GET', '/prod/sessions/1/cluster/a/project/b?roleSessionName=n', headers={'Authorization': 'token{}'.format(i)})
+            conn.getresponse().read()
+        conn.close()
+        return startup, startup_rss, rss_kb(proxy.pid)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Check proxy startup time and memory against a budget')
+    parser.add_argument('--upstream_clients', dest='upstream_clients', default='stdlib',
+                        help='Comma separated --upstream_client values to measure (default: stdlib)')
+    parser.add_argument('--server_mode', dest='server_mode', default='threaded', choices=['threaded', 'asyncio'])
+    parser.add_argument('--runs', dest='runs', type=int, default=5)
+    parser.add_argument('--requests', dest='requests', type=int, default=1000,
+                        help='Distinct credentials cached before measuring loaded memory (default: 1000)')
+    parser.add_argument('--max_startup_ms', dest='max_startup_ms', type=float, default=300,
+                        help='Budget for the median time until the first request is answered (default: 300)')
+    parser.add_argument('--max_rss_mb', dest='max_rss_mb', type=float, default=32,
+                        help='Budget for resident memory after caching --requests credentials (default: 32)')
+    args = parser.parse_args(argv)
+    stub = StubUpstream().start()
+    results = {}
+    over_budget = False
+    try:
+        for upstream_client in args.upstream_clients.split(','):
+            runs = [measure(stub, upstream_client, args.server_mode, args.requests) for i in range(args.runs)]
+            result = {
+                "startup_ms": statistics.median(run[0] for run in runs) * 1000,
+                "startup_rss_mb": max(run[1] for run in runs) / 1024,
+                "loaded_rss_mb": max(run[2] for run in runs) / 1024,
+            }
+            result["within_budget"] = result["startup_ms"] <= args.max_startup_ms and result["loaded_rss_mb"] <= args.max_rss_mb
+            over_budget = over_budget or not result["within_budget"]
+            results[upstream_client] = result
+    finally:
+        stub.stop()
+    print(json.dumps(results, indent=2))
+    if over_budget:
+        print('Over budget: startup {} ms, memory {} MB'.format(args.max_startup_ms, args.max_rss_mb))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Per-miss latency of the localhost proxy against a local stub API, with and without connection reuse.
+# Run from the repository root: python3 -m load_test.bench_upstream_pool
+import argparse, sys
+import http.client
+import statistics
+import threading
+import time
+import requests
+import localhost_proxy
+from localhost_proxy import CacheContainer, InflightRequests, ThreadedHTTPServer, ProxyHTTPRequestHandler, UpstreamSession
+from load_test.stub_upstream import StubUpstream
+
+class PerRequestUpstream():
+    """Opens a new upstream connection for every request, like the module-level requests.get/post calls did."""
+    def get(self, url, **kwargs):
+        return requests.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return requests.post(url, **kwargs)
+
+def run(stub, upstream, keepalive, requests_count):
+    localhost_proxy.hostname = stub.hostname
+    localhost_proxy.upstream_scheme = 'http'
+    # Caching disabled so every request is a miss
+    localhost_proxy.cache = CacheContainer("none", 0)
+    localhost_proxy.inflight = InflightRequests(30)
+    localhost_proxy.upstream = upstream
+    ProxyHTTPRequestHandler.protocol_version = 'HTTP/1.1' if keepalive else 'HTTP/1.0'
+    httpd = ThreadedHTTPServer(('127.0.0.1', 0), ProxyHTTPRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    latencies = []
+    conn = None
+    try:
+        for i in range(requests_count):
+            if conn is None or not keepalive:
+                conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+            start = time.perf_counter()
+            conn.request('GET', '/prod/sessions/1/cluster/a/project/b?roleSessionName=n', headers={'Authorization': 'token'})
+            resp = conn.getresponse()
+            resp.read()
+            latencies.append(time.perf_counter() - start)
+            if not keepalive:
+                conn.close()
+    finally:
+        conn.close()
+        httpd.shutdown()
+        httpd.server_close()
+        ProxyHTTPRequestHandler.protocol_version = 'HTTP/1.1'
+    latencies.sort()
+    return {
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark per-miss proxy latency')
+    parser.add_argument('--requests', dest='requests', type=int, default=2000)
+    args = parser.parse_args(argv)
+    stub = StubUpstream().start()
+    # Keep the proxy's per-request logging out of the measurement output
+    sys.stdout = open('/dev/null', 'w')
+    try:
+        results = {
+            "per_request_connections": run(stub, PerRequestUpstream(), False, args.requests),
+            "pooled_keepalive": run(stub, UpstreamSession(32, 60), True, args.requests),
+        }
+    finally:
+        sys.stdout = sys.__stdout__
+        stub.stop()
+    for name, result in results.items():
+        print('{:<26} mean {mean_ms:.3f} ms  p50 {p50_ms:.3f} ms  p99 {p99_ms:.3f} ms'.format(name, **result))
+
+if __name__ == '__main__':
+    main()
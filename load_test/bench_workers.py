@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Throughput of the proxy with 1 to N worker processes (--workers), with load from several client processes
+# so the clients are not the bottleneck. Only meaningful on a machine with several cores.
+# Run from the repository root: python3 -m load_test.bench_workers --max_workers 8
+import argparse, sys
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from load_test.stub_upstream import StubUpstream
+from load_test.bench_server_modes import start_proxy
+from load_test.bench_proxy import PATH, client, percentile
+
+def drive_process(port, clients, tokens, requests_per_client):
+    async def drive():
+        latencies = []
+        errors = []
+        await asyncio.gather(*[client(port, PATH.format(i % tokens), 'token{}'.format(i % tokens), requests_per_client, None, latencies, errors)
+                               for i in range(clients)])
+        return latencies, len(errors)
+    return asyncio.run(drive())
+
+def run(args, workers, pool):
+    stub = StubUpstream(latency=args.upstream_latency).start()
+    proxy, port = start_proxy(args.server_mode, stub, ['--workers', str(workers)])
+    try:
+        # Warm every worker's cache so the run measures cache hits
+        pool.starmap(drive_process, [(port, args.tokens, args.tokens, 5)] * args.client_processes)
+        calls = stub.calls
+        start = time.perf_counter()
+        results = pool.starmap(drive_process, [(port, args.clients, args.tokens, args.requests_per_client)] * args.client_processes)
+        elapsed = time.perf_counter() - start
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        stub.stop()
+    latencies = sorted(latency for result in results for latency in result[0])
+    return {
+        "requests": len(latencies),
+        "errors": sum(result[1] for result in results),
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "upstream_calls": stub.calls - calls,
+    }
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Compare proxy throughput with more worker processes')
+    parser.add_argument('--max_workers', dest='max_workers', type=int, default=os.cpu_count(),
+                        help='Largest --workers value, runs double from 1 up to it (default: CPU count)')
+    parser.add_argument('--server_mode', dest='server_mode', default='threaded', choices=['threaded', 'asyncio'])
+    parser.add_argument('--client_processes', dest='client_processes', type=int, default=os.cpu_count(),
+                        help='Processes generating load (default: CPU count)')
+    parser.add_argument('--clients', dest='clients', type=int, default=100,
+                        help='Kept-alive client connections per client process (default: 100)')
+    parser.add_argument('--tokens', dest='tokens', type=int, default=16)
+    parser.add_argument('--requests_per_client', dest='requests_per_client', type=int, default=50)
+    parser.add_argument('--upstream_latency', dest='upstream_latency', type=float, default=0.05)
+    args = parser.parse_args(argv)
+    counts = []
+    workers = 1
+    while workers < args.max_workers:
+        counts.append(workers)
+        workers *= 2
+    counts.append(args.max_workers)
+    results = {}
+    with multiprocessing.Pool(args.client_processes) as pool:
+        for workers in counts:
+            results[workers] = run(args, workers, pool)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Replays traffic captured with localhost_proxy.py --capture_file against a fresh proxy and the local stub API,
+# at the captured pace or faster, to compare cache and concurrency settings on real job-start patterns.
+# Run from the repository root: python3 -m load_test.replay capture.jsonl --speed 10 --proxy_args "--workers 4"
+import argparse, sys
+import asyncio
+import json
+import statistics
+import time
+from load_test.stub_upstream import StubUpstream
+from load_test.bench_server_modes import start_proxy
+from load_test.bench_proxy import client, percentile
+
+def read_capture(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record["time"])
+    return records
+
+async def drive(port, records, speed):
+    # Each request is sent on its own connection at its captured offset divided by speed, as fast as
+    # possible when speed is 0. Captured session hashes stand in for the tokens.
+    latencies = []
+    errors = []
+    lag = []
+    start = time.perf_counter()
+    first = records[0]["time"]
+    async def send(record):
+        if speed > 0:
+            due = start + (record["time"] - first) / speed
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            lag.append(time.perf_counter() - due)
+        await client(port, record["path"], 'replay-' + record["session"], 1, None, latencies, errors)
+    await asyncio.gather(*[send(record) for record in records])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "elapsed_s": elapsed,
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_schedule_lag_ms": max(lag) * 1000 if lag else 0,
+    }
+
+def replay(records, speed=1, server_mode='threaded', proxy_args=(), upstream_latency=None, lifetime=3600):
+    captured_latencies = [record["upstream_ms"] for record in records if record.get("upstream_ms") is not None]
+    if upstream_latency is None:
+        # The stub answers as fast as the API did in the capture, sped up like the rest of the replay
+        upstream_latency = statistics.median(captured_latencies) / 1000 if captured_latencies else 0
+        if speed > 0:
+            upstream_latency /= speed
+    stub = StubUpstream(latency=upstream_latency, lifetime=lifetime).start()
+    proxy, port = start_proxy(server_mode, stub, list(proxy_args))
+    try:
+        result = asyncio.run(drive(port, records, speed))
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        stub.stop()
+    outcomes = {}
+    for record in records:
+        outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+    result["upstream_calls"] = stub.calls
+    result["hit_ratio"] = 1 - stub.calls / result["requests"] if result["requests"] else 0
+    result["captured_outcomes"] = outcomes
+    result["stub_latency_ms"] = upstream_latency * 1000
+    return result
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Replay captured localhost proxy traffic')
+    parser.add_argument('capture_file', help='File written by localhost_proxy.py --capture_file')
+    parser.add_argument('--speed', dest='speed', type=float, default=1,
+                        help='Replay this many times faster than captured, 0 sends everything at once (default: 1)')
+    parser.add_argument('--server_mode', dest='server_mode', default='threaded', choices=['threaded', 'asyncio'])
+    parser.add_argument('--proxy_args', dest='proxy_args', default='',
+                        help='Extra flags passed to localhost_proxy.py, for example "--workers 4"')
+    parser.add_argument('--upstream_latency', dest='upstream_latency', type=float, default=None,
+                        help='Seconds each stub API request takes (default: captured median divided by speed)')
+    parser.add_argument('--lifetime', dest='lifetime', type=int, default=3600,
+                        help='Seconds until stub credentials expire (default: 3600)')
+    args = parser.parse_args(argv)
+    records = read_capture(args.capture_file)
+    if not records:
+        print('No requests in {}'.format(args.capture_file))
+        return 1
+    result = replay(records, args.speed, args.server_mode, args.proxy_args.split(), args.upstream_latency, args.lifetime)
+    print(json.dumps(result, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Local stand-in for the credentials API used by the localhost proxy tests and benchmarks.
+# Serves GET /.../sessions/{id}/cluster/{id}/project/{id} with credentials shaped like get_credentials output,
+# and GET /.../sessions/revocations like list_revocations.
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+import argparse, sys
+import hashlib
+import json
+import threading
+import time
+
+class StubHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.record(self)
+        if urlsplit(self.path).path.endswith('/sessions/revocations'):
+            # Pages of revocation_page_size revocations, next is the index of the first one on the page
+            start = int(dict(parse_qsl(urlsplit(self.path).query)).get('next', 0))
+            end = start + stub.revocation_page_size
+            feed = {
+                "Revocations": [{"TokenHash": hashlib.sha256(token.encode()).hexdigest(), "LastUpdatedTime": int(time.time())}
+                                for token in stub.revoked[start:end]],
+                "Cursor": int(time.time()),
+            }
+            if end < len(stub.revoked):
+                feed["NextCursor"] = str(end)
+            self.send_body(200, json.dumps(feed))
+            return
+        if stub.latency > 0:
+            time.sleep(stub.latency)
+        fault = stub.next_fault()
+        if fault == 'drop':
+            # Close the connection without a response, like a reset from an overloaded endpoint
+            self.close_connection = True
+            return
+        if fault is not None:
+            self.send_body(fault, json.dumps({"message": HTTPStatus(fault).phrase}))
+            return
+        expiration = datetime.now(timezone.utc) + timedelta(seconds=stub.lifetime)
+        self.send_body(200, json.dumps({
+            "AccessKeyId": "ASIASTUB",
+            "Expiration": str(expiration.replace(microsecond=0)),
+            "RoleArn": "arn:aws:iam::123456789012:role/stub",
+            "SecretAccessKey": "stub-secret",
+            "Token": "stub-token",
+        }))
+
+    def do_POST(self):
+        self.server.stub.record(self)
+        content_len = int(self.headers.get('content-length', 0))
+        self.send_body(200, self.rfile.read(content_len).decode())
+
+    def send_body(self, status, body):
+        content = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StubUpstream():
+    def __init__(self, latency=0, lifetime=3600, port=0, faults=None):
+        # latency is the seconds each GET sleeps, lifetime the seconds until the returned credentials expire.
+        # faults is a list of status codes, or 'drop' to close the connection, answered to the next GETs in order.
+        self.latency = latency
+        self.lifetime = lifetime
+        self.faults = list(faults or [])
+        # Session tokens listed by the revocation feed
+        self.revoked = []
+        self.revocation_page_size = 1000
+        self.calls = 0
+        self.connections = set()
+        self.paths = []
+        self.hosts = []
+        self.calls_lock = threading.Lock()
+        self.httpd = StubHTTPServer(('127.0.0.1', port), StubHTTPRequestHandler)
+        self.httpd.stub = self
+        self.thread = None
+
+    @property
+    def hostname(self):
+        return '127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def record(self, handler):
+        with self.calls_lock:
+            self.calls += 1
+            self.connections.add(handler.client_address)
+            self.paths.append(handler.path)
+            self.hosts.append(handler.headers['Host'])
+
+    def next_fault(self):
+        with self.calls_lock:
+            if self.faults:
+                return self.faults.pop(0)
+            return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Stub credentials API')
+    parser.add_argument('--port', dest='port', type=int, default=8443)
+    parser.add_argument('--latency', dest='latency', type=float, default=0,
+                        help='Seconds each credentials request takes (default: 0)')
+    parser.add_argument('--lifetime', dest='lifetime', type=int, default=3600,
+                        help='Seconds until returned credentials expire (default: 3600)')
+    parser.add_argument('--faults', dest='faults', default='',
+                        help='Comma separated status codes, or drop, answered to the first requests (default: none)')
+    args = parser.parse_args(argv)
+    faults = [fault if fault == 'drop' else int(fault) for fault in args.faults.split(',') if fault]
+    stub = StubUpstream(args.latency, args.lifetime, args.port, faults)
+    print('Stub credentials API listening on {}'.format(stub.hostname))
+    stub.httpd.serve_forever()
+
+if __name__ == '__main__':
+    main()
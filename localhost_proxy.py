@@ -1,127 +1,1006 @@
 #!/usr/bin/env python3
 from http.server import BaseHTTPRequestHandler,HTTPServer
-import argparse, sys, requests
-import threading
-from datetime import datetime
-import queue
+import argparse, sys
+import hashlib
+import http.client
+import ssl
 import threading
+import time
+import heapq
+import itertools
+import os
+import random
+import signal
+import socket
+import struct
+import tempfile
+from datetime import datetime, timezone
+from http.cookiejar import DefaultCookiePolicy
+from http import HTTPStatus
+from email.utils import formatdate
+from urllib.parse import urlsplit, quote, parse_qsl
+from collections import OrderedDict, deque
 from socketserver import ThreadingMixIn
 import json
 
 hostname = ''
+upstream_scheme = 'https'
+# Passed as verify to the upstream clients: True for the default CAs, the path of a CA bundle, or False
+upstream_verify = True
 cache = None
+inflight = None
+upstream = None
+refresher = None
+read_reports = None
+retry_policy = None
+breakers = None
+endpoints = None
+negative_cache_ttl = 0
+expiry_margin = 0
+revocations = None
+capture = None
+
+# Connection management headers apply to a single hop, so they are not forwarded in either direction
+HOP_BY_HOP_HEADERS = ['Connection', 'Keep-Alive', 'connection', 'keep-alive']
+# Throttling and server errors from the API are retried
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+# Only throttling and unavailability count against the circuit breaker and endpoint health. API Gateway
+# answers 500 and 502 for errors of a single session, such as its role not being assumable.
+HOST_FAILURE_STATUS_CODES = [429, 503, 504]
+# Responses for unknown or unauthorized sessions, cached for a short time when negative_cache_ttl is set
+NEGATIVE_CACHE_STATUS_CODES = [403, 404]
+# Path of the API's revocation feed after the stage name, its responses are never cached
+REVOCATION_FEED_PATH = '/sessions/revocations'
+# Upstream response headers that are not passed on, the proxy sets its own body framing
+FILTERED_RESPONSE_HEADERS = ['Content-Encoding', 'Transfer-Encoding', 'content-encoding', 'transfer-encoding', 'content-length', 'Content-Length'] + HOP_BY_HOP_HEADERS
 
 class CacheContainer():
     def __init__(self, cache_mode, max_queue_size):
         # Configure credentials cache to be enabled by default "store"
         self.cache_mode = cache_mode
+        # max_queue_size of 0 indicates it will not bind the cache size
         self.max_queue_size = max_queue_size
-        self.credentials_cache = {}
+        # Entries ordered from least to most recently used
+        self.credentials_cache = OrderedDict()
         self.cache_lock = threading.Lock()
-        # Queue to remove expired keys
-        self.cache_keys = queue.Queue()
+        # Min-heap of (deadline, sequence, key) to find expired keys. Keys replaced or evicted since
+        # they were pushed are skipped when popped.
+        self.expirations = []
+        self.sequence = itertools.count()
+        # Sets of keys by entry tag, the hash of the session token they were fetched with, to evict the
+        # entries of revoked sessions. Like in the heap, keys removed otherwise are skipped.
+        self.tags = {}
 
     def get(self, key):
-        return self.credentials_cache.get(key)
+        with self.cache_lock:
+            value = self.credentials_cache.get(key)
+            if value is None:
+                return None
+            # Expired entries are removed as they are found
+            if time.monotonic_ns() >= value.deadline:
+                del self.credentials_cache[key]
+                return None
+            self.credentials_cache.move_to_end(key)
+            return value
 
     def put(self, key, content):
-        self.clear_cache()
-        self.credentials_cache[key] = content
-        self.cache_keys.put(key)
+        with self.cache_lock:
+            self.credentials_cache[key] = content
+            self.credentials_cache.move_to_end(key)
+            heapq.heappush(self.expirations, (content.deadline, next(self.sequence), key))
+            if content.tag is not None:
+                self.tags.setdefault(content.tag, set()).add(key)
+            self.purge()
+
+    def load(self, items):
+        # Inserts many (key, entry) pairs, least recently used first, with a single heap rebuild
+        with self.cache_lock:
+            for key, value in items:
+                self.credentials_cache[key] = value
+                self.credentials_cache.move_to_end(key)
+                self.expirations.append((value.deadline, next(self.sequence), key))
+                if value.tag is not None:
+                    self.tags.setdefault(value.tag, set()).add(key)
+            heapq.heapify(self.expirations)
+            self.purge()
+
+    def evict_tags(self, tags):
+        # Removes the entries with any of tags, returns how many were cached
+        evicted = 0
+        with self.cache_lock:
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    value = self.credentials_cache.get(key)
+                    if value is not None and value.tag == tag:
+                        del self.credentials_cache[key]
+                        evicted += 1
+        return evicted
 
     def clear_cache(self):
-        # remove expired items every time we insert, or when queue is big enough
-        # max_queue_size of 0 indicates it will not bind the queue_size
-        self.cache_lock.acquire()
-        error = None
+        with self.cache_lock:
+            self.purge()
+
+    def items(self):
+        # Unexpired entries from least to most recently used
+        with self.cache_lock:
+            self.purge()
+            return list(self.credentials_cache.items())
+
+    def purge(self):
+        # Remove expired items in expiration order, then least recently used items beyond max_queue_size.
+        # Must be called holding cache_lock.
+        now = time.monotonic_ns()
+        while self.expirations and self.expirations[0][0] <= now:
+            deadline, sequence, key = heapq.heappop(self.expirations)
+            current = self.credentials_cache.get(key)
+            if current is not None and current.deadline <= now:
+                del self.credentials_cache[key]
+        if self.max_queue_size > 0:
+            while len(self.credentials_cache) > self.max_queue_size:
+                self.credentials_cache.popitem(last=False)
+        # Rebuild the heap and tags once skipped keys outnumber cached ones, so they stay proportional to the cache
+        if len(self.expirations) > 2 * len(self.credentials_cache) + 64:
+            self.expirations = [(value.deadline, next(self.sequence), key) for key, value in self.credentials_cache.items()]
+            heapq.heapify(self.expirations)
+            self.tags = {}
+            for key, value in self.credentials_cache.items():
+                if value.tag is not None:
+                    self.tags.setdefault(value.tag, set()).add(key)
+
+def deadline_after(seconds):
+    # Deadlines are time.monotonic_ns() values, so wall clock and timezone changes do not move them
+    return time.monotonic_ns() + int(seconds * 1000000000)
+
+def expiration_deadline(expiration):
+    # Expiration is the credentials expiration from get_credentials, with its UTC offset. A time
+    # without offset is taken as UTC. The deadline is expiry_margin seconds before it.
+    expires = datetime.fromisoformat(expiration)
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    return deadline_after(expires.timestamp() - time.time() - expiry_margin)
+
+class CacheEntry():
+    # Response as sent to clients, serialized once when it is received. payload holds the status line and
+    # headers followed by the body, which starts at body_offset.
+    __slots__ = ('status', 'payload', 'body_offset', 'deadline', 'tag', 'accessed')
+
+    def __init__(self, status, head, body, deadline, tag=None):
+        self.status = status
+        self.payload = head + body
+        self.body_offset = len(head)
+        self.deadline = deadline
+        self.tag = tag
+        # Set once the entry is served from the cache, see RefreshAhead
+        self.accessed = False
+
+    @classmethod
+    def from_payload(cls, status, payload, body_offset, deadline, tag=None):
+        entry = cls.__new__(cls)
+        entry.status = status
+        entry.payload = payload
+        entry.body_offset = body_offset
+        entry.deadline = deadline
+        entry.tag = tag
+        entry.accessed = False
+        return entry
+
+    @property
+    def body(self):
+        return self.payload[self.body_offset:]
+
+    def response(self, body=True):
+        return self.payload if body else memoryview(self.payload)[:self.body_offset]
+
+class InflightTimeout(Exception):
+    pass
+
+class InflightCall():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class InflightRequests():
+    def __init__(self, timeout):
+        # Seconds a caller waits for an in-flight upstream request for the same key
+        self.timeout = timeout
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+
+    def do(self, key, fn):
+        # Only the first caller for a key runs fn, concurrent callers wait and share its result or error
+        with self.calls_lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = InflightCall()
+                self.calls[key] = call
+        if not leader:
+            if not call.done.wait(self.timeout):
+                raise InflightTimeout('Timed out waiting for in-flight request')
+            if call.error is not None:
+                raise call.error
+            return call.result
         try:
-            while(True):
-                if self.cache_keys.qsize() == 0:
-                    break
-                top = self.cache_keys.queue[0]
-                current = self.credentials_cache.get(top)
-                if current == None:
-                    # We already deleted this key, so just skip from the queue
-                    self.cache_keys.get()
-                    continue
-                # If expired or greater than the configured limit remove
-                if datetime.now() >= current["expiration"] or self.max_queue_size < self.cache_keys.qsize():
-                    self.cache_keys.get()
-                    del self.credentials_cache[top]
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.calls_lock:
+                del self.calls[key]
+            call.done.set()
+
+class UpstreamSession():
+    def __init__(self, pool_size, idle_timeout, hosts=1):
+        # Keep-alive connections to the API are reused across requests and handler threads. hosts is the
+        # number of API endpoints, each keeps its own pool of up to pool_size connections.
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.hosts = hosts
+        self.session = None
+        self.last_used = 0
+        self.session_lock = threading.Lock()
+
+    def new_session(self):
+        # Imported on first use, so the proxy does not load requests unless it sends requests through it
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.hosts, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        # The session is shared by every caller, never replay cookies from one caller to another
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def current(self):
+        # Drop pooled connections that sat idle longer than the idle timeout, the API side may have closed them
+        with self.session_lock:
+            now = time.monotonic()
+            if self.session is not None and self.idle_timeout > 0 and now - self.last_used > self.idle_timeout:
+                self.session.close()
+                self.session = None
+            if self.session is None:
+                self.session = self.new_session()
+            self.last_used = now
+            return self.session
+
+    def get(self, url, **kwargs):
+        return self.current().get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.current().post(url, **kwargs)
+
+class UpstreamError(OSError):
+    pass
+
+class UpstreamResponse():
+    """Response read by the asyncio and http.client upstream clients, with the parts of requests.Response the proxy uses."""
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('UTF-8')
+
+class IdleConnections():
+    """Idle keep-alive connections to the API per key, shared by the http.client and asyncio upstream clients.
+    Connections are reused most recently released first, and closed with close once idle for idle_timeout."""
+    def __init__(self, pool_size, idle_timeout, close):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.close = close
+        self.idle = {}
+        self.idle_lock = threading.Lock()
+
+    def take(self, key, usable=None):
+        # Returns an idle connection for key, or None when a new one is needed
+        with self.idle_lock:
+            idle = self.idle.get(key, [])
+            now = time.monotonic()
+            while idle:
+                conn, last_used = idle.pop()
+                if (self.idle_timeout <= 0 or now - last_used <= self.idle_timeout) and (usable is None or usable(conn)):
+                    return conn
+                self.close(conn)
+        return None
+
+    def release(self, key, conn):
+        with self.idle_lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append((conn, time.monotonic()))
+                return
+        self.close(conn)
+
+def upstream_ssl_context(verify):
+    # Same certificate checks as verify on the requests path
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+    return ssl.create_default_context(cafile=None if verify is True else verify)
+
+def request_target(url):
+    parts = urlsplit(url)
+    return parts, parts.path + ('?' + parts.query if parts.query else '')
+
+def identity_headers(headers, dropped=()):
+    # The body is passed on as is, so never ask for it compressed. The clients set Content-Length themselves.
+    filtered = {key: value for key, value in headers.items() if key.lower() not in ['content-length', 'accept-encoding'] + list(dropped)}
+    filtered['Accept-Encoding'] = 'identity'
+    return filtered
+
+def add_header(headers, name, value):
+    # Repeated response headers are joined into one value, like requests does
+    headers[name] = headers[name] + ', ' + value if name in headers else value
+
+def retry_on_new_connection(reused, attempt, method):
+    # The API may have closed a pooled connection while it sat idle, retry once on a new one
+    return reused and attempt == 0 and method in ['GET', 'HEAD']
+
+class StdlibUpstreamSession():
+    """Upstream client with the get and post calls of UpstreamSession, on http.client instead of requests."""
+    def __init__(self, pool_size, idle_timeout):
+        # Pooled per (scheme, host, verify)
+        self.connections = IdleConnections(pool_size, idle_timeout, lambda conn: conn.close())
+        # TLS contexts per verify value, built on first use
+        self.contexts = {}
+
+    def connect(self, scheme, host, verify, timeout):
+        conn = self.connections.take((scheme, host, verify))
+        if conn is not None:
+            conn.sock.settimeout(timeout)
+            return conn, True
+        if scheme == 'https':
+            if verify not in self.contexts:
+                self.contexts[verify] = upstream_ssl_context(verify)
+            return http.client.HTTPSConnection(host, timeout=timeout, context=self.contexts[verify]), False
+        return http.client.HTTPConnection(host, timeout=timeout), False
+
+    def request(self, method, url, headers, body, verify, timeout):
+        parts, target = request_target(url)
+        headers = identity_headers(headers)
+        for attempt in range(2):
+            conn, reused = self.connect(parts.scheme, parts.netloc, verify, timeout)
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                resp = conn.getresponse()
+                content = resp.read()
+            except (ConnectionError, http.client.HTTPException) as e:
+                conn.close()
+                if retry_on_new_connection(reused, attempt, method):
                     continue
-                # if there are no expired items or queue is smaller than limit break purging
-                break
+                if isinstance(e, OSError):
+                    raise
+                raise UpstreamError(str(e)) from e
+            except BaseException:
+                conn.close()
+                raise
+            resp_headers = {}
+            for name, value in resp.getheaders():
+                add_header(resp_headers, name, value)
+            if resp.will_close:
+                conn.close()
+            else:
+                self.connections.release((parts.scheme, parts.netloc, verify), conn)
+            return UpstreamResponse(resp.status, resp_headers, content)
 
-        except BaseException as e:
+    def get(self, url, headers=None, verify=True, timeout=None):
+        return self.request('GET', url, headers or {}, None, verify, timeout)
+
+    def post(self, url, data=None, headers=None, verify=True, timeout=None):
+        return self.request('POST', url, headers or {}, data or b'', verify, timeout)
+
+def upstream_url(host, path):
+    return '{}://{}{}'.format(upstream_scheme, host, path)
+
+class UpstreamEndpoints():
+    def __init__(self, hostnames, probe_interval, alpha=0.3):
+        # Requests go to the healthy endpoint with the lowest moving average latency. alpha is the weight
+        # of the latest latency in the average.
+        self.hostnames = hostnames
+        self.probe_interval = probe_interval
+        self.alpha = alpha
+        self.latencies = {host: None for host in hostnames}
+        self.healthy = {host: True for host in hostnames}
+        self.endpoints_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def select(self):
+        with self.endpoints_lock:
+            # Endpoints not measured yet are tried first, and when none is healthy all of them are candidates
+            candidates = [host for host in self.hostnames if self.healthy[host]] or self.hostnames
+            return min(candidates, key=lambda host: self.latencies[host] or 0)
+
+    def observe(self, host, latency, success):
+        with self.endpoints_lock:
+            # One error takes an endpoint out of rotation until a request or probe to it succeeds again
+            self.healthy[host] = success
+            if success:
+                average = self.latencies[host]
+                self.latencies[host] = latency if average is None else self.alpha * latency + (1 - self.alpha) * average
+
+    def probe(self, host):
+        # Any answer from the API counts as healthy, except server errors and throttling
+        start = time.monotonic()
+        try:
+            resp = upstream.get(upstream_url(host, '/'), headers={'Host': host}, verify=upstream_verify, timeout=inflight.timeout)
+            success = not host_failed(resp)
+        except OSError:
+            success = False
+        self.observe(host, time.monotonic() - start, success)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for host in self.hostnames:
+                self.probe(host)
+            self.stopped.wait(self.probe_interval)
+
+def select_hostname():
+    if endpoints is not None:
+        return endpoints.select()
+    return hostname
+
+def observe_hostname(host, latency, success):
+    if endpoints is not None:
+        endpoints.observe(host, latency, success)
+
+class RetryPolicy():
+    def __init__(self, max_retries, base_delay, max_delay):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delays(self):
+        # Decorrelated jitter: each delay is picked at random between the base delay and three times the
+        # previous delay, capped at max_delay, so clients retrying together spread out
+        delay = self.base_delay
+        for attempt in range(self.max_retries):
+            delay = min(self.max_delay, random.uniform(self.base_delay, delay * 3))
+            yield delay
+
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker():
+    def __init__(self, threshold, reset_timeout):
+        # Opens after threshold consecutive failed requests, then after reset_timeout seconds lets one
+        # trial request through to decide whether to close again
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.breaker_lock = threading.Lock()
+
+    def before_request(self):
+        with self.breaker_lock:
+            if self.opened_at is None:
+                return
+            if self.trial or time.monotonic() < self.opened_at + self.reset_timeout:
+                raise CircuitOpen('Too many failed requests to the API, failing fast')
+            self.trial = True
+
+    def record(self, success):
+        with self.breaker_lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.trial or self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+            self.trial = False
+
+class CircuitBreakers():
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.breakers_lock = threading.Lock()
+
+    def get(self, host):
+        with self.breakers_lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(self.threshold, self.reset_timeout)
+                self.breakers[host] = breaker
+            return breaker
+
+def retry_delays():
+    # The delays to sleep before each retry
+    return retry_policy.delays() if retry_policy is not None else iter(())
+
+def before_attempt(host):
+    # Fails fast when the circuit breaker for host is open, returns the breaker to record the attempt on
+    breaker = breakers.get(host) if breakers is not None else None
+    if breaker is not None:
+        breaker.before_request()
+    return breaker
+
+def host_failed(resp):
+    # resp is None when the connection failed or timed out
+    return resp is None or resp.status_code in HOST_FAILURE_STATUS_CODES
+
+def after_attempt(host, breaker, start, resp):
+    # Returns whether the attempt should be retried
+    healthy = not host_failed(resp)
+    if breaker is not None:
+        breaker.record(healthy)
+    observe_hostname(host, time.monotonic() - start, healthy)
+    return resp is None or resp.status_code in RETRYABLE_STATUS_CODES
+
+def fetch_upstream(path, headers):
+    # Every attempt goes to the best endpoint at the time, so retries fail over when an endpoint has errors
+    delays = retry_delays()
+    while True:
+        host = select_hostname()
+        breaker = before_attempt(host)
+        start = time.monotonic()
+        resp = None
+        try:
+            resp = upstream.get(upstream_url(host, path), headers=set_header(headers, host), verify=upstream_verify, timeout=inflight.timeout)
+        except OSError as e:
+            # requests exceptions derive from OSError too
             error = e
         finally:
-            self.cache_lock.release()
-            if error is not None:
+            # Any other error is recorded as a failed attempt too before it is raised, so a half-open
+            # breaker does not stay in its trial
+            failed = after_attempt(host, breaker, start, resp)
+        delay = next(delays, None) if failed else None
+        if delay is None:
+            if resp is None:
                 raise error
+            return resp
+        print("Retrying request to API in {:.3f}s".format(delay))
+        time.sleep(delay)
+
+def session_token(headers):
+    # C++ sdk uses lowercase authorization, so try both
+    if 'Authorization' in headers:
+        return headers['Authorization']
+    elif 'authorization' in headers:
+        return headers['authorization']
+    else:
+        raise Exception('No authorization header found in request')
+
+def cache_key(headers, path):
+    # The endpoint is not part of the key, every endpoint serves the same credentials
+    return session_token(headers) + path
+
+def token_hash(token):
+    # Same hash as the API's revocation feed
+    return hashlib.sha256(token.encode('UTF-8')).hexdigest()
+
+def cache_response(key, path, headers, resp, fetched):
+    # Serialize the response once for every caller, and cache it when it holds credentials, or for a short
+    # time when the session is unknown or not allowed
+    deadline = None
+    if urlsplit(path).path.endswith(REVOCATION_FEED_PATH):
+        # Passed through for proxies polling the feed through this one
+        pass
+    elif resp.status_code == 200 and cache.cache_mode == "store":
+        deadline = expiration_deadline(json.loads(resp.text)["Expiration"])
+    elif resp.status_code in NEGATIVE_CACHE_STATUS_CODES and negative_cache_ttl > 0 and cache.cache_mode == "store":
+        deadline = deadline_after(negative_cache_ttl)
+    tag = None
+    if deadline is not None:
+        tag = token_hash(session_token(headers))
+        if revocations is not None and resp.status_code == 200:
+            revocations.use_session(session_token(headers), path)
+    entry = CacheEntry(resp.status_code, response_head(resp.status_code, resp.headers, len(resp.content), False, date=False), resp.content, deadline, tag)
+    # Credentials already within expiry_margin of their expiration are passed on but not cached
+    if deadline is not None and deadline > time.monotonic_ns():
+        cache.put(key, entry)
+        if refresher is not None and resp.status_code == 200:
+            refresher.schedule_refresh(key, path, headers, entry, fetched)
+    return entry
+
+def fetch_credentials(key, path, headers, use_cache=True, timing=None):
+    # Runs once per key no matter how many callers missed, so the cache is filled once per upstream response.
+    # When this caller requests the API, the seconds it took are stored in timing['upstream'].
+    def fetch():
+        # A caller that missed the cache just before the previous request for the key completed finds its result here
+        if use_cache and cache.cache_mode == "store":
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+        fetched = time.monotonic_ns()
+        resp = fetch_upstream(path, headers)
+        if timing is not None:
+            timing['upstream'] = (time.monotonic_ns() - fetched) / 1000000000
+        return cache_response(key, path, headers, resp, fetched)
+    return inflight.do(key, fetch)
+
+class RefreshAhead():
+    def __init__(self, fraction, jitter, workers=4):
+        # Entries are refreshed after fraction of their lifetime, less a random part of up to jitter of their lifetime,
+        # by up to workers threads at a time, so one slow refresh does not hold back the others
+        self.fraction = fraction
+        self.jitter = jitter
+        self.workers = workers
+        self.schedule = []
+        self.sequence = itertools.count()
+        self.schedule_lock = threading.Condition()
+        self.stopped = False
+
+    def schedule_refresh(self, key, path, headers, value, fetched):
+        # fetched is the time.monotonic_ns() the request for value was sent at
+        lifetime = value.deadline - fetched
+        delay = lifetime * max(0, self.fraction - random.uniform(0, self.jitter))
+        with self.schedule_lock:
+            heapq.heappush(self.schedule, (fetched + int(delay), next(self.sequence), key, path, headers, value))
+            self.schedule_lock.notify()
+
+    def start(self):
+        threads = [threading.Thread(target=self.run, daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stop(self):
+        with self.schedule_lock:
+            self.stopped = True
+            self.schedule_lock.notify_all()
+
+    def run(self):
+        while True:
+            with self.schedule_lock:
+                while not self.stopped and (not self.schedule or self.schedule[0][0] > time.monotonic_ns()):
+                    timeout = None
+                    if self.schedule:
+                        timeout = (self.schedule[0][0] - time.monotonic_ns()) / 1000000000
+                    self.schedule_lock.wait(timeout)
+                if self.stopped:
+                    return
+                refresh_at, sequence, key, path, headers, value = heapq.heappop(self.schedule)
+            # Refreshes held back past the entry's deadline are dropped, the next caller fetches the credentials
+            if value.deadline <= time.monotonic_ns():
+                continue
+            self.refresh(key, path, headers, value)
+
+    def refresh(self, key, path, headers, value):
+        # Only refresh entries still cached as scheduled and read since they were stored, unused entries just expire
+        if cache.get(key) is not value or not value.accessed:
+            return
+        try:
+            print("Refreshing cached credentials ahead of expiration.")
+            fetch_credentials(key, path, headers, use_cache=False)
+        except BaseException as e:
+            # The cached credentials stay valid, callers fetch again once they expire
+            print("Refreshing cached credentials failed", e)
+
+class ReadReporter():
+    def __init__(self):
+        # Workers serve reads of their cached credentials themselves, so the shared process would never see
+        # them in use and refresh them ahead. The first read of each entry a worker caches is passed on as a
+        # request for the same credentials, which the shared process serves from its cache and marks as read.
+        self.pending = deque()
+        self.pending_lock = threading.Condition()
+
+    def report(self, path, headers):
+        with self.pending_lock:
+            self.pending.append((path, headers))
+            self.pending_lock.notify()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            with self.pending_lock:
+                while not self.pending:
+                    self.pending_lock.wait()
+                path, headers = self.pending.popleft()
+            try:
+                upstream.get(upstream_url(hostname, path), headers=set_header(headers, hostname), verify=upstream_verify, timeout=inflight.timeout)
+            except OSError as e:
+                # The shared process refreshes the credentials once another worker misses them
+                print("Reporting read of cached credentials failed", e)
+
+class RevocationPoller():
+    def __init__(self, interval):
+        # Polls the API's revocation feed every interval seconds and evicts the cached entries of the
+        # sessions it lists. The feed accepts any session token, the last one credentials were fetched
+        # with is used, so there is nothing to poll until something is cached.
+        self.interval = interval
+        self.token = None
+        self.path = None
+        self.cursor = None
+        self.stopped = threading.Event()
+
+    def use_session(self, token, path):
+        # The feed is under the same stage as the credentials path
+        stage = path[:path.find('/sessions/')] if '/sessions/' in path else ''
+        self.token = token
+        self.path = stage + REVOCATION_FEED_PATH
+
+    def poll(self):
+        if self.token is None:
+            return 0
+        path = self.path
+        if self.cursor is not None:
+            path += '?since={}'.format(self.cursor)
+        # Long feeds come in pages, the cursor only moves on once all of them were read
+        evicted = 0
+        page_path = path
+        while True:
+            resp = fetch_upstream(page_path, {'Authorization': self.token})
+            if resp.status_code != 200:
+                print("Revocation feed returned", resp.status_code)
+                return evicted
+            feed = json.loads(resp.text)
+            evicted += cache.evict_tags({revocation["TokenHash"] for revocation in feed["Revocations"]})
+            if not feed.get("NextCursor"):
+                break
+            page_path = path + ('&' if '?' in path else '?') + 'next=' + quote(feed["NextCursor"])
+        self.cursor = feed["Cursor"]
+        if evicted:
+            print("Evicted {} cached credentials of revoked sessions".format(evicted))
+        return evicted
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except BaseException as e:
+                print("Polling revocation feed failed", e)
+
+# Snapshot file layout: SNAPSHOT_MAGIC, then per entry a SNAPSHOT_RECORD header (deadline as a unix
+# timestamp, status, key length, tag length, body offset, payload length) followed by the UTF-8 key,
+# the ASCII tag and the payload. Monotonic deadlines do not carry over a restart, so they are stored
+# as wall clock time.
+SNAPSHOT_MAGIC = b'IAMCREDSPROXY2\n'
+SNAPSHOT_RECORD = struct.Struct('>dHIHII')
+
+def write_snapshot(path):
+    # Written to a private temporary file then renamed, so readers never see a partial snapshot
+    entries = cache.items()
+    records = [SNAPSHOT_MAGIC]
+    wall_offset = time.time_ns() - time.monotonic_ns()
+    for key, entry in entries:
+        encoded_key = key.encode('UTF-8')
+        encoded_tag = entry.tag.encode('ascii') if entry.tag is not None else b''
+        records.append(SNAPSHOT_RECORD.pack((entry.deadline + wall_offset) / 1000000000, entry.status, len(encoded_key), len(encoded_tag), entry.body_offset, len(entry.payload)))
+        records.append(encoded_key)
+        records.append(encoded_tag)
+        records.append(entry.payload)
+    # mkstemp creates a new file with a random name readable only by this user, next to path so it can be renamed
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            fd = None
+            f.write(b''.join(records))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    return len(entries)
+
+def split_cache_key(key, tag):
+    # Keys are the session token followed by the path, the token is the part before a '/' that hashes to the tag
+    start = 0
+    while True:
+        end = key.find('/', start)
+        if end < 0:
+            return None, None
+        if token_hash(key[:end]) == tag:
+            return key[:end], key[end:]
+        start = end + 1
+
+def load_snapshot(path):
+    # The snapshot holds session tokens and credentials, only trust a file private to this user
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return 0
+    with os.fdopen(fd, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            print("Ignoring snapshot file not private to this user", path)
+            return 0
+        data = f.read()
+    if not data.startswith(SNAPSHOT_MAGIC):
+        print("Ignoring snapshot file in unknown format", path)
+        return 0
+    now = time.time()
+    wall_offset = time.time_ns() - time.monotonic_ns()
+    items = []
+    offset = len(SNAPSHOT_MAGIC)
+    while offset + SNAPSHOT_RECORD.size <= len(data):
+        expiration, status, key_len, tag_len, body_offset, payload_len = SNAPSHOT_RECORD.unpack_from(data, offset)
+        offset += SNAPSHOT_RECORD.size
+        key_end = offset + key_len
+        tag_end = key_end + tag_len
+        payload_end = tag_end + payload_len
+        if payload_end > len(data):
+            break
+        # Expired entries are skipped without decoding them
+        if expiration > now:
+            deadline = int(expiration * 1000000000) - wall_offset
+            tag = data[key_end:tag_end].decode('ascii') if tag_len else None
+            items.append((data[offset:key_end].decode('UTF-8'), CacheEntry.from_payload(status, data[tag_end:payload_end], body_offset, deadline, tag)))
+        offset = payload_end
+    cache.load(items)
+    if refresher is not None or revocations is not None:
+        # Restored credentials are refreshed like fetched ones, over the lifetime they have left, and the
+        # revocation feed is polled with the token of the most recently used ones
+        fetched = time.monotonic_ns()
+        for key, entry in reversed(items):
+            if entry.status != 200 or entry.tag is None:
+                continue
+            token, path = split_cache_key(key, entry.tag)
+            if token is None:
+                continue
+            if revocations is not None and revocations.token is None:
+                revocations.use_session(token, path)
+            if refresher is None:
+                break
+            refresher.schedule_refresh(key, path, {'Authorization': token}, entry, fetched)
+    return len(items)
+
+class SnapshotWriter():
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_snapshot(self.path)
+        except BaseException as e:
+            print("Writing cache snapshot failed", e)
+
+class TrafficCapture():
+    # Path segments followed by an id, and path segments that are not ids
+    ID_PREFIXES = ['sessions', 'cluster', 'project', 'users']
+    LITERALS = ['revocations', 'users']
+
+    def __init__(self, path):
+        # Appends a JSON line per GET to path, for load_test/replay.py. Session tokens, ids and query
+        # values are replaced by hashes salted per capture, which keep requests for the same credentials
+        # together without revealing them.
+        self.salt = os.urandom(16)
+        self.file = open(path, 'a', buffering=1)
+        self.lock = threading.Lock()
+
+    def redact(self, value):
+        return hashlib.sha256(self.salt + value.encode('UTF-8')).hexdigest()[:16]
+
+    def path_shape(self, path):
+        parts = urlsplit(path)
+        segments = parts.path.split('/')
+        for i in range(1, len(segments)):
+            if segments[i - 1] in self.ID_PREFIXES and segments[i] not in self.LITERALS:
+                segments[i] = self.redact(segments[i])
+        shape = '/'.join(segments)
+        if parts.query:
+            shape += '?' + '&'.join(name + '=' + self.redact(value) for name, value in parse_qsl(parts.query, keep_blank_values=True))
+        return shape
+
+    def record(self, method, path, headers, status, outcome, upstream_latency):
+        # outcome is hit, miss when this request went to the API, shared when it got the response of a
+        # concurrent request, or error
+        token = headers.get('Authorization') or headers.get('authorization') or ''
+        line = json.dumps({
+            "time": time.time(),
+            "method": method,
+            "path": self.path_shape(path),
+            "session": self.redact(token),
+            "status": status,
+            "outcome": outcome,
+            "upstream_ms": upstream_latency * 1000 if upstream_latency is not None else None,
+        })
+        with self.lock:
+            self.file.write(line + '\n')
 
 def merge_two_dicts(x, y):
     return x | y
 
-def set_header(headers):
+def set_header(headers, host):
+    # Each endpoint gets its own Host header, a copy is made as the request is retried on other endpoints
     print("Setting host")
-    print(hostname)
-    headers['Host'] = hostname
-    return headers
+    print(host)
+    return merge_two_dicts(headers, {'Host': host})
 
 class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
-    protocol_version = 'HTTP/1.0'
+    protocol_version = 'HTTP/1.1'
+    # Close idle keep-alive client connections after this many seconds
+    timeout = 30
+    # Responses may be written in more than one part, do not let Nagle hold the last one back on kept-alive connections
+    disable_nagle_algorithm = True
     def do_HEAD(self):
         self.do_GET(body=False)
         return
         
     def do_GET(self, body=True):
         sent = False
+        status = 404
+        outcome = 'error'
+        timing = {}
         try:
-            url = 'https://{}{}'.format(hostname, self.path)
-            req_header = self.parse_headers()
-            headers = set_header(req_header)
-            # C++ sdk uses lowercase authorization, so try both
-            if 'Authorization' in headers:
-                key = headers['Authorization'] + url
-            elif 'authorization' in headers:
-                key = headers['authorization'] + url
-            else:
-                raise 'No authorization header found in request'
-            resp = None
+            headers = self.parse_headers()
+            key = cache_key(headers, self.path)
+            entry = None
             if cache.cache_mode == "store":
-                value = cache.get(key)
-                if value is not None and datetime.now() < value["expiration"]:
+                entry = cache.get(key)
+                if entry is not None:
                     print("Using cached credentials.")
-                    resp = value["content"]
-            if resp is None:
+                    if not entry.accessed and read_reports is not None:
+                        read_reports.report(self.path, headers)
+                    entry.accessed = True
+                    outcome = 'hit'
+            if entry is None:
                 print("Requesting credentials from API. Cached credentials not avaialble.")
-                resp = requests.get(url, headers=headers, verify=False)
+                entry = fetch_credentials(key, self.path, headers, timing=timing)
+                outcome = 'miss' if 'upstream' in timing else 'shared'
             sent = True
+            status = entry.status
 
-            self.send_response(resp.status_code)
-            self.send_resp_headers(resp)
-            msg = resp.text
-            if resp.status_code == 200 and cache.cache_mode == "store":
-                cache.put(key, {
-                    "content": resp,
-                    "expiration": datetime.fromisoformat(json.loads(msg)["Expiration"][:-6])
-                })
-            if body:
-                self.wfile.write(msg.encode(encoding='UTF-8',errors='strict'))
- 
+            # Status line, headers and body are written in one go from the serialized entry
+            self.log_request(entry.status)
+            self.wfile.write(entry.response(body))
             return
+        except CircuitOpen as e:
+            sent = True
+            status = 503
+            self.send_error(503, str(e))
         finally:
             if not sent:
                 self.send_error(404, 'Error trying to proxy')
+            if capture is not None:
+                capture.record(self.command, self.path, self.headers, status, outcome, timing.get('upstream'))
 
     def do_POST(self, body=True):
         sent = False
         try:
-            url = 'https://{}{}'.format(hostname, self.path)
-            content_len = int(self.headers.getheader('content-length', 0))
+            content_len = int(self.headers.get('content-length', 0))
             post_body = self.rfile.read(content_len)
             req_header = self.parse_headers()
-            resp = requests.post(url, data=post_body, headers=set_header(req_header), verify=False)
+            host = select_hostname()
+            start = time.monotonic()
+            resp = None
+            try:
+                resp = upstream.post(upstream_url(host, self.path), data=post_body, headers=set_header(req_header, host), verify=upstream_verify, timeout=inflight.timeout)
+            finally:
+                observe_hostname(host, time.monotonic() - start, not host_failed(resp))
             sent = True
 
             self.send_response(resp.status_code)
@@ -138,19 +1017,305 @@ class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
         print("SELF REQUEST HEADEARS")
         print(self.headers)
         for line in self.headers:
-            req_header[line] = self.headers[line]
+            if line not in HOP_BY_HOP_HEADERS:
+                req_header[line] = self.headers[line]
         return req_header
 
     def send_resp_headers(self, resp):
         respheaders = resp.headers
         print ('Response Header')
         for key in respheaders:
-            if key not in ['Content-Encoding', 'Transfer-Encoding', 'content-encoding', 'transfer-encoding', 'content-length', 'Content-Length']:
+            if key not in FILTERED_RESPONSE_HEADERS:
                 print (key, respheaders[key])
                 self.send_header(key, respheaders[key])
         self.send_header('Content-Length', len(resp.content))
         self.end_headers()
 
+class AsyncUpstreamPool():
+    def __init__(self, pool_size, idle_timeout, verify=True):
+        # Pooled (reader, writer) pairs per (scheme, host)
+        self.connections = IdleConnections(pool_size, idle_timeout, lambda conn: conn[1].close())
+        self.ssl_context = upstream_ssl_context(verify)
+
+    async def connect(self, scheme, host):
+        import asyncio
+        conn = self.connections.take((scheme, host), lambda conn: not conn[0].at_eof())
+        if conn is not None:
+            return conn[0], conn[1], True
+        name, _, port = host.partition(':')
+        if scheme == 'https':
+            reader, writer = await asyncio.open_connection(name, int(port or 443), ssl=self.ssl_context, server_hostname=name)
+        else:
+            reader, writer = await asyncio.open_connection(name, int(port or 80))
+        return reader, writer, False
+
+    async def request(self, method, url, headers, body=b''):
+        import asyncio
+        parts, target = request_target(url)
+        lines = ['{} {} HTTP/1.1'.format(method, target)]
+        for key, value in identity_headers(headers, ['host']).items():
+            lines.append('{}: {}'.format(key, value))
+        lines.append('Host: {}'.format(headers.get('Host', parts.netloc)))
+        if body or method == 'POST':
+            lines.append('Content-Length: {}'.format(len(body)))
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+        for attempt in range(2):
+            reader, writer, reused = await self.connect(parts.scheme, parts.netloc)
+            try:
+                writer.write(request)
+                await writer.drain()
+                resp, keep_alive = await self.read_response(reader, method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if retry_on_new_connection(reused, attempt, method):
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self.connections.release((parts.scheme, parts.netloc), (reader, writer))
+            else:
+                writer.close()
+            return resp
+
+    async def read_response(self, reader, method):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed before response')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        status_code = int(status)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in [b'\r\n', b'\n', b'']:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            add_header(headers, name.strip(), value.strip())
+        lowercase = {name.lower(): value for name, value in headers.items()}
+        keep_alive = version == 'HTTP/1.1' and lowercase.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status_code in [204, 304] or status_code < 200:
+            content = b''
+        elif 'chunked' in lowercase.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await reader.readline()) not in [b'\r\n', b'\n', b'']:
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b''.join(chunks)
+        elif 'content-length' in lowercase:
+            content = await reader.readexactly(int(lowercase['content-length']))
+        else:
+            # Body runs until the connection is closed
+            content = await reader.read()
+            keep_alive = False
+        return UpstreamResponse(status_code, headers, content), keep_alive
+
+def response_head(status_code, resp_headers, content_length, close, date=True):
+    # Mirrors send_response and send_resp_headers of ProxyHTTPRequestHandler. Cached heads leave out
+    # the proxy's Date header, the API's Date header is passed on.
+    try:
+        reason = HTTPStatus(status_code).phrase
+    except ValueError:
+        reason = ''
+    lines = [
+        'HTTP/1.1 {} {}'.format(status_code, reason),
+        'Server: ' + ProxyHTTPRequestHandler.server_version + ' ' + ProxyHTTPRequestHandler.sys_version
+    ]
+    if date:
+        lines.append('Date: ' + formatdate(usegmt=True))
+    for key in resp_headers:
+        if key not in FILTERED_RESPONSE_HEADERS:
+            lines.append('{}: {}'.format(key, resp_headers[key]))
+    lines.append('Content-Length: {}'.format(content_length))
+    if close:
+        lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+def error_response(status_code, message):
+    # Mirrors BaseHTTPRequestHandler.send_error, which also closes the connection
+    content = (ProxyHTTPRequestHandler.error_message_format % {
+        'code': status_code,
+        'message': message,
+        'explain': HTTPStatus(status_code).description
+    }).encode('UTF-8', 'replace')
+    headers = {'Content-Type': ProxyHTTPRequestHandler.error_content_type}
+    return response_head(status_code, headers, len(content), True) + content
+
+class AsyncProxyServer():
+    def __init__(self, upstream_pool, keepalive_timeout):
+        self.upstream_pool = upstream_pool
+        self.keepalive_timeout = keepalive_timeout
+        # In-flight upstream requests by cache key, the asyncio counterpart of InflightRequests
+        self.calls = {}
+
+    async def handle_client(self, reader, writer):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # Closing the transport ends the read below on idle keep-alive connections
+                idle = loop.call_later(self.keepalive_timeout, writer.close)
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                finally:
+                    idle.cancel()
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                request_parts = request_line.split()
+                if len(request_parts) != 3:
+                    writer.write(error_response(400, 'Bad request syntax'))
+                    await writer.drain()
+                    return
+                method, path, version = request_parts
+                headers = {}
+                connection = ''
+                content_len = 0
+                for line in header_lines:
+                    if not line:
+                        continue
+                    name, _, value = line.partition(':')
+                    name, value = name.strip(), value.strip()
+                    if name.lower() == 'connection':
+                        connection = value.lower()
+                    if name.lower() == 'content-length':
+                        content_len = int(value)
+                    if name not in HOP_BY_HOP_HEADERS:
+                        headers[name] = value
+                if version == 'HTTP/1.1':
+                    close = connection == 'close'
+                else:
+                    close = connection != 'keep-alive'
+                post_body = await reader.readexactly(content_len) if content_len else b''
+                try:
+                    if method in ['GET', 'HEAD']:
+                        response = await self.do_GET(path, headers, method == 'GET')
+                    elif method == 'POST':
+                        response = await self.do_POST(path, headers, post_body, close)
+                    else:
+                        response = error_response(501, 'Unsupported method ({})'.format(method))
+                        close = True
+                except CircuitOpen as e:
+                    response = error_response(503, str(e))
+                    close = True
+                except Exception as e:
+                    print("Error trying to proxy", e)
+                    # Errors close the connection, like send_error does
+                    response = error_response(404, 'Error trying to proxy')
+                    close = True
+                writer.write(response)
+                await writer.drain()
+                if close:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return
+        finally:
+            writer.close()
+
+    async def do_GET(self, path, headers, body):
+        status = 404
+        outcome = 'error'
+        timing = {}
+        try:
+            key = cache_key(headers, path)
+            entry = None
+            if cache.cache_mode == "store":
+                entry = cache.get(key)
+                if entry is not None:
+                    print("Using cached credentials.")
+                    if not entry.accessed and read_reports is not None:
+                        read_reports.report(path, headers)
+                    entry.accessed = True
+                    outcome = 'hit'
+            if entry is None:
+                print("Requesting credentials from API. Cached credentials not avaialble.")
+                entry = await self.fetch_credentials(key, path, headers, timing)
+                outcome = 'miss' if 'upstream' in timing else 'shared'
+            status = entry.status
+            return entry.response(body)
+        except CircuitOpen:
+            status = 503
+            raise
+        finally:
+            if capture is not None:
+                capture.record('GET' if body else 'HEAD', path, headers, status, outcome, timing.get('upstream'))
+
+    async def do_POST(self, path, req_header, post_body, close):
+        import asyncio
+        host = select_hostname()
+        start = time.monotonic()
+        resp = None
+        try:
+            resp = await asyncio.wait_for(self.upstream_pool.request('POST', upstream_url(host, path), set_header(req_header, host), post_body), inflight.timeout)
+        finally:
+            observe_hostname(host, time.monotonic() - start, not host_failed(resp))
+        return response_head(resp.status_code, resp.headers, len(resp.content), close) + resp.content
+
+    async def fetch_upstream(self, path, headers):
+        import asyncio
+        # Same endpoint selection, retries and circuit breaking as fetch_upstream
+        delays = retry_delays()
+        while True:
+            host = select_hostname()
+            breaker = before_attempt(host)
+            start = time.monotonic()
+            resp = None
+            try:
+                resp = await asyncio.wait_for(self.upstream_pool.request('GET', upstream_url(host, path), set_header(headers, host)), inflight.timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                failed = after_attempt(host, breaker, start, resp)
+            delay = next(delays, None) if failed else None
+            if delay is None:
+                if resp is None:
+                    raise error
+                return resp
+            print("Retrying request to API in {:.3f}s".format(delay))
+            await asyncio.sleep(delay)
+
+    async def fetch_credentials(self, key, path, headers, timing=None):
+        import asyncio
+        # Only the first caller for a key requests the API, concurrent callers await the same future
+        call = self.calls.get(key)
+        if call is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(call), inflight.timeout)
+            except asyncio.TimeoutError:
+                raise InflightTimeout('Timed out waiting for in-flight request')
+        call = asyncio.get_running_loop().create_future()
+        self.calls[key] = call
+        try:
+            fetched = time.monotonic_ns()
+            resp = await self.fetch_upstream(path, headers)
+            if timing is not None:
+                timing['upstream'] = (time.monotonic_ns() - fetched) / 1000000000
+            entry = cache_response(key, path, headers, resp, fetched)
+            call.set_result(entry)
+            return entry
+        except BaseException as e:
+            call.set_exception(e)
+            # Mark the error retrieved, there may be no other caller waiting for it
+            call.exception()
+            raise
+        finally:
+            del self.calls[key]
+
+async def serve_asyncio(server_address, upstream_pool_size, upstream_idle_timeout, keepalive_timeout, started=None, ssl_context=None, reuse_port=False):
+    import asyncio
+    proxy = AsyncProxyServer(AsyncUpstreamPool(upstream_pool_size, upstream_idle_timeout, upstream_verify), keepalive_timeout)
+    server = await asyncio.start_server(proxy.handle_client, server_address[0], server_address[1], backlog=1024, ssl=ssl_context, reuse_port=reuse_port or None)
+    if started is not None:
+        started(server)
+    async with server:
+        await server.serve_forever()
+
 def parse_args(argv=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Proxy HTTP requests')
     parser.add_argument('--port', dest='port', type=int, default=9999,
@@ -159,29 +1324,307 @@ def parse_args(argv=sys.argv[1:]):
                         help='Cache GET requests until credentials expiration')
     parser.add_argument('--max_queue_size', dest='max_queue_size', type=int, default=1000000,
                         help='Cache GET requests until credentials expiration')
+    parser.add_argument('--expiry_margin', dest='expiry_margin', type=float, default=60,
+                        help='Stop serving cached credentials this many seconds before they expire (default: 60)')
+    parser.add_argument('--inflight_timeout', dest='inflight_timeout', type=float, default=30,
+                        help='Seconds to wait on an in-flight upstream request for the same credentials (default: 30)')
+    parser.add_argument('--refresh_ahead_fraction', dest='refresh_ahead_fraction', type=float, default=0,
+                        help='Refresh cached credentials in use after this fraction of their lifetime, 0 disables (default: 0)')
+    parser.add_argument('--refresh_ahead_jitter', dest='refresh_ahead_jitter', type=float, default=0.1,
+                        help='Refresh up to this fraction of the lifetime earlier, at random, to spread refreshes out (default: 0.1)')
+    parser.add_argument('--refresh_ahead_workers', dest='refresh_ahead_workers', type=int, default=4,
+                        help='Threads refreshing cached credentials at the same time (default: 4)')
+    parser.add_argument('--max_retries', dest='max_retries', type=int, default=2,
+                        help='Times a throttled, failed or unreachable API request is retried (default: 2)')
+    parser.add_argument('--retry_base_delay', dest='retry_base_delay', type=float, default=0.1,
+                        help='Smallest delay in seconds before retrying an API request (default: 0.1)')
+    parser.add_argument('--retry_max_delay', dest='retry_max_delay', type=float, default=2,
+                        help='Largest delay in seconds before retrying an API request (default: 2)')
+    parser.add_argument('--negative_cache_ttl', dest='negative_cache_ttl', type=float, default=5,
+                        help='Seconds to cache 403 and 404 responses from the API, 0 disables (default: 5)')
+    parser.add_argument('--breaker_threshold', dest='breaker_threshold', type=int, default=10,
+                        help='Consecutive failed API requests that make the proxy fail fast, 0 disables (default: 10)')
+    parser.add_argument('--breaker_reset_timeout', dest='breaker_reset_timeout', type=float, default=5,
+                        help='Seconds to fail fast before trying the API again (default: 5)')
+    parser.add_argument('--upstream_client', dest='upstream_client', type=str, default='requests', choices=['requests', 'stdlib'],
+                        help='Send API requests with requests, or with the standard library only for a faster start and less memory (default: requests)')
+    parser.add_argument('--upstream_pool_size', dest='upstream_pool_size', type=int, default=32,
+                        help='Maximum keep-alive connections kept open to the API (default: 32)')
+    parser.add_argument('--upstream_idle_timeout', dest='upstream_idle_timeout', type=float, default=60,
+                        help='Seconds before idle keep-alive connections to the API are reopened, 0 keeps them forever (default: 60)')
+    parser.add_argument('--keepalive_timeout', dest='keepalive_timeout', type=float, default=30,
+                        help='Seconds before an idle keep-alive client connection is closed (default: 30)')
+    parser.add_argument('--upstream_scheme', dest='upstream_scheme', type=str, default='https', choices=['https', 'http'],
+                        help='Scheme used to reach the API (default: https)')
+    parser.add_argument('--upstream_ca_file', dest='upstream_ca_file', type=str, default='',
+                        help='CA bundle to verify the certificate of the API or shared proxy with, such as the certificate of a shared proxy (default: system CAs)')
+    parser.add_argument('--upstream_tls_verify', dest='upstream_tls_verify', type=str, default='on', choices=['on', 'off'],
+                        help='Verify the certificate of the API or shared proxy, off sends session tokens to whoever answers (default: on)')
+    parser.add_argument('--snapshot_file', dest='snapshot_file', type=str, default='',
+                        help='Save the cache to this file and reload it at startup, ideally on tmpfs such as /dev/shm (default: disabled)')
+    parser.add_argument('--snapshot_interval', dest='snapshot_interval', type=float, default=60,
+                        help='Seconds between cache snapshots (default: 60)')
+    parser.add_argument('--bind_address', dest='bind_address', type=str, default='127.0.0.1',
+                        help='Address to serve HTTP requests on, set it to reach a shared proxy from other nodes (default: 127.0.0.1)')
+    parser.add_argument('--certfile', dest='certfile', type=str, default='',
+                        help='Certificate chain file to serve HTTPS instead of HTTP (default: disabled)')
+    parser.add_argument('--keyfile', dest='keyfile', type=str, default='',
+                        help='Private key file for --certfile, if not included in it')
+    parser.add_argument('--server_mode', dest='server_mode', type=str, default='threaded', choices=['threaded', 'asyncio'],
+                        help='Serve each connection on its own thread, or all connections on one asyncio event loop (default: threaded)')
+    parser.add_argument('--capture_file', dest='capture_file', type=str, default='',
+                        help='Append an anonymized JSON line per GET to this file, for load_test/replay.py (default: disabled)')
+    parser.add_argument('--revocation_poll_interval', dest='revocation_poll_interval', type=float, default=0,
+                        help='Seconds between polls of the API revocation feed to evict credentials of revoked sessions, 0 disables (default: 0)')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Worker processes sharing the port, for nodes where one process cannot keep up (default: 1)')
     parser.add_argument('--hostname', dest='hostname', type=str, default='t7b9p81x86.execute-api.us-east-1.amazonaws.com',
-                        help='Hostname to be processd (default: t7b9p81x86.execute-api.us-east-1.amazonaws.com)')
+                        help='Hostname to be processd, or a comma separated list of endpoints for the same API (default: t7b9p81x86.execute-api.us-east-1.amazonaws.com)')
+    parser.add_argument('--probe_interval', dest='probe_interval', type=float, default=10,
+                        help='Seconds between latency probes when more than one hostname is given (default: 10)')
     args = parser.parse_args(argv)
     return args
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
+    # Idle keep-alive connections must not hold up shutdown
+    daemon_threads = True
+    # Job start bursts open many connections at once, do not drop them at the listen backlog
+    request_queue_size = 1024
+    # Set to serve HTTPS, for a shared proxy that node proxies reach over the network
+    ssl_context = None
+
+    def get_request(self):
+        conn, addr = self.socket.accept()
+        if self.ssl_context is not None:
+            # Leave the TLS handshake to the handler thread, a slow client must not hold up accepting others
+            conn = self.ssl_context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+        return conn, addr
+
+class ReusePortHTTPServer(ThreadedHTTPServer):
+    """Listener of a worker process, every worker binds the same port and the kernel spreads connections over them."""
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def listener_ssl_context(certfile, keyfile):
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(certfile, keyfile or None)
+    return ssl_context
+
+def new_upstream(args, hosts=1):
+    if args.upstream_client == 'stdlib':
+        return StdlibUpstreamSession(args.upstream_pool_size, args.upstream_idle_timeout)
+    return UpstreamSession(args.upstream_pool_size, args.upstream_idle_timeout, hosts)
+
+def serve(args, server_address, ssl_context, reuse_port=False):
+    if args.server_mode == 'asyncio':
+        # asyncio is imported where it is used, the threaded mode does not pay for loading it at startup
+        import asyncio
+        print('HTTP server is running as reverse proxy on asyncio')
+        asyncio.run(serve_asyncio(server_address, args.upstream_pool_size, args.upstream_idle_timeout, args.keepalive_timeout, ssl_context=ssl_context, reuse_port=reuse_port))
+        return
+    httpd = (ReusePortHTTPServer if reuse_port else ThreadedHTTPServer)(server_address, ProxyHTTPRequestHandler)
+    httpd.ssl_context = ssl_context
+    print('HTTP server is running as reverse proxy')
+    httpd.serve_forever()
+
+def run_worker(args, shared_httpd, server_address, ssl_context):
+    # Workers answer clients from their own cache and send misses to the shared cache in the parent
+    # process, which requests each credentials once from the API for all workers
+    global hostname
+    global upstream_scheme
+    global cache
+    global inflight
+    global upstream
+    global negative_cache_ttl
+    global expiry_margin
+    global revocations
+    global read_reports
+    parent = os.getppid()
+    shared_httpd.socket.close()
+    hostname = '127.0.0.1:{}'.format(shared_httpd.server_address[1])
+    upstream_scheme = 'http'
+    cache = CacheContainer(args.cache_mode, args.max_queue_size)
+    inflight = InflightRequests(args.inflight_timeout)
+    upstream = new_upstream(args)
+    negative_cache_ttl = args.negative_cache_ttl
+    expiry_margin = args.expiry_margin
+    def exit_with_parent():
+        # Without the shared cache every request would fail, stop so clients notice
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(1)
+    threading.Thread(target=exit_with_parent, daemon=True).start()
+    if args.revocation_poll_interval > 0:
+        # Workers poll through the parent, which passes feed requests on uncached
+        revocations = RevocationPoller(args.revocation_poll_interval)
+        revocations.start()
+    if args.refresh_ahead_fraction > 0:
+        # Refresh-ahead runs in the parent only, workers get the refreshed credentials from it once their copy expires
+        read_reports = ReadReporter()
+        read_reports.start()
+    serve(args, server_address, ssl_context, reuse_port=True)
+
+def start_workers(args, shared_httpd, server_address, ssl_context):
+    # Forked before the parent starts any thread
+    pids = []
+    for i in range(args.workers):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(args, shared_httpd, server_address, ssl_context)
+            except BaseException as e:
+                print('Worker {} stopped'.format(i), e)
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        pids.append(pid)
+    return pids
+
+def stop_workers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+def parse_prefetch_args(argv):
+    parser = argparse.ArgumentParser(prog='localhost_proxy.py prefetch',
+                                     description='Fill the proxy cache with the credentials a job will use before it starts')
+    parser.add_argument('--uri', dest='uri', type=str, default=os.environ.get('AWS_CONTAINER_CREDENTIALS_FULL_URI', ''),
+                        help='Session credentials URI on the proxy, without roleSessionName (default: $AWS_CONTAINER_CREDENTIALS_FULL_URI)')
+    parser.add_argument('--token', dest='token', type=str, default=os.environ.get('AWS_CONTAINER_AUTHORIZATION_TOKEN', ''),
+                        help='Session token (default: $AWS_CONTAINER_AUTHORIZATION_TOKEN)')
+    parser.add_argument('--role_session_names', dest='role_session_names', type=str, required=True,
+                        help='Comma separated roleSessionName values the job will use')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=8,
+                        help='Credentials requested at the same time (default: 8)')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=30,
+                        help='Seconds to wait for each credentials request (default: 30)')
+    return parser.parse_args(argv)
+
+def prefetch(argv):
+    # Requests the credentials through the running proxy, which caches them for the job's processes
+    args = parse_prefetch_args(argv)
+    if not args.uri or not args.token:
+        print('prefetch needs --uri and --token, or AWS_CONTAINER_CREDENTIALS_FULL_URI and AWS_CONTAINER_AUTHORIZATION_TOKEN')
+        return 2
+    parts = urlsplit(args.uri)
+    base = '{}://{}{}?roleSessionName='.format(parts.scheme, parts.netloc, parts.path)
+    names = [name.strip() for name in args.role_session_names.split(',') if name.strip()]
+    client = StdlibUpstreamSession(args.concurrency, 0)
+    def fetch(name):
+        try:
+            # Characters allowed in role session names are sent as they are, like the SDKs do, so the cache key matches
+            resp = client.get(base + quote(name, safe='+=,.@-'), headers={'Authorization': args.token}, timeout=args.timeout)
+            return resp.status_code
+        except OSError as e:
+            return str(e)
+    from concurrent.futures import ThreadPoolExecutor
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        results = list(executor.map(fetch, names))
+    failed = [(name, result) for name, result in zip(names, results) if result != 200]
+    for name, result in failed:
+        print('Prefetching credentials for {} failed: {}'.format(name, result))
+    print('Prefetched {} of {} credentials in {:.3f}s'.format(len(names) - len(failed), len(names), time.monotonic() - start))
+    return 1 if failed else 0
 
 def main(argv=sys.argv[1:]):
     global hostname
     global cache_mode
     global max_queue_size
     global cache
+    global inflight
+    global upstream
+    global upstream_scheme
+    global upstream_verify
+    global refresher
+    global retry_policy
+    global breakers
+    global negative_cache_ttl
+    global endpoints
+    global expiry_margin
+    global revocations
+    global capture
+    if argv and argv[0] == 'prefetch':
+        return prefetch(argv[1:])
     args = parse_args(argv)
-    hostname = args.hostname
+    print('HTTP server is starting on {} port {}...'.format(args.hostname, args.port))
+    server_address = (args.bind_address, args.port)
+    ssl_context = None
+    if args.certfile:
+        ssl_context = listener_ssl_context(args.certfile, args.keyfile)
+    elif args.bind_address not in ['127.0.0.1', 'localhost', '::1']:
+        print('WARNING: serving on {} without --certfile, session tokens and credentials are sent unencrypted'.format(args.bind_address))
+    ProxyHTTPRequestHandler.timeout = args.keepalive_timeout
+    if args.capture_file:
+        # Opened before the workers are forked, so they append to it with the same salt
+        capture = TrafficCapture(args.capture_file)
+    shared_httpd = None
+    worker_pids = []
+    if args.workers > 1:
+        # This process becomes the shared cache the workers fetch from, on a loopback port only they use
+        shared_httpd = ThreadedHTTPServer(('127.0.0.1', 0), ProxyHTTPRequestHandler)
+        worker_pids = start_workers(args, shared_httpd, server_address, ssl_context)
+        # Its requests come from the workers, which captured them already
+        capture = None
+    hostnames = [host.strip() for host in args.hostname.split(',') if host.strip()]
+    hostname = hostnames[0]
+    upstream_scheme = args.upstream_scheme
+    upstream_verify = args.upstream_ca_file or True
+    if args.upstream_tls_verify == 'off':
+        print('WARNING: not verifying the certificate of {}, session tokens are sent to whoever answers'.format(args.hostname))
+        upstream_verify = False
     cache_mode = args.cache_mode
     max_queue_size = args.max_queue_size
     cache = CacheContainer(cache_mode, max_queue_size)
-    print('HTTP server is starting on {} port {}...'.format(args.hostname, args.port))
-    server_address = ('127.0.0.1', args.port)
-    httpd = ThreadedHTTPServer(server_address, ProxyHTTPRequestHandler)
-    print('HTTP server is running as reverse proxy')
-    httpd.serve_forever()
+    inflight = InflightRequests(args.inflight_timeout)
+    upstream = new_upstream(args, len(hostnames))
+    retry_policy = RetryPolicy(args.max_retries, args.retry_base_delay, args.retry_max_delay)
+    if args.breaker_threshold > 0:
+        breakers = CircuitBreakers(args.breaker_threshold, args.breaker_reset_timeout)
+    negative_cache_ttl = args.negative_cache_ttl
+    expiry_margin = args.expiry_margin
+    if len(hostnames) > 1:
+        endpoints = UpstreamEndpoints(hostnames, args.probe_interval)
+        endpoints.start()
+    if args.revocation_poll_interval > 0:
+        revocations = RevocationPoller(args.revocation_poll_interval)
+        revocations.start()
+    if args.refresh_ahead_fraction > 0:
+        refresher = RefreshAhead(args.refresh_ahead_fraction, args.refresh_ahead_jitter, args.refresh_ahead_workers)
+        refresher.start()
+    snapshot_writer = None
+    if args.snapshot_file and cache.cache_mode == "store":
+        start = time.monotonic()
+        loaded = load_snapshot(args.snapshot_file)
+        print('Loaded {} cached credentials from {} in {:.3f}s'.format(loaded, args.snapshot_file, time.monotonic() - start))
+        snapshot_writer = SnapshotWriter(args.snapshot_file, args.snapshot_interval)
+        snapshot_writer.start()
+    if snapshot_writer is not None or worker_pids:
+        # Exit through the finally below on SIGTERM so the latest cache is saved and the workers are stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if shared_httpd is not None:
+            print('HTTP server is running as shared cache for {} workers'.format(len(worker_pids)))
+            shared_httpd.serve_forever()
+            return
+        serve(args, server_address, ssl_context)
+    finally:
+        stop_workers(worker_pids)
+        if snapshot_writer is not None:
+            snapshot_writer.stop()
+            snapshot_writer.write()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
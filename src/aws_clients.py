@@ -0,0 +1,48 @@
+import os
+import boto3
+from botocore.config import Config
+
+# Shared by all handlers. Clients are created once per Lambda container and reused by warm invocations,
+# so connections stay open between them instead of being set up again on every request.
+config = Config(
+    # Adaptive mode also slows down locally when DynamoDB or STS throttle
+    retries={
+        'max_attempts': 4,
+        'mode': 'adaptive'
+    },
+    # API Gateway gives up after 29 seconds, fail and retry well before that
+    connect_timeout=2,
+    read_timeout=5,
+    tcp_keepalive=True,
+    # A container handles one invocation at a time, which makes its calls one after the other
+    max_pool_connections=4
+)
+
+# STS is called on the regional endpoint of the function's partition, older botocore versions default to
+# the global endpoint, which adds a round trip to us-east-1
+os.environ.setdefault('AWS_STS_REGIONAL_ENDPOINTS', 'regional')
+
+clients = {}
+resources = {}
+
+def new_client(service_name, **kwargs):
+    return boto3.client(service_name, config=config, **kwargs)
+
+def client(service_name):
+    if service_name not in clients:
+        clients[service_name] = new_client(service_name)
+    return clients[service_name]
+
+def resource(service_name):
+    if service_name not in resources:
+        resources[service_name] = boto3.resource(service_name, config=config)
+    return resources[service_name]
+
+def paginate(operation, args):
+    # Yields the items of every page of a DynamoDB query or scan, args is updated to the next page's start key
+    while True:
+        response = operation(**args)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
@@ -0,0 +1,31 @@
+import json
+import os
+import aws_clients
+import token_lookup
+
+dynamodb = aws_clients.resource('dynamodb')
+sessions_table_name = os.environ['SESSIONS_TABLE_NAME']
+sessions_table = dynamodb.Table(sessions_table_name)
+
+# Adds SessionTokenLookupTable items for sessions created before create_session wrote them. Until it has
+# run, the authorizer falls back to SessionTokenGSI for tokens without a lookup item. Items are written
+# as they would be by create_session, so it can be run again, also while sessions are being created.
+
+def handler(event, context):
+    lookup_table = dynamodb.Table(token_lookup.table_name)
+    scan_args = {
+        'ProjectionExpression': 'ClusterNameSessionId, SubmittedTime, SessionToken'
+    }
+    written = 0
+    # batch_writer sends 25 items per BatchWriteItem and retries unprocessed items
+    with lookup_table.batch_writer() as batch:
+        for session in aws_clients.paginate(sessions_table.scan, scan_args):
+            if not session.get("SessionToken"):
+                continue
+            batch.put_item(Item=token_lookup.lookup_item(session))
+            written += 1
+    print("Wrote token lookup items", written)
+    return {
+        'statusCode': 200,
+        'body': json.dumps({"writtenItems": written})
+    }
@@ -1,18 +1,17 @@
 import json
 import os
-import boto3
+import aws_clients
+import role_mappings
 import re
 import time
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
-dynamodb = boto3.resource('dynamodb')
-iam = boto3.client('iam')
+dynamodb = aws_clients.resource('dynamodb')
+iam = aws_clients.client('iam')
 sessions_table_name = os.environ['SESSIONS_TABLE_NAME']
 sessions_table = dynamodb.Table(sessions_table_name)
 sessions_last_updated_time_index_name = "LastUpdatedTimeGSI"
-iam_role_mapping_table_name = os.environ['IAM_ROLE_MAPPING_TABLE_NAME']
-iam_role_mapping_table = dynamodb.Table(iam_role_mapping_table_name)
 
 # Set the number of days looking backwards from the current day that should be queried and cleaned-up. The most recent 24 hours is excluded to prevent removing active revocations.
 cleanup_window_days = 3
@@ -44,12 +43,10 @@ def handler(event, context):
         Select="SPECIFIC_ATTRIBUTES"
     )
     items = response['Items']
-    role_arns = set()
     print("Invalidated sessions within cleanup window specified", items)
 
-    # Lookup all applicable IAM role ARNs associated to projects and remove any obsolete IAM role inline revocation policies
-    for item in items:
-        role_arns.add(query_role_arn(item["ProjectId"]))
+    # Lookup all applicable IAM role ARNs associated to projects in one batch and remove any obsolete IAM role inline revocation policies
+    role_arns = set(role_mappings.require_role_arns(item["ProjectId"] for item in items))
     print('Role ARNs associated with invalidated sessions to clean up', role_arns)
     for role_arn in role_arns:
         delete_obsolete_role_revocation_policies(role_arn, last_updated_epoch_time_min, last_updated_epoch_time_max)
@@ -58,19 +55,6 @@ def handler(event, context):
             'body': '{}'
         }
 
-def query_role_arn(project_id):
-    response = iam_role_mapping_table.query(
-        KeyConditionExpression='ProjectId = :id',
-        ExpressionAttributeValues={
-            ':id': project_id
-        }
-    )
-    items = response['Items']
-    if len(items) == 1:
-        return items[0]["RoleArn"]
-    else:
-        raise Exception('')
-    
 def delete_obsolete_role_revocation_policies(role_arn, revocation_time_min, revocation_time_max):
     arn_pattern = r'arn:aws:iam::\d+:role/([^/]+)'
     role_name = re.match(arn_pattern, role_arn).group(1)
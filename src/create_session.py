@@ -1,10 +1,12 @@
 import json
 import uuid
 import os
-import boto3
+import aws_clients
+import role_mappings
+import token_lookup
 from datetime import datetime
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = aws_clients.resource('dynamodb')
 table_name = os.environ['SESSIONS_TABLE_NAME']
 table = dynamodb.Table(table_name)
 
@@ -60,22 +62,30 @@ def handler(event, context):
     
     # TODO: Add logic to handle previuos sessions with same clusterId and sessionId. One option is to update those previous sessions to "Completed" here
 
-    # Write new session details to DynamoDB table
+    item = {
+        'ClusterNameSessionId': cluster_name + "-" + session_id,
+        'SessionId': session_id,
+        'ProjectId': project_id,
+        'ClusterName': cluster_name,
+        'ClusterUser': cluster_user,
+        'SessionToken': session_token,
+        'Status': 'ACTIVE',
+        'SubmittedTime': submitted_time_number,
+        'LastUpdatedTime': submitted_time_number
+    }
+    # Store the project's role on the session so get_credentials does not have to look it up. Projects
+    # without a mapping yet are looked up by get_credentials.
+    role_arn = role_mappings.get_role_arn(project_id)
+    if role_arn is not None:
+        item['RoleArn'] = role_arn
+        mapping_version = role_mappings.current_version()
+        if mapping_version is not None:
+            item['RoleMappingVersion'] = mapping_version
+
+    # Write new session details to DynamoDB table, with its token lookup item in the same transaction so
+    # the authorizer finds the session as soon as this returns
     try:
-        table.put_item(
-            Item={
-                'ClusterNameSessionId': cluster_name + "-" + session_id,
-                'SessionId': session_id,
-                'ProjectId': project_id,
-                'ClusterName': cluster_name,
-                'ClusterUser': cluster_user,
-                'SessionToken': session_token,
-                'Status': 'ACTIVE',
-                'SubmittedTime': submitted_time_number,
-                'LastUpdatedTime': submitted_time_number
-            },
-            ConditionExpression='attribute_not_exists(SessionId)'
-        )
+        put_session(item)
         return {
             'statusCode': 200,
             'body': json.dumps(response)
@@ -85,3 +95,29 @@ def handler(event, context):
             'statusCode': 400,
             'body': json.dumps({"message": "Cluster Name, Session ID, and Submitted Time already exist."})
         }
+
+def put_session(item):
+    if not token_lookup.table_name:
+        table.put_item(
+            Item=item,
+            ConditionExpression='attribute_not_exists(SessionId)'
+        )
+        return
+    dynamodb.meta.client.transact_write_items(
+        TransactItems=[
+            {
+                'Put': {
+                    'TableName': table_name,
+                    'Item': item,
+                    'ConditionExpression': 'attribute_not_exists(SessionId)'
+                }
+            },
+            {
+                'Put': {
+                    'TableName': token_lookup.table_name,
+                    'Item': token_lookup.lookup_item(item),
+                    'ConditionExpression': 'attribute_not_exists(TokenHash)'
+                }
+            }
+        ]
+    )
@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+import aws_clients
+
+# Cache of credentials issued by get_credentials, so repeated requests for the same session, role and
+# roleSessionName do not call sts:AssumeRole again. Entries are kept in the container, and in a shared
+# DynamoDB table when CREDENTIALS_CACHE_TABLE_NAME is set, encrypted with the KMS key CREDENTIALS_CACHE_KEY_ID.
+# Callers check the session before reading the cache, so sessions that are no longer ACTIVE never get
+# cached credentials.
+
+# Cached credentials are reused until this many seconds before they expire
+margin_seconds = int(os.environ.get('CREDENTIALS_CACHE_MARGIN_SECONDS', 300))
+max_entries = int(os.environ.get('CREDENTIALS_CACHE_MAX_ENTRIES', 10000))
+table_name = os.environ.get('CREDENTIALS_CACHE_TABLE_NAME')
+key_id = os.environ.get('CREDENTIALS_CACHE_KEY_ID')
+
+# Credentials and their expiration as epoch seconds by cache key, least recently used first
+entries = OrderedDict()
+
+def cache_key(session, role_arn, role_session_name):
+    # The session token is part of the key, so a new session for the same cluster and session id never
+    # gets credentials issued to the previous one. Hashed, so the shared table holds no tokens.
+    parts = [session["ClusterNameSessionId"], str(session["SubmittedTime"]), session["SessionToken"], role_arn, role_session_name]
+    return hashlib.sha256("\n".join(parts).encode('UTF-8')).hexdigest()
+
+def expiration_epoch(credentials):
+    return datetime.fromisoformat(credentials["Expiration"]).timestamp()
+
+def get(key):
+    now = time.time()
+    entry = entries.get(key)
+    if entry is not None:
+        if entry[1] - margin_seconds > now:
+            entries.move_to_end(key)
+            return entry[0]
+        del entries[key]
+    if table_name:
+        try:
+            credentials = get_shared(key, now)
+        except Exception as e:
+            # The shared tier only saves STS calls, fall back to assuming the role
+            print("Reading shared credentials cache failed", e)
+            return None
+        if credentials is not None:
+            put_local(key, credentials)
+            return credentials
+    return None
+
+def put(key, credentials):
+    put_local(key, credentials)
+    if table_name:
+        try:
+            put_shared(key, credentials)
+        except Exception as e:
+            print("Writing shared credentials cache failed", e)
+
+def put_local(key, credentials):
+    entries[key] = (credentials, expiration_epoch(credentials))
+    entries.move_to_end(key)
+    while len(entries) > max_entries:
+        entries.popitem(last=False)
+
+def get_shared(key, now):
+    item = aws_clients.resource('dynamodb').Table(table_name).get_item(Key={'CacheKey': key}).get('Item')
+    # Expired items may still be there, TTL deletion runs in the background
+    if item is None or int(item["ExpiresAt"]) - margin_seconds <= now:
+        return None
+    plaintext = aws_clients.client('kms').decrypt(
+        CiphertextBlob=base64.b64decode(item["Ciphertext"]),
+        EncryptionContext={'CacheKey': key}
+    )['Plaintext']
+    return json.loads(plaintext)
+
+def put_shared(key, credentials):
+    ciphertext = aws_clients.client('kms').encrypt(
+        KeyId=key_id,
+        Plaintext=json.dumps(credentials).encode('UTF-8'),
+        # Binds the ciphertext to its key, an item copied under another key fails to decrypt
+        EncryptionContext={'CacheKey': key}
+    )['CiphertextBlob']
+    aws_clients.resource('dynamodb').Table(table_name).put_item(
+        Item={
+            'CacheKey': key,
+            'Ciphertext': base64.b64encode(ciphertext).decode('ascii'),
+            'ExpiresAt': int(expiration_epoch(credentials))
+        }
+    )
@@ -1,17 +1,17 @@
 import json
 import os
-import boto3
+import aws_clients
+import role_mappings
+import session_status
 import re
 import time
 from datetime import datetime, timezone
 
-dynamodb = boto3.resource('dynamodb')
-iam = boto3.client('iam')
+dynamodb = aws_clients.resource('dynamodb')
+iam = aws_clients.client('iam')
 sessions_table_name = os.environ['SESSIONS_TABLE_NAME']
 sessions_table = dynamodb.Table(sessions_table_name)
 sessions_cluster_user_index_name = 'ClusterUserGSI'
-iam_role_mapping_table_name = os.environ['IAM_ROLE_MAPPING_TABLE_NAME']
-iam_role_mapping_table = dynamodb.Table(iam_role_mapping_table_name)
 
 def handler(event, context):
     # Capture current time for consistent use across all revocation activities
@@ -34,14 +34,13 @@ def handler(event, context):
         FilterExpression='#SessionStatus = :statusValue'
     )
     items = response['Items']
-    role_arns = set()
     print("Active sessions for revocation associated with user", items)
-    # Update active sessions for user to invalidated status. Lookup all applicable IAM role ARNs associated to projects
+    # Update active sessions for user to invalidated status
     for item in items:
-        item["Status"] = "INVALIDATED"
-        item["LastUpdatedTime"] = get_current_epoch_time()
+        session_status.set_status(item, "INVALIDATED", get_current_epoch_time())
         sessions_table.put_item(Item=item)
-        role_arns.add(query_role_arn(item["ProjectId"]))
+    # Lookup all applicable IAM role ARNs associated to projects, in one batch
+    role_arns = set(role_mappings.require_role_arns(item["ProjectId"] for item in items))
     for role_arn in role_arns:
         put_role_revocation_policy(revocation_time, role_arn, role_session_name_pattern)
     print('Role ARNs associated with user sessions for revocation ', role_arns)
@@ -50,19 +49,6 @@ def handler(event, context):
             'body': '{}'
         }
 
-def query_role_arn(project_id):
-    response = iam_role_mapping_table.query(
-        KeyConditionExpression='ProjectId = :id',
-        ExpressionAttributeValues={
-            ':id': project_id
-        }
-    )
-    items = response['Items']
-    if len(items) == 1:
-        return items[0]["RoleArn"]
-    else:
-        raise Exception('')
-
 def get_current_epoch_time():
     epoch_time = int(time.time())
     return epoch_time
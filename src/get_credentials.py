@@ -1,24 +1,46 @@
-import boto3
+import aws_clients
+import credentials_cache
+import role_mappings
 import json
 import os
+import time
+from decimal import Decimal
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = aws_clients.resource('dynamodb')
 sessions_table_name = os.environ['SESSIONS_TABLE_NAME']
 sessions_table = dynamodb.Table(sessions_table_name)
-iam_role_mapping_table_name = os.environ['IAM_ROLE_MAPPING_TABLE_NAME']
-iam_role_mapping_table = dynamodb.Table(iam_role_mapping_table_name)
+# Sessions read by the authorizer serve cached credentials without reading them again while they are at
+# most this old, 0 always reads the session. A session ended through update_session is only seen once the
+# context is older, so it can get cached credentials for up to this long.
+authorizer_context_max_age_seconds = float(os.environ.get('AUTHORIZER_CONTEXT_MAX_AGE_SECONDS', 0))
 
 def handler(event, context):
-    # Lookup Role ARN for project associated with job session
+    cluster_name_session_id = event["pathParameters"]["clusterId"] + "-" + event["pathParameters"]["sessionId"]
+    items = session_from_authorizer(event, cluster_name_session_id)
+    # Cache keys already looked up for this request, not read from the shared tier a second time
+    missed_keys = set()
+    if items is not None:
+        # The session as the authorizer read it only serves credentials issued before, for at most
+        # authorizer_context_max_age_seconds. New credentials are only issued after reading the session again below.
+        response = session_credentials(event, items, cached_only=True, missed_keys=missed_keys)
+        if response is not None and response['statusCode'] == 200:
+            return response
+    # Lookup Role ARN for project associated with job session. Consistent, so a session invalidated just
+    # before is never issued new credentials.
     response = sessions_table.query(
         KeyConditionExpression='ClusterNameSessionId = :clusterNameSessionId',
         ExpressionAttributeValues={
-            ':clusterNameSessionId': event["pathParameters"]["clusterId"] + "-" + event["pathParameters"]["sessionId"],
+            ':clusterNameSessionId': cluster_name_session_id,
         },
+        ConsistentRead=True,
         ScanIndexForward=False,
         Limit=1
     )
-    items = response['Items']
+    return session_credentials(event, response['Items'], missed_keys=missed_keys)
+
+def session_credentials(event, items, cached_only=False, missed_keys=None):
+    # Returns the response for the latest session in items. With cached_only, returns None instead of
+    # assuming the role when the credentials are not cached, and adds their key to missed_keys.
     print("items", items)
 
     if len(items) != 1:
@@ -54,21 +76,20 @@ def handler(event, context):
             'body': '{"message": "session is not ACTIVE"}'
         }
     
-    response = iam_role_mapping_table.query(
-        KeyConditionExpression='ProjectId = :id',
-        ExpressionAttributeValues={
-            ':id': session["ProjectId"]
-        }
-    )
-    items = response['Items']
-    if len(items) != 1:
+    # Sessions store their role when created, unless the mappings changed since and the session was not re-synced.
+    # Without a __version__ item changes cannot be told apart, so the mapping is looked up.
+    mapping_version = role_mappings.current_version()
+    if "RoleArn" in session and mapping_version is not None and session.get("RoleMappingVersion") == mapping_version:
+        role_arn = session["RoleArn"]
+    else:
+        role_arn = role_mappings.get_role_arn(session["ProjectId"])
+    if role_arn is None:
         return {
             'statusCode': 404,
             'body': json.dumps({"message": "There is no role mapping for given projectId"})
         }
-    role_mapping = items[0]
     assume_role_args = {
-       "RoleArn": role_mapping["RoleArn"]
+       "RoleArn": role_arn
     }
     
     if event["queryStringParameters"] and "roleSessionName" in event["queryStringParameters"]:
@@ -78,15 +99,49 @@ def handler(event, context):
             'statusCode': 400,
             'body': '{"message": "Missing roleSessionName queryParameter"}'
         }
-    out = assume_iam_role(assume_role_args)
+    # Only reached for ACTIVE sessions, checked above
+    key = credentials_cache.cache_key(session, assume_role_args["RoleArn"], assume_role_args["RoleSessionName"])
+    out = None if missed_keys and key in missed_keys else credentials_cache.get(key)
+    if out is None:
+        if cached_only:
+            if missed_keys is not None:
+                missed_keys.add(key)
+            return None
+        out = assume_iam_role(assume_role_args)
+        credentials_cache.put(key, out)
     return {
         'statusCode': 200,
         'body': json.dumps(out)
     }
 
+def session_from_authorizer(event, cluster_name_session_id):
+    # Returns the latest session for the path as the authorizer read it, in the same shape as the query
+    # above, or None when the authorizer context is missing, too old or about another session
+    authorizer = (event.get("requestContext") or {}).get("authorizer") or {}
+    if authorizer_context_max_age_seconds <= 0:
+        return None
+    if authorizer.get("ClusterNameSessionId") != cluster_name_session_id or "SessionReadAt" not in authorizer or "IsLatest" not in authorizer:
+        return None
+    if time.time() * 1000 - int(authorizer["SessionReadAt"]) > authorizer_context_max_age_seconds * 1000:
+        return None
+    session = {}
+    for name in ["ClusterNameSessionId", "SessionId", "ClusterName", "ProjectId", "Status", "RoleArn"]:
+        if name in authorizer:
+            session[name] = authorizer[name]
+    session["SubmittedTime"] = int(authorizer["SubmittedTime"])
+    if "RoleMappingVersion" in authorizer:
+        session["RoleMappingVersion"] = Decimal(authorizer["RoleMappingVersion"])
+    # API Gateway passes context values on as strings. The authorizer found the session by this token,
+    # a newer session for the same cluster and session id has another one.
+    if str(authorizer["IsLatest"]).lower() == "true":
+        session["SessionToken"] = event["headers"]["Authorization"]
+    else:
+        session["SessionToken"] = None
+    return [session]
+
 def assume_iam_role(assume_role_args):
-    # Create a STS client
-    sts_client = boto3.client('sts')
+    # Reused across invocations
+    sts_client = aws_clients.client('sts')
 
     # Assume the IAM role
     response = sts_client.assume_role(**assume_role_args)
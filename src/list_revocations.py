@@ -0,0 +1,104 @@
+import base64
+import binascii
+import json
+import os
+import aws_clients
+import hashlib
+import session_status
+import time
+
+dynamodb = aws_clients.resource('dynamodb')
+table_name = os.environ['SESSIONS_TABLE_NAME']
+table = dynamodb.Table(table_name)
+# Revocations older than this are not listed, credentials issued before them have expired by now
+MAX_WINDOW_SECONDS = int(os.environ.get('REVOCATION_WINDOW_SECONDS', 43200))
+# The index is eventually consistent, so the returned cursor trails the current time and late writes
+# are listed by the next poll. Revocations can be listed more than once.
+CURSOR_LAG_SECONDS = 60
+# Revocations per response, keeps responses far below the Lambda response size limit
+PAGE_SIZE = int(os.environ.get('REVOCATION_PAGE_SIZE', 1000))
+
+def handler(event, context):
+    now = get_current_epoch_time()
+    params = event.get("queryStringParameters") or {}
+    try:
+        since = int(params.get("since", 0))
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({"message": "since must be an epoch time in seconds"})
+        }
+    since = max(since, now - MAX_WINDOW_SECONDS)
+    # The cursor is that of the first page, so revocations written while later pages are read are listed again
+    position = {"Bucket": session_status.revoked_hour(since), "Key": None, "Cursor": max(since, now - CURSOR_LAG_SECONDS)}
+    if params.get("next"):
+        try:
+            position = decode_position(params["next"])
+            # Every bucket from that of since is queried, never start further back
+            if position["Bucket"] < session_status.revoked_hour(since):
+                raise ValueError("Position before since")
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({"message": "next must be a NextCursor returned by this API"})
+            }
+
+    # Revocations are read an hour bucket at a time, from the hour of since to the current one. Session
+    # tokens are only listed hashed, proxies hash the tokens of their cached credentials to match.
+    revocations = []
+    bucket = position["Bucket"]
+    last_bucket = session_status.revoked_hour(now)
+    key = position["Key"]
+    while bucket <= last_bucket and len(revocations) < PAGE_SIZE:
+        response = query_bucket_since(bucket, since, PAGE_SIZE - len(revocations), key)
+        for item in response['Items']:
+            revocations.append({
+                "TokenHash": hashlib.sha256(item["SessionToken"].encode('UTF-8')).hexdigest(),
+                "LastUpdatedTime": int(item["LastUpdatedTime"]),
+            })
+        key = response.get('LastEvaluatedKey')
+        if key is None:
+            bucket += 1
+    body = {
+        "Revocations": revocations,
+        "Cursor": position["Cursor"],
+    }
+    # Pages end after PAGE_SIZE revocations, request the next one with next=NextCursor and the same since
+    if bucket <= last_bucket:
+        body["NextCursor"] = encode_position({"Bucket": bucket, "Key": key, "Cursor": position["Cursor"]})
+    return {
+        'statusCode': 200,
+        'body': json.dumps(body)
+    }
+
+def encode_position(position):
+    # Key values are strings and whole numbers, DynamoDB returns the numbers as Decimal
+    return base64.urlsafe_b64encode(json.dumps(position, default=int).encode('UTF-8')).decode('ascii')
+
+def decode_position(next_cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(next_cursor.encode('ascii')))
+        if not isinstance(position["Bucket"], int) or not isinstance(position["Cursor"], int):
+            raise ValueError("Invalid position")
+        return position
+    except (KeyError, TypeError, UnicodeError, binascii.Error, json.JSONDecodeError) as e:
+        raise ValueError("Invalid position") from e
+
+def query_bucket_since(bucket, since, limit, exclusive_start_key=None):
+    query_args = {
+        'IndexName': session_status.revoked_index_name,
+        'KeyConditionExpression': 'RevokedHour = :bucket AND LastUpdatedTime >= :since',
+        'ExpressionAttributeValues': {
+            ':bucket': bucket,
+            ':since': since
+        },
+        'ProjectionExpression': 'SessionToken, LastUpdatedTime',
+        'Limit': limit
+    }
+    if exclusive_start_key is not None:
+        query_args['ExclusiveStartKey'] = exclusive_start_key
+    return table.query(**query_args)
+
+def get_current_epoch_time():
+    epoch_time = int(time.time())
+    return epoch_time
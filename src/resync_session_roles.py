@@ -0,0 +1,84 @@
+import json
+import os
+import aws_clients
+import role_mappings
+
+dynamodb = aws_clients.resource('dynamodb')
+sessions_table_name = os.environ['SESSIONS_TABLE_NAME']
+sessions_table = dynamodb.Table(sessions_table_name)
+sessions_project_id_index_name = 'ProjectIdGSI'
+
+# Stores the current role mapping on ACTIVE sessions after IamRoleMappingTable changed, so get_credentials
+# reads the role from the session again instead of looking it up. Invoke it with {"projectIds": [...]}
+# to re-sync the sessions of changed projects only, or without projectIds to re-sync all ACTIVE sessions.
+
+def handler(event, context):
+    event = event or {}
+    # Read the mappings as they are now, not as cached by this container
+    role_mappings.reset()
+    mapping_version = role_mappings.current_version()
+
+    if event.get("projectIds"):
+        sessions = query_active_sessions(event["projectIds"])
+    else:
+        sessions = scan_active_sessions()
+    updated = 0
+    missing_projects = set()
+    for session in sessions:
+        role_arn = role_mappings.get_role_arn(session["ProjectId"])
+        if role_arn is None:
+            missing_projects.add(session["ProjectId"])
+            continue
+        if session.get("RoleArn") == role_arn and session.get("RoleMappingVersion") == mapping_version:
+            continue
+        update_session_role(session, role_arn, mapping_version)
+        updated += 1
+    print("Re-synced roles of sessions", updated, "projects without a role mapping", missing_projects)
+    return {
+        'statusCode': 200,
+        'body': json.dumps({"updatedSessions": updated, "projectsWithoutMapping": sorted(missing_projects)})
+    }
+
+def update_session_role(session, role_arn, mapping_version):
+    key = {
+        'ClusterNameSessionId': session["ClusterNameSessionId"],
+        'SubmittedTime': session["SubmittedTime"]
+    }
+    # Only the role attributes are written, so status changes made meanwhile are kept
+    if mapping_version is None:
+        sessions_table.update_item(
+            Key=key,
+            UpdateExpression='SET RoleArn = :roleArn REMOVE RoleMappingVersion',
+            ConditionExpression='attribute_exists(ClusterNameSessionId)',
+            ExpressionAttributeValues={':roleArn': role_arn}
+        )
+    else:
+        sessions_table.update_item(
+            Key=key,
+            UpdateExpression='SET RoleArn = :roleArn, RoleMappingVersion = :version',
+            ConditionExpression='attribute_exists(ClusterNameSessionId)',
+            ExpressionAttributeValues={':roleArn': role_arn, ':version': mapping_version}
+        )
+
+def session_query_args():
+    return {
+        'FilterExpression': '#SessionStatus = :statusValue',
+        # Using AttributeNames since Status is a DynamoDB reserved keyword
+        'ExpressionAttributeNames': {
+            '#SessionStatus': 'Status'
+        },
+        'ProjectionExpression': 'ClusterNameSessionId, SubmittedTime, ProjectId, RoleArn, RoleMappingVersion'
+    }
+
+def query_active_sessions(project_ids):
+    for project_id in project_ids:
+        query_args = session_query_args()
+        query_args['IndexName'] = sessions_project_id_index_name
+        query_args['KeyConditionExpression'] = 'ProjectId = :projectId'
+        query_args['ExpressionAttributeValues'] = {':projectId': project_id, ':statusValue': 'ACTIVE'}
+        yield from aws_clients.paginate(sessions_table.query, query_args)
+
+def scan_active_sessions():
+    scan_args = session_query_args()
+    scan_args['ExpressionAttributeValues'] = {':statusValue': 'ACTIVE'}
+    yield from aws_clients.paginate(sessions_table.scan, scan_args)
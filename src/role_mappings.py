@@ -0,0 +1,109 @@
+import os
+import time
+import aws_clients
+
+# In-container cache of the project to IAM role mappings in IamRoleMappingTable, shared by all handlers.
+# Mappings are kept for ROLE_MAPPING_CACHE_TTL_SECONDS. To apply a changed mapping sooner, increment the
+# Version attribute of the item with ProjectId __version__: containers read it every
+# ROLE_MAPPING_VERSION_CHECK_SECONDS and drop their cached mappings when it changed.
+table_name = os.environ['IAM_ROLE_MAPPING_TABLE_NAME']
+ttl_seconds = int(os.environ.get('ROLE_MAPPING_CACHE_TTL_SECONDS', 900))
+version_check_seconds = int(os.environ.get('ROLE_MAPPING_VERSION_CHECK_SECONDS', 30))
+VERSION_PROJECT_ID = '__version__'
+# BatchGetItem reads up to 100 keys per request
+BATCH_SIZE = 100
+
+# Role ARN and the monotonic time it was loaded at, by project id. Projects without a mapping are
+# not cached, so a newly added mapping is used right away.
+mappings = {}
+version = None
+version_checked = None
+
+def get_role_arn(project_id):
+    # Returns the role ARN mapped to project_id, or None when there is none
+    return get_role_arns([project_id]).get(project_id)
+
+def get_role_arns(project_ids, refresh=False):
+    # Returns the role ARNs mapped to project_ids by project id, projects without a mapping are left out.
+    # With refresh, all of them are read from the table, and the cache is updated with what was read.
+    if not refresh:
+        check_version()
+    now = time.monotonic()
+    role_arns = {}
+    missing = []
+    for project_id in set(project_ids):
+        cached = mappings.get(project_id)
+        if not refresh and cached is not None and now - cached[1] < ttl_seconds:
+            role_arns[project_id] = cached[0]
+        else:
+            missing.append(project_id)
+    if not missing:
+        return role_arns
+    if len(missing) == 1:
+        item = table().get_item(Key={'ProjectId': missing[0]}).get('Item')
+        loaded = [item] if item is not None else []
+    else:
+        loaded = batch_get(missing)
+    for item in loaded:
+        mappings[item["ProjectId"]] = (item["RoleArn"], now)
+        role_arns[item["ProjectId"]] = item["RoleArn"]
+    return role_arns
+
+def require_role_arns(project_ids):
+    # Returns the role ARNs of project_ids as they are in the table now, raises when a project has no mapping.
+    # Used for revocations, which must cover the role a project maps to now: a mapping changed within the
+    # cache TTL would otherwise get the old role the Deny policy and leave the new role's credentials valid.
+    project_ids = set(project_ids)
+    role_arns = get_role_arns(project_ids, refresh=True)
+    if len(role_arns) != len(project_ids):
+        raise Exception('No role mapping for projects ' + ', '.join(sorted(project_ids - set(role_arns))))
+    return list(role_arns.values())
+
+def batch_get(project_ids):
+    items = []
+    for start in range(0, len(project_ids), BATCH_SIZE):
+        request_items = {
+            table_name: {
+                'Keys': [{'ProjectId': project_id} for project_id in project_ids[start:start + BATCH_SIZE]],
+                'ProjectionExpression': 'ProjectId, RoleArn'
+            }
+        }
+        attempt = 0
+        while request_items:
+            response = aws_clients.resource('dynamodb').batch_get_item(RequestItems=request_items)
+            items.extend(response['Responses'].get(table_name, []))
+            # Keys left unread when throttled are requested again after a short backoff
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                attempt += 1
+                time.sleep(min(1, 0.05 * 2 ** attempt))
+    return items
+
+def reset():
+    # Drops the cached mappings and version, so the next lookups read the table as it is now
+    global version
+    global version_checked
+    mappings.clear()
+    version = None
+    version_checked = None
+
+def current_version():
+    # Version stamp of the mappings, None when there is no __version__ item
+    check_version()
+    return version
+
+def check_version():
+    global version
+    global version_checked
+    now = time.monotonic()
+    if version_checked is not None and now - version_checked < version_check_seconds:
+        return
+    item = table().get_item(Key={'ProjectId': VERSION_PROJECT_ID}).get('Item')
+    current = item.get("Version") if item is not None else None
+    if current != version:
+        mappings.clear()
+        version = current
+    version_checked = now
+
+def table():
+    return aws_clients.resource('dynamodb').Table(table_name)
@@ -0,0 +1,18 @@
+# Sessions in these states are refused credentials, so proxies must stop serving cached ones
+REVOKED_STATUSES = ["INVALIDATED", "COMPLETED"]
+# Revoked sessions carry RevokedHour, the hour of their LastUpdatedTime since the epoch, which is the
+# partition key of RevokedHourGSI. Only revoked sessions are in the index, and each hour of revocations
+# is its own partition, instead of every session being in the partition of its status.
+revoked_index_name = 'RevokedHourGSI'
+BUCKET_SECONDS = 3600
+
+def revoked_hour(epoch_time):
+    return int(epoch_time) // BUCKET_SECONDS
+
+def set_status(session, status, epoch_time):
+    session['Status'] = status
+    session['LastUpdatedTime'] = epoch_time
+    if status in REVOKED_STATUSES:
+        session['RevokedHour'] = revoked_hour(epoch_time)
+    else:
+        session.pop('RevokedHour', None)
@@ -0,0 +1,18 @@
+import hashlib
+import os
+
+# SessionTokenLookupTable maps the hash of a session token to the key of its session, so the authorizer
+# finds sessions with a strongly consistent GetItem instead of querying the eventually consistent
+# SessionTokenGSI. create_session writes both items in one transaction, backfill_token_lookup adds the
+# items of sessions created before the table existed.
+table_name = os.environ.get('TOKEN_LOOKUP_TABLE_NAME')
+
+def token_hash(session_token):
+    return hashlib.sha256(session_token.encode('UTF-8')).hexdigest()
+
+def lookup_item(session):
+    return {
+        'TokenHash': token_hash(session['SessionToken']),
+        'ClusterNameSessionId': session['ClusterNameSessionId'],
+        'SubmittedTime': session['SubmittedTime']
+    }
@@ -1,11 +1,12 @@
 import json
 import uuid
 import os
-import boto3
+import aws_clients
+import session_status
 import time
 from decimal import Decimal
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = aws_clients.resource('dynamodb')
 table_name = os.environ['SESSIONS_TABLE_NAME']
 table = dynamodb.Table(table_name)
 
@@ -35,7 +36,8 @@ def handler(event, context):
             ':clusterNameSessionId': event["pathParameters"]["clusterId"] + "-" + event["pathParameters"]["sessionId"],
         },
         ScanIndexForward=False,
-        Limit=1
+        Limit=1,
+        ConsistentRead=True
     )
     items = response['Items']
     print('Session item for update', items)
@@ -52,8 +54,7 @@ def handler(event, context):
             'statusCode': 400,
             'body': json.dumps({"message": "Status can only be updated to ACTIVE, COMPLETED, or INVALIDATED"})
         }
-    session['Status'] = body['status']
-    session['LastUpdatedTime'] = get_current_epoch_time()
+    session_status.set_status(session, body['status'], get_current_epoch_time())
 
     # Write session token to DynamoDB table
     table.put_item(
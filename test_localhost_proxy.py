@@ -1,9 +1,30 @@
 import unittest
-from localhost_proxy import CacheContainer
-from datetime import datetime, timedelta
+import localhost_proxy
+from localhost_proxy import CacheContainer, CacheEntry, InflightRequests, InflightTimeout, ThreadedHTTPServer, ProxyHTTPRequestHandler, UpstreamSession, RefreshAhead
+from localhost_proxy import serve_asyncio, write_snapshot, load_snapshot, prefetch
+from localhost_proxy import deadline_after, expiration_deadline
+from localhost_proxy import RetryPolicy, CircuitBreaker, CircuitBreakers, CircuitOpen, UpstreamEndpoints, StdlibUpstreamSession
+from localhost_proxy import RevocationPoller, TrafficCapture, token_hash, fetch_upstream
+from load_test.stub_upstream import StubUpstream
+from load_test import replay
+import asyncio
+from datetime import datetime, timedelta, timezone
+import http.client
+import itertools
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import threading
 import time
 
+def entry(deadline, content):
+    return CacheEntry(200, b'', content.encode() if isinstance(content, str) else content, deadline)
+
 class TestStringMethods(unittest.TestCase):
 
     def test_not_exists(self):
@@ -12,8 +33,8 @@ class TestStringMethods(unittest.TestCase):
 
     def test_max_queue_size_one(self):
         cache = CacheContainer("store", 1)
-        value1 = {"expiration": datetime.now() + timedelta(minutes=1), "content": "one"}
-        value2 = {"expiration": datetime.now() + timedelta(minutes=1), "content": "two"}
+        value1 = entry(deadline_after(60), "one")
+        value2 = entry(deadline_after(60), "two")
         cache.put("one", value1)
         self.assertEqual(value1, cache.get("one"))
         # Second item should not be on the cache
@@ -26,10 +47,10 @@ class TestStringMethods(unittest.TestCase):
 
     def test_expire_on_time(self):
         cache = CacheContainer("store", 1)
-        self.assertEqual(cache.cache_keys.qsize(), 0)
+        self.assertEqual(len(cache.expirations), 0)
         cache.clear_cache()
-        self.assertEqual(cache.cache_keys.qsize(), 0)
-        value1 = {"expiration": datetime.now() + timedelta(seconds=3), "content": "one"}
+        self.assertEqual(len(cache.expirations), 0)
+        value1 = entry(deadline_after(3), "one")
         cache.put("one", value1)
         self.assertEqual(value1, cache.get("one"))
         time.sleep(5)
@@ -38,11 +59,11 @@ class TestStringMethods(unittest.TestCase):
 
     def test_insert_twice(self):
         cache = CacheContainer("store", 1)
-        value1 = {"expiration": datetime.now() + timedelta(seconds=3), "content": "one"}
+        value1 = entry(deadline_after(3), "one")
         cache.put("one", value1)
         self.assertEqual(value1, cache.get("one"))
         # Insert element again with higher expiration
-        value1 = {"expiration": datetime.now() + timedelta(seconds=4), "content": "one"}
+        value1 = entry(deadline_after(4), "one")
         cache.put("one", value1)
         self.assertEqual(value1, cache.get("one"))
         time.sleep(5)
@@ -52,7 +73,7 @@ class TestStringMethods(unittest.TestCase):
     def test_multithreaded_cache_access(self):
         cache = CacheContainer("store", 1)
         num_threads = 10
-        cache_value = {"expiration": datetime.now() + timedelta(minutes=2), "content": "test"}
+        cache_value = entry(deadline_after(120), "test")
 
         def insert_and_get():
             for i in range(100):
@@ -81,5 +102,1241 @@ class TestStringMethods(unittest.TestCase):
             else:
                 self.assertEqual(retrieved_value, cache_value)
 
+class TestCacheOrdering(unittest.TestCase):
+
+    def value(self, seconds, content=None):
+        return CacheEntry(200, b'', str(content).encode(), deadline_after(seconds))
+
+    def test_evicts_least_recently_used(self):
+        cache = CacheContainer("store", 2)
+        cache.put("one", self.value(60))
+        cache.put("two", self.value(60))
+        # Reading one makes two the least recently used
+        self.assertIsNotNone(cache.get("one"))
+        cache.put("three", self.value(60))
+        self.assertIsNone(cache.get("two"))
+        self.assertIsNotNone(cache.get("one"))
+        self.assertIsNotNone(cache.get("three"))
+
+    def test_short_lived_entry_purged_behind_long_lived(self):
+        cache = CacheContainer("store", 0)
+        cache.put("long", self.value(60))
+        cache.put("short", self.value(0.2))
+        time.sleep(0.3)
+        cache.clear_cache()
+        self.assertNotIn("short", cache.credentials_cache)
+        self.assertIsNotNone(cache.get("long"))
+
+    def test_expired_entry_removed_on_get(self):
+        cache = CacheContainer("store", 0)
+        cache.put("one", self.value(0.1))
+        time.sleep(0.2)
+        self.assertIsNone(cache.get("one"))
+        self.assertNotIn("one", cache.credentials_cache)
+
+    def test_replaced_entry_not_purged_by_old_expiration(self):
+        cache = CacheContainer("store", 0)
+        cache.put("one", self.value(0.1))
+        cache.put("one", self.value(60))
+        time.sleep(0.2)
+        cache.clear_cache()
+        self.assertIsNotNone(cache.get("one"))
+
+    def test_zero_max_queue_size_unbounded(self):
+        cache = CacheContainer("store", 0)
+        for i in range(1000):
+            cache.put(i, self.value(60))
+        self.assertEqual(1000, len(cache.credentials_cache))
+
+    def test_heap_stays_proportional_to_cache(self):
+        cache = CacheContainer("store", 10)
+        for i in range(10000):
+            cache.put(i % 20, self.value(60))
+        self.assertEqual(10, len(cache.credentials_cache))
+        self.assertLessEqual(len(cache.expirations), 2 * 10 + 64)
+
+    def test_concurrent_put_get_with_expiring_entries(self):
+        cache = CacheContainer("store", 50)
+        num_threads = 16
+        errors = []
+        start = threading.Barrier(num_threads)
+
+        def worker(thread_id):
+            start.wait()
+            try:
+                for i in range(2000):
+                    key = (thread_id * 7 + i) % 200
+                    # Mix entries that expire during the test with long-lived ones
+                    cache.put(key, self.value(0.01 if i % 3 == 0 else 60, key))
+                    value = cache.get((key + 1) % 200)
+                    if value is not None:
+                        if value.body != str((key + 1) % 200).encode():
+                            errors.append("wrong value for key")
+                        if value.deadline <= deadline_after(-1):
+                            errors.append("expired value returned")
+                    if len(cache.credentials_cache) > 50:
+                        errors.append("cache above max_queue_size")
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        cache.clear_cache()
+        self.assertLessEqual(len(cache.credentials_cache), 50)
+        # Every cached key can still be found through the expiration heap
+        heap_keys = {key for deadline, sequence, key in cache.expirations}
+        self.assertLessEqual(set(cache.credentials_cache), heap_keys)
+
+def configure_proxy(stub, cache_mode="store", refresher=None):
+    localhost_proxy.hostname = stub.hostname
+    localhost_proxy.upstream_scheme = 'http'
+    localhost_proxy.cache = CacheContainer(cache_mode, 1000)
+    localhost_proxy.inflight = InflightRequests(5)
+    localhost_proxy.upstream = UpstreamSession(4, 60)
+    localhost_proxy.refresher = refresher
+    localhost_proxy.retry_policy = None
+    localhost_proxy.breakers = None
+    localhost_proxy.negative_cache_ttl = 0
+    localhost_proxy.endpoints = None
+    localhost_proxy.revocations = None
+    localhost_proxy.capture = None
+
+def start_proxy(stub, cache_mode="store", refresher=None):
+    configure_proxy(stub, cache_mode, refresher)
+    httpd = ThreadedHTTPServer(('127.0.0.1', 0), ProxyHTTPRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def stop_proxy(httpd):
+    httpd.shutdown()
+    httpd.server_close()
+
+class AsyncProxy():
+    def __init__(self, stub, cache_mode="store"):
+        configure_proxy(stub, cache_mode)
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        def on_started(server):
+            self.server = server
+            started.set()
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.task = self.loop.create_task(serve_asyncio(('127.0.0.1', 0), 4, 60, 30, on_started))
+            try:
+                self.loop.run_until_complete(self.task)
+            except asyncio.CancelledError:
+                pass
+            # Let open client connections finish before the loop is closed
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+        self.loop.close()
+
+def wait_for_proxy(port):
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.connect()
+            return conn
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_proxy_process(args):
+    port = free_port()
+    proxy = subprocess.Popen([sys.executable, 'localhost_proxy.py', '--port', str(port)] + args,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_proxy(port).close()
+    return proxy, port
+
+def stop_proxy_process(proxy):
+    # SIGTERM lets the proxy save its snapshot on the way out
+    proxy.send_signal(signal.SIGTERM)
+    proxy.wait()
+
+def proxy_get(conn, path='/prod/sessions/1/cluster/a/project/b?roleSessionName=n', token='token'):
+    conn.request('GET', path, headers={'Authorization': token})
+    resp = conn.getresponse()
+    return resp.status, resp.read().decode()
+
+class TestInflightRequests(unittest.TestCase):
+
+    def run_concurrently(self, num_threads, target):
+        start = threading.Barrier(num_threads)
+        results = [None] * num_threads
+        def run(i):
+            start.wait()
+            try:
+                results[i] = target()
+            except BaseException as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_callers_share_one_call(self):
+        inflight = InflightRequests(5)
+        calls = []
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return "creds"
+        results = self.run_concurrently(64, lambda: inflight.do("key", fetch))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(["creds"] * 64, results)
+        self.assertEqual({}, inflight.calls)
+
+    def test_concurrent_callers_share_error(self):
+        inflight = InflightRequests(5)
+        calls = []
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            raise ValueError("upstream failed")
+        results = self.run_concurrently(16, lambda: inflight.do("key", fetch))
+        self.assertEqual(1, len(calls))
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        # The failed call is not remembered, the next caller retries
+        self.assertEqual("creds", inflight.do("key", lambda: "creds"))
+
+    def test_different_keys_not_coalesced(self):
+        inflight = InflightRequests(5)
+        self.assertEqual("one", inflight.do("one", lambda: "one"))
+        self.assertEqual("two", inflight.do("two", lambda: "two"))
+
+    def test_waiter_timeout(self):
+        inflight = InflightRequests(0.1)
+        release = threading.Event()
+        leader = threading.Thread(target=inflight.do, args=("key", release.wait))
+        leader.start()
+        while "key" not in inflight.calls:
+            time.sleep(0.01)
+        with self.assertRaises(InflightTimeout):
+            inflight.do("key", lambda: "never called")
+        release.set()
+        leader.join()
+
+    def test_proxy_concurrent_misses_one_upstream_request(self):
+        stub = StubUpstream(latency=0.2).start()
+        httpd = start_proxy(stub)
+        def client_get():
+            conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+            result = proxy_get(conn)
+            conn.close()
+            return result
+        try:
+            results = self.run_concurrently(32, client_get)
+        finally:
+            stop_proxy(httpd)
+            stub.stop()
+        self.assertEqual(1, stub.calls)
+        self.assertEqual(32, len(results))
+        for status, body in results:
+            self.assertEqual(200, status)
+            self.assertEqual(results[0][1], body)
+
+class TestUpstreamConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubUpstream().start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_misses_reuse_upstream_connection(self):
+        httpd = start_proxy(self.stub, cache_mode="none")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+            for i in range(5):
+                status, body = proxy_get(conn)
+                self.assertEqual(200, status)
+            conn.close()
+        finally:
+            stop_proxy(httpd)
+        self.assertEqual(5, self.stub.calls)
+        self.assertEqual(1, len(self.stub.connections))
+
+    def test_client_connection_kept_alive(self):
+        httpd = start_proxy(self.stub)
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+            self.assertEqual(200, proxy_get(conn)[0])
+            sock = conn.sock
+            self.assertEqual(200, proxy_get(conn)[0])
+            # http.client reopens the socket if the server closed it
+            self.assertIs(sock, conn.sock)
+            conn.request('HEAD', '/prod/sessions/1/cluster/a/project/b?roleSessionName=n', headers={'Authorization': 'token'})
+            resp = conn.getresponse()
+            self.assertEqual(b'', resp.read())
+            self.assertEqual(200, proxy_get(conn)[0])
+            conn.close()
+        finally:
+            stop_proxy(httpd)
+        self.assertEqual(1, self.stub.calls)
+
+    def test_idle_session_reopened(self):
+        upstream = UpstreamSession(4, 0.1)
+        session = upstream.current()
+        self.assertIs(session, upstream.current())
+        time.sleep(0.2)
+        self.assertIsNot(session, upstream.current())
+
+class TestStdlibUpstream(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubUpstream().start()
+        self.httpd = start_proxy(self.stub, cache_mode="none")
+        localhost_proxy.upstream = StdlibUpstreamSession(4, 60)
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+        stop_proxy(self.httpd)
+        self.stub.stop()
+
+    def test_get_reuses_upstream_connection(self):
+        for i in range(5):
+            status, body = proxy_get(self.conn)
+            self.assertEqual(200, status)
+            self.assertEqual("ASIASTUB", json.loads(body)["AccessKeyId"])
+        self.assertEqual(5, self.stub.calls)
+        self.assertEqual(1, len(self.stub.connections))
+        self.assertEqual([self.stub.hostname] * 5, self.stub.hosts)
+
+    def test_post_headers_filtered(self):
+        self.conn.request('POST', '/prod/sessions', body='{"sessionId": "1"}', headers={'Authorization': 'secret'})
+        resp = self.conn.getresponse()
+        self.assertEqual(200, resp.status)
+        self.assertEqual('application/json', resp.getheader('Content-Type'))
+        self.assertEqual('18', resp.getheader('Content-Length'))
+        self.assertEqual(b'{"sessionId": "1"}', resp.read())
+
+    def test_closed_connection_retried(self):
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.stub.faults = ['drop']
+        # The pooled connection is closed by the API, the request is sent again on a new one
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertEqual(3, self.stub.calls)
+
+    def test_unreachable_upstream(self):
+        localhost_proxy.hostname = '127.0.0.1:{}'.format(free_port())
+        self.assertEqual(404, proxy_get(self.conn)[0])
+
+    def test_requests_not_imported(self):
+        proc = subprocess.run([sys.executable, '-c', 'import sys, localhost_proxy; print("requests" in sys.modules)'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        self.assertEqual('False', proc.stdout.strip())
+
+class TestAsyncioServer(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubUpstream(latency=0.2).start()
+        self.proxy = AsyncProxy(self.stub)
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.stub.stop()
+
+    def connect(self):
+        return http.client.HTTPConnection('127.0.0.1', self.proxy.port)
+
+    def test_asyncio_not_imported_in_threaded_mode(self):
+        proc = subprocess.run([sys.executable, '-c', 'import sys, localhost_proxy; print("asyncio" in sys.modules)'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        self.assertEqual('False', proc.stdout.strip())
+
+    def test_concurrent_misses_one_upstream_request(self):
+        def client_get():
+            conn = self.connect()
+            result = proxy_get(conn)
+            conn.close()
+            return result
+        results = TestInflightRequests.run_concurrently(self, 32, client_get)
+        self.assertEqual(1, self.stub.calls)
+        for status, body in results:
+            self.assertEqual(200, status)
+            self.assertEqual(results[0][1], body)
+
+    def test_keepalive_head_and_cache(self):
+        conn = self.connect()
+        status, body = proxy_get(conn)
+        self.assertEqual(200, status)
+        self.assertEqual("ASIASTUB", json.loads(body)["AccessKeyId"])
+        sock = conn.sock
+        conn.request('HEAD', '/prod/sessions/1/cluster/a/project/b?roleSessionName=n', headers={'Authorization': 'token'})
+        resp = conn.getresponse()
+        self.assertEqual(200, resp.status)
+        self.assertEqual(str(len(body)), resp.getheader('Content-Length'))
+        self.assertEqual(b'', resp.read())
+        self.assertEqual((200, body), proxy_get(conn))
+        self.assertIs(sock, conn.sock)
+        conn.close()
+        self.assertEqual(1, self.stub.calls)
+
+    def test_different_tokens_not_shared(self):
+        conn = self.connect()
+        proxy_get(conn, token='one')
+        proxy_get(conn, token='two')
+        conn.close()
+        self.assertEqual(2, self.stub.calls)
+
+    def test_post_forwarded(self):
+        conn = self.connect()
+        conn.request('POST', '/prod/sessions', body='{"sessionId": "1"}', headers={'Authorization': 'secret'})
+        resp = conn.getresponse()
+        self.assertEqual(200, resp.status)
+        self.assertEqual(b'{"sessionId": "1"}', resp.read())
+        conn.close()
+
+    def test_missing_authorization_returns_404(self):
+        conn = self.connect()
+        conn.request('GET', '/prod/sessions/1/cluster/a/project/b')
+        resp = conn.getresponse()
+        self.assertEqual(404, resp.status)
+        resp.read()
+        conn.close()
+        self.assertEqual(0, self.stub.calls)
+
+class TestCacheEntry(unittest.TestCase):
+
+    def test_response_is_head_then_body(self):
+        value = CacheEntry(200, b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n', b'{}', None)
+        self.assertEqual(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}', value.response())
+        self.assertEqual(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n', bytes(value.response(body=False)))
+        self.assertEqual(b'{}', value.body)
+
+    def test_slots_only(self):
+        value = entry(None, "creds")
+        with self.assertRaises(AttributeError):
+            value.content = "creds"
+
+    def test_cached_response_headers_filtered(self):
+        stub = StubUpstream().start()
+        httpd = start_proxy(stub)
+        try:
+            for i in range(2):
+                conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+                conn.request('GET', '/prod/sessions/1/cluster/a/project/b?roleSessionName=n', headers={'Authorization': 'token'})
+                resp = conn.getresponse()
+                body = resp.read()
+                self.assertEqual(200, resp.status)
+                self.assertEqual('application/json', resp.getheader('Content-Type'))
+                self.assertEqual(str(len(body)), resp.getheader('Content-Length'))
+                self.assertEqual(1, len(resp.headers.get_all('Content-Length')))
+                conn.close()
+        finally:
+            stop_proxy(httpd)
+            stub.stop()
+        self.assertEqual(1, stub.calls)
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache.snapshot')
+        localhost_proxy.cache = CacheContainer("store", 1000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        value = CacheEntry(200, b'HTTP/1.1 200 OK\r\n\r\n', b'{"AccessKeyId": "A"}', deadline_after(300))
+        localhost_proxy.cache.put("token\u00e9https://example.com/path", value)
+        self.assertEqual(1, write_snapshot(self.path))
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+        localhost_proxy.cache = CacheContainer("store", 1000)
+        self.assertEqual(1, load_snapshot(self.path))
+        loaded = localhost_proxy.cache.get("token\u00e9https://example.com/path")
+        self.assertEqual(value.payload, loaded.payload)
+        self.assertEqual(value.body_offset, loaded.body_offset)
+        self.assertEqual(value.status, loaded.status)
+        # Stored as wall clock time, so only as precise as the clocks are read
+        self.assertAlmostEqual(value.deadline, loaded.deadline, delta=1000000)
+
+    def test_tags_kept(self):
+        value = CacheEntry(200, b'', b'creds', deadline_after(300), token_hash("token"))
+        localhost_proxy.cache.put("token/path", value)
+        write_snapshot(self.path)
+        localhost_proxy.cache = CacheContainer("store", 1000)
+        load_snapshot(self.path)
+        self.assertEqual(1, localhost_proxy.cache.evict_tags({token_hash("token")}))
+        self.assertIsNone(localhost_proxy.cache.get("token/path"))
+
+    def test_expired_entries_skipped(self):
+        localhost_proxy.cache.put("short", entry(deadline_after(0.5), "short"))
+        localhost_proxy.cache.put("long", entry(deadline_after(300), "long"))
+        self.assertEqual(2, write_snapshot(self.path))
+        time.sleep(0.6)
+        localhost_proxy.cache = CacheContainer("store", 1000)
+        self.assertEqual(1, load_snapshot(self.path))
+        self.assertIsNone(localhost_proxy.cache.get("short"))
+        self.assertIsNotNone(localhost_proxy.cache.get("long"))
+
+    def test_restored_entries_scheduled_for_refresh(self):
+        token = "to/ken"
+        localhost_proxy.cache.put(token + "/sessions/1/path", CacheEntry(200, b'', b'creds', deadline_after(300), token_hash(token)))
+        localhost_proxy.cache.put("denied/path", CacheEntry(403, b'', b'denied', deadline_after(300), token_hash("denied")))
+        write_snapshot(self.path)
+        localhost_proxy.cache = CacheContainer("store", 1000)
+        localhost_proxy.refresher = RefreshAhead(0.5, 0)
+        self.addCleanup(setattr, localhost_proxy, 'refresher', None)
+        load_snapshot(self.path)
+        [(refresh_at, sequence, key, path, headers, value)] = localhost_proxy.refresher.schedule
+        self.assertEqual(token + "/sessions/1/path", key)
+        self.assertEqual("/sessions/1/path", path)
+        self.assertEqual({'Authorization': token}, headers)
+        # Refreshed halfway through the lifetime left at restore
+        self.assertAlmostEqual(refresh_at, deadline_after(150), delta=1000000000)
+
+    def test_revocation_poller_primed_from_restored_entries(self):
+        for token in ["older", "newer"]:
+            localhost_proxy.cache.put(token + "/prod/sessions/1/path", CacheEntry(200, b'', b'creds', deadline_after(300), token_hash(token)))
+        write_snapshot(self.path)
+        localhost_proxy.cache = CacheContainer("store", 1000)
+        localhost_proxy.revocations = RevocationPoller(10)
+        self.addCleanup(setattr, localhost_proxy, 'revocations', None)
+        load_snapshot(self.path)
+        self.assertEqual("newer", localhost_proxy.revocations.token)
+        self.assertEqual("/prod/sessions/revocations", localhost_proxy.revocations.path)
+
+    def test_temporary_file_not_predictable(self):
+        os.symlink(os.path.join(self.tmpdir.name, 'target'), self.path + '.tmp')
+        localhost_proxy.cache.put("key", entry(deadline_after(300), "creds"))
+        self.assertEqual(1, write_snapshot(self.path))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, 'target')))
+        self.assertEqual(sorted(['cache.snapshot', 'cache.snapshot.tmp']), sorted(os.listdir(self.tmpdir.name)))
+
+    def test_missing_file(self):
+        self.assertEqual(0, load_snapshot(self.path))
+
+    def test_file_readable_by_others_ignored(self):
+        localhost_proxy.cache.put("key", entry(deadline_after(300), "creds"))
+        write_snapshot(self.path)
+        os.chmod(self.path, 0o644)
+        localhost_proxy.cache = CacheContainer("store", 1000)
+        self.assertEqual(0, load_snapshot(self.path))
+
+    def test_truncated_file(self):
+        localhost_proxy.cache.put("one", entry(deadline_after(300), "one"))
+        localhost_proxy.cache.put("two", entry(deadline_after(300), "two"))
+        write_snapshot(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        localhost_proxy.cache = CacheContainer("store", 1000)
+        self.assertEqual(1, load_snapshot(self.path))
+
+    def test_restarted_proxy_serves_snapshot(self):
+        stub = StubUpstream().start()
+        args = ['--upstream_scheme', 'http', '--hostname', stub.hostname, '--snapshot_file', self.path, '--snapshot_interval', '3600']
+        try:
+            for i in range(2):
+                proxy, port = start_proxy_process(args)
+                try:
+                    conn = http.client.HTTPConnection('127.0.0.1', port)
+                    self.assertEqual(200, proxy_get(conn)[0])
+                    conn.close()
+                finally:
+                    stop_proxy_process(proxy)
+        finally:
+            stub.stop()
+        self.assertEqual(1, stub.calls)
+
+class TestHierarchicalProxies(unittest.TestCase):
+    # Node proxies forward to a shared proxy in front of the stub API, each in its own process
+
+    def start_topology(self, shared_args=(), node_args=(), nodes=2):
+        self.stub = StubUpstream(latency=0.2).start()
+        self.processes = []
+        shared, shared_port = start_proxy_process(['--upstream_scheme', 'http', '--hostname', self.stub.hostname] + list(shared_args))
+        self.processes.append(shared)
+        self.node_ports = []
+        for i in range(nodes):
+            node, port = start_proxy_process(['--hostname', '127.0.0.1:{}'.format(shared_port)] + list(node_args))
+            self.processes.append(node)
+            self.node_ports.append(port)
+
+    def tearDown(self):
+        for proxy in self.processes:
+            stop_proxy_process(proxy)
+        self.stub.stop()
+
+    def get_from_nodes(self, token, per_node=8):
+        def client_get(port):
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            result = proxy_get(conn, token=token)
+            conn.close()
+            return result
+        ports = self.node_ports * per_node
+        return TestInflightRequests.run_concurrently(self, len(ports), lambda: client_get(ports.pop()))
+
+    def test_nodes_share_upstream_request(self):
+        self.start_topology(node_args=['--upstream_scheme', 'http'])
+        results = self.get_from_nodes('token')
+        self.assertEqual(1, self.stub.calls)
+        for status, body in results:
+            self.assertEqual(200, status)
+            self.assertEqual(results[0][1], body)
+        # Served from each node's own cache now
+        self.get_from_nodes('token')
+        self.assertEqual(1, self.stub.calls)
+
+    def test_authorization_kept_in_key_at_every_level(self):
+        self.start_topology(node_args=['--upstream_scheme', 'http'])
+        self.get_from_nodes('one', per_node=1)
+        self.get_from_nodes('two', per_node=1)
+        self.assertEqual(2, self.stub.calls)
+
+    def create_certificate(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        certfile = os.path.join(tmpdir.name, 'proxy.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                        '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', certfile, '-out', certfile], check=True, capture_output=True)
+        return certfile
+
+    @unittest.skipUnless(shutil.which('openssl'), 'openssl is needed to create a test certificate')
+    def test_nodes_reach_shared_proxy_over_https(self):
+        certfile = self.create_certificate()
+        self.start_topology(shared_args=['--certfile', certfile], node_args=['--upstream_scheme', 'https', '--upstream_ca_file', certfile], nodes=1)
+        results = self.get_from_nodes('token', per_node=4)
+        self.assertEqual([200] * 4, [status for status, body in results])
+        self.assertEqual(1, self.stub.calls)
+
+    @unittest.skipUnless(shutil.which('openssl'), 'openssl is needed to create a test certificate')
+    def test_unknown_shared_proxy_certificate_rejected(self):
+        certfile = self.create_certificate()
+        self.start_topology(shared_args=['--certfile', certfile], node_args=['--upstream_scheme', 'https', '--upstream_client', 'stdlib'], nodes=1)
+        results = self.get_from_nodes('token', per_node=1)
+        self.assertNotEqual(200, results[0][0])
+        self.assertEqual(0, self.stub.calls)
+
+    @unittest.skipUnless(shutil.which('openssl'), 'openssl is needed to create a test certificate')
+    def test_unverified_shared_proxy_on_opt_in(self):
+        certfile = self.create_certificate()
+        self.start_topology(shared_args=['--certfile', certfile], node_args=['--upstream_scheme', 'https', '--upstream_tls_verify', 'off'], nodes=1)
+        self.assertEqual(200, self.get_from_nodes('token', per_node=1)[0][0])
+
+class TestRefreshAhead(unittest.TestCase):
+
+    def setUp(self):
+        # Credentials from the stub expire in 4 seconds and are refreshed after 2
+        self.stub = StubUpstream(lifetime=4).start()
+        self.refresher = RefreshAhead(0.5, 0)
+        self.refresher.start()
+        self.httpd = start_proxy(self.stub, refresher=self.refresher)
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+        self.refresher.stop()
+        stop_proxy(self.httpd)
+        localhost_proxy.refresher = None
+        self.stub.stop()
+
+    def test_used_entry_refreshed_before_expiration(self):
+        status, first = proxy_get(self.conn)
+        self.assertEqual(200, status)
+        self.assertEqual((200, first), proxy_get(self.conn))
+        time.sleep(2.5)
+        self.assertEqual(2, self.stub.calls)
+        # The refreshed credentials are served from the cache
+        status, second = proxy_get(self.conn)
+        self.assertEqual(2, self.stub.calls)
+        self.assertNotEqual(first, second)
+
+    def test_unused_entry_not_refreshed(self):
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        time.sleep(2.5)
+        self.assertEqual(1, self.stub.calls)
+
+    def test_cached_value_served_while_refreshing(self):
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.stub.latency = 1
+        time.sleep(2.2)
+        # The refresh is in flight upstream, callers still get the cached credentials without waiting
+        start = time.monotonic()
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_jitter_refreshes_earlier(self):
+        refresher = RefreshAhead(0.8, 0.2)
+        fetched = time.monotonic_ns()
+        value = entry(fetched + 100 * 1000000000, "creds")
+        for i in range(50):
+            refresher.schedule_refresh("key", "path", {}, value, fetched)
+        for refresh_at in [item[0] for item in refresher.schedule]:
+            self.assertGreaterEqual(refresh_at, fetched + 60 * 1000000000)
+            self.assertLessEqual(refresh_at, fetched + 80 * 1000000000)
+
+    def test_refreshes_run_concurrently(self):
+        refresher = RefreshAhead(0.5, 0, workers=2)
+        started = []
+        def refresh(key, path, headers, value):
+            started.append(time.monotonic())
+            time.sleep(1)
+        refresher.refresh = refresh
+        refresher.start()
+        self.addCleanup(refresher.stop)
+        fetched = time.monotonic_ns()
+        for key in ["first", "second"]:
+            refresher.schedule_refresh(key, "path", {}, entry(fetched + 100 * 1000000000, "creds"), fetched - 100 * 1000000000)
+        time.sleep(0.5)
+        # The second refresh did not wait for the first one to complete
+        self.assertEqual(2, len(started))
+
+    def test_expired_entry_not_refreshed(self):
+        refresher = RefreshAhead(0.5, 0, workers=1)
+        refreshed = []
+        refresher.refresh = lambda key, path, headers, value: refreshed.append(key)
+        # Both refreshes are due, only the first entry has expired since
+        now = time.monotonic_ns()
+        refresher.schedule_refresh("expired", "path", {}, entry(now - 1000000000, "creds"), now - 10 * 1000000000)
+        refresher.schedule_refresh("valid", "path", {}, entry(now + 100 * 1000000000, "creds"), now - 200 * 1000000000)
+        refresher.start()
+        self.addCleanup(refresher.stop)
+        time.sleep(0.2)
+        self.assertEqual(["valid"], refreshed)
+
+class TestUpstreamFailures(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubUpstream().start()
+        self.httpd = start_proxy(self.stub)
+        localhost_proxy.retry_policy = RetryPolicy(2, 0.01, 0.05)
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+        stop_proxy(self.httpd)
+        self.stub.stop()
+
+    def test_throttled_and_failed_requests_retried(self):
+        self.stub.faults = [429, 503]
+        status, body = proxy_get(self.conn)
+        self.assertEqual(200, status)
+        self.assertEqual("ASIASTUB", json.loads(body)["AccessKeyId"])
+        self.assertEqual(3, self.stub.calls)
+
+    def test_dropped_connection_retried(self):
+        self.stub.faults = ['drop']
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertEqual(2, self.stub.calls)
+
+    def test_last_failure_returned_when_retries_exhausted(self):
+        self.stub.faults = [503, 503, 502]
+        self.assertEqual(502, proxy_get(self.conn)[0])
+        self.assertEqual(3, self.stub.calls)
+        # Failures are not cached
+        self.assertEqual(200, proxy_get(self.conn)[0])
+
+    def test_forbidden_not_retried_and_negative_cached(self):
+        localhost_proxy.negative_cache_ttl = 0.5
+        self.stub.faults = [403]
+        self.assertEqual(403, proxy_get(self.conn)[0])
+        self.assertEqual(403, proxy_get(self.conn)[0])
+        self.assertEqual(1, self.stub.calls)
+        # Another token has its own cache key
+        self.assertEqual(200, proxy_get(self.conn, token='other')[0])
+        time.sleep(0.6)
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertEqual(3, self.stub.calls)
+
+    def test_open_circuit_fails_fast(self):
+        localhost_proxy.retry_policy = None
+        localhost_proxy.breakers = CircuitBreakers(2, 0.3)
+        self.stub.faults = [503, 503]
+        self.assertEqual(503, proxy_get(self.conn)[0])
+        self.assertEqual(503, proxy_get(self.conn)[0])
+        self.conn.close()
+        self.assertEqual(503, proxy_get(self.conn)[0])
+        self.assertEqual(2, self.stub.calls)
+        time.sleep(0.35)
+        # One trial request is let through, and closes the circuit when it succeeds
+        self.conn.close()
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertEqual(200, proxy_get(self.conn, token='other')[0])
+        self.assertEqual(4, self.stub.calls)
+
+    def test_session_errors_do_not_open_circuit(self):
+        localhost_proxy.retry_policy = None
+        localhost_proxy.breakers = CircuitBreakers(2, 0.3)
+        # API Gateway answers 500 and 502 for a single session's errors, other sessions still get credentials
+        self.stub.faults = [502, 500, 502]
+        for status in [502, 500, 502]:
+            self.conn.close()
+            self.assertEqual(status, proxy_get(self.conn)[0])
+        self.conn.close()
+        self.assertEqual(200, proxy_get(self.conn, token='other')[0])
+        self.assertEqual(4, self.stub.calls)
+
+    def test_asyncio_server_retries(self):
+        stop_proxy(self.httpd)
+        proxy = AsyncProxy(self.stub)
+        localhost_proxy.retry_policy = RetryPolicy(2, 0.01, 0.05)
+        try:
+            self.stub.faults = [503, 'drop']
+            conn = http.client.HTTPConnection('127.0.0.1', proxy.port)
+            self.assertEqual(200, proxy_get(conn)[0])
+            conn.close()
+            self.assertEqual(3, self.stub.calls)
+        finally:
+            proxy.stop()
+        self.httpd = start_proxy(self.stub)
+
+class TestRetryAndBreaker(unittest.TestCase):
+
+    def test_delays_bounded(self):
+        for i in range(50):
+            delays = list(RetryPolicy(5, 0.1, 1).delays())
+            self.assertEqual(5, len(delays))
+            for delay in delays:
+                self.assertGreaterEqual(delay, 0.1)
+                self.assertLessEqual(delay, 1)
+
+    def test_no_retries(self):
+        self.assertEqual([], list(RetryPolicy(0, 0.1, 1).delays()))
+
+    def test_failed_trial_reopens_breaker(self):
+        breaker = CircuitBreaker(1, 0.1)
+        breaker.before_request()
+        breaker.record(False)
+        self.assertRaises(CircuitOpen, breaker.before_request)
+        time.sleep(0.15)
+        breaker.before_request()
+        # Only one trial request at a time
+        self.assertRaises(CircuitOpen, breaker.before_request)
+        breaker.record(False)
+        self.assertRaises(CircuitOpen, breaker.before_request)
+
+    def test_unexpected_error_ends_trial(self):
+        class FailingUpstream():
+            def get(self, url, **kwargs):
+                raise ValueError('unparsable response')
+        stub = StubUpstream()
+        self.addCleanup(stub.httpd.server_close)
+        configure_proxy(stub)
+        localhost_proxy.upstream = FailingUpstream()
+        localhost_proxy.breakers = CircuitBreakers(1, 0.05)
+        breaker = localhost_proxy.breakers.get(stub.hostname)
+        breaker.before_request()
+        breaker.record(False)
+        time.sleep(0.1)
+        # The trial fails with an error that is not an OSError, the breaker opens again instead of
+        # staying in its trial
+        self.assertRaises(ValueError, fetch_upstream, '/path', {'Authorization': 'token'})
+        self.assertTrue(breaker.opened_at is not None and not breaker.trial)
+        time.sleep(0.1)
+        breaker.before_request()
+
+class TestUpstreamEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.slow = StubUpstream(latency=0.1).start()
+        self.fast = StubUpstream().start()
+        self.httpd = start_proxy(self.slow)
+        localhost_proxy.endpoints = UpstreamEndpoints([self.slow.hostname, self.fast.hostname], 60)
+        for host in localhost_proxy.endpoints.hostnames:
+            localhost_proxy.endpoints.probe(host)
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+        stop_proxy(self.httpd)
+        self.slow.stop()
+        self.fast.stop()
+
+    def test_lowest_latency_endpoint_used(self):
+        self.assertEqual(self.fast.hostname, localhost_proxy.endpoints.select())
+        self.assertEqual(200, proxy_get(self.conn, token='one')[0])
+        self.assertEqual(200, proxy_get(self.conn, token='two')[0])
+        path = '/prod/sessions/1/cluster/a/project/b?roleSessionName=n'
+        self.assertEqual(['/', path, path], self.fast.paths)
+        self.assertEqual(['/'], self.slow.paths)
+        # Each endpoint gets its own Host header
+        self.assertEqual([self.fast.hostname] * 3, self.fast.hosts)
+        self.assertEqual([self.slow.hostname], self.slow.hosts)
+
+    def test_failover_on_error(self):
+        localhost_proxy.retry_policy = RetryPolicy(1, 0.01, 0.01)
+        self.fast.faults = [503]
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertEqual(2, self.fast.calls)
+        self.assertEqual(2, self.slow.calls)
+        self.assertEqual(self.slow.hostname, self.slow.hosts[-1])
+        # The endpoint stays out of rotation until it answers a probe
+        self.assertEqual(self.slow.hostname, localhost_proxy.endpoints.select())
+        localhost_proxy.endpoints.probe(self.fast.hostname)
+        self.assertEqual(self.fast.hostname, localhost_proxy.endpoints.select())
+
+    def test_cache_shared_between_endpoints(self):
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        localhost_proxy.endpoints.observe(self.fast.hostname, 0, False)
+        self.assertEqual(200, proxy_get(self.conn)[0])
+        self.assertEqual(1, self.slow.calls + self.fast.calls - 2)
+
+    def test_connections_kept_for_each_endpoint(self):
+        localhost_proxy.upstream = UpstreamSession(4, 60, 2)
+        for i in range(6):
+            # Alternate between the endpoints
+            localhost_proxy.endpoints.observe(self.fast.hostname, 0, i % 2 == 0)
+            localhost_proxy.endpoints.observe(self.slow.hostname, 0, i % 2 == 1)
+            self.assertEqual(200, proxy_get(self.conn, token=str(i))[0])
+        self.assertEqual(3, len(self.fast.paths) - 1)
+        self.assertEqual(3, len(self.slow.paths) - 1)
+        # One connection to each endpoint besides the probe's
+        self.assertEqual(2, len(self.fast.connections))
+        self.assertEqual(2, len(self.slow.connections))
+
+    def test_all_unhealthy_still_tried(self):
+        for host in localhost_proxy.endpoints.hostnames:
+            localhost_proxy.endpoints.observe(host, 0, False)
+        self.assertEqual(200, proxy_get(self.conn)[0])
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubUpstream(latency=0.2).start()
+        self.httpd = start_proxy(self.stub)
+        self.uri = 'http://127.0.0.1:{}/prod/sessions/1/cluster/a/project/b'.format(self.httpd.server_address[1])
+
+    def tearDown(self):
+        stop_proxy(self.httpd)
+        self.stub.stop()
+
+    def test_prefetch_fills_cache(self):
+        names = ['node{}'.format(i) for i in range(16)]
+        start = time.monotonic()
+        self.assertEqual(0, prefetch(['--uri', self.uri + '?roleSessionName=ignored', '--token', 'token',
+                                      '--role_session_names', ','.join(names), '--concurrency', '8']))
+        # Two rounds of eight concurrent requests
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(16, self.stub.calls)
+        self.assertEqual(16, len(localhost_proxy.cache.items()))
+        conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+        for name in names:
+            self.assertEqual(200, proxy_get(conn, path='/prod/sessions/1/cluster/a/project/b?roleSessionName=' + name)[0])
+        conn.close()
+        self.assertEqual(16, self.stub.calls)
+
+    def test_prefetch_keeps_session_name_characters(self):
+        names = ['node-user@corp', 'a+b=c.d']
+        self.assertEqual(0, prefetch(['--uri', self.uri, '--token', 'token', '--role_session_names', ','.join(names)]))
+        conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+        for name in names:
+            self.assertEqual(200, proxy_get(conn, path='/prod/sessions/1/cluster/a/project/b?roleSessionName=' + name)[0])
+        conn.close()
+        self.assertEqual(2, self.stub.calls)
+
+    def test_prefetch_reports_failures(self):
+        self.stub.faults = [403]
+        self.assertEqual(1, prefetch(['--uri', self.uri, '--token', 'token', '--role_session_names', 'a', '--concurrency', '1']))
+
+    def test_prefetch_needs_token(self):
+        env = dict(os.environ)
+        env.pop('AWS_CONTAINER_AUTHORIZATION_TOKEN', None)
+        proc = subprocess.run([sys.executable, 'localhost_proxy.py', 'prefetch', '--uri', self.uri, '--role_session_names', 'a'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True)
+        self.assertEqual(2, proc.returncode)
+
+class TestExpirationTimezones(unittest.TestCase):
+    # Offsets behind, ahead of and far from UTC, including a half hour one
+    TIMEZONES = ['UTC', 'America/Los_Angeles', 'Asia/Kolkata', 'Pacific/Kiritimati', 'America/St_Johns']
+
+    def setUp(self):
+        self.saved_tz = os.environ.get('TZ')
+
+    def tearDown(self):
+        if self.saved_tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = self.saved_tz
+        time.tzset()
+        localhost_proxy.expiry_margin = 0
+
+    def set_timezone(self, tz):
+        os.environ['TZ'] = tz
+        time.tzset()
+
+    def assert_seconds_left(self, seconds, deadline):
+        self.assertAlmostEqual(seconds, (deadline - time.monotonic_ns()) / 1000000000, delta=0.5)
+
+    def test_expiration_offsets(self):
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        for tz in self.TIMEZONES:
+            self.set_timezone(tz)
+            with self.subTest(tz=tz):
+                # get_credentials sends str() of the STS expiration, which is in UTC
+                self.assert_seconds_left(3600, expiration_deadline(str(expires)))
+                self.assert_seconds_left(3600, expiration_deadline(expires.isoformat()))
+                self.assert_seconds_left(3600, expiration_deadline(expires.astimezone(timezone(timedelta(hours=-7))).isoformat()))
+                self.assert_seconds_left(3600, expiration_deadline(str(expires.replace(tzinfo=None))))
+
+    def test_safety_margin(self):
+        localhost_proxy.expiry_margin = 300
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        self.assert_seconds_left(3300, expiration_deadline(str(expires)))
+
+    def test_proxy_caches_until_expiration(self):
+        stub = StubUpstream(lifetime=2).start()
+        httpd = start_proxy(stub)
+        conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+        try:
+            for tz in self.TIMEZONES:
+                self.set_timezone(tz)
+                with self.subTest(tz=tz):
+                    calls = stub.calls
+                    self.assertEqual(200, proxy_get(conn, token=tz)[0])
+                    self.assertEqual(200, proxy_get(conn, token=tz)[0])
+                    self.assertEqual(calls + 1, stub.calls)
+            time.sleep(2.1)
+            # Expired in every timezone, whatever the offset
+            for tz in self.TIMEZONES:
+                self.assertEqual(200, proxy_get(conn, token=tz)[0])
+            self.assertEqual(2 * len(self.TIMEZONES), stub.calls)
+        finally:
+            conn.close()
+            stop_proxy(httpd)
+            stub.stop()
+
+    def test_snapshot_keeps_deadline_across_timezones(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, 'snapshot')
+        try:
+            localhost_proxy.cache = CacheContainer("store", 1000)
+            localhost_proxy.cache.put("key", entry(deadline_after(600), "creds"))
+            self.set_timezone('Asia/Kolkata')
+            write_snapshot(path)
+            self.set_timezone('America/Los_Angeles')
+            localhost_proxy.cache = CacheContainer("store", 1000)
+            self.assertEqual(1, load_snapshot(path))
+            self.assert_seconds_left(600, localhost_proxy.cache.get("key").deadline)
+        finally:
+            tmpdir.cleanup()
+
+class TestRevocations(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubUpstream().start()
+        self.httpd = start_proxy(self.stub)
+        localhost_proxy.revocations = RevocationPoller(3600)
+
+    def tearDown(self):
+        stop_proxy(self.httpd)
+        self.stub.stop()
+
+    def get(self, token):
+        conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+        result = proxy_get(conn, token=token)
+        conn.close()
+        return result
+
+    def test_evict_tags(self):
+        cache = CacheContainer("store", 1000)
+        cache.put("a1", CacheEntry(200, b'', b'a', deadline_after(300), "a"))
+        cache.put("a2", CacheEntry(200, b'', b'a', deadline_after(300), "a"))
+        cache.put("b1", CacheEntry(200, b'', b'b', deadline_after(300), "b"))
+        # Replaced under another tag, not evicted with the old one
+        cache.put("a2", CacheEntry(200, b'', b'b', deadline_after(300), "b"))
+        self.assertEqual(1, cache.evict_tags({"a", "c"}))
+        self.assertIsNone(cache.get("a1"))
+        self.assertIsNotNone(cache.get("a2"))
+        self.assertIsNotNone(cache.get("b1"))
+
+    def test_nothing_to_poll_before_caching(self):
+        self.assertEqual(0, localhost_proxy.revocations.poll())
+        self.assertEqual(0, self.stub.calls)
+
+    def test_revoked_session_evicted(self):
+        self.get('revoked')
+        self.get('active')
+        self.stub.revoked.append('revoked')
+        self.assertEqual(1, localhost_proxy.revocations.poll())
+        self.assertEqual('/prod/sessions/revocations', self.stub.paths[-1])
+        # The next poll continues from the returned cursor
+        localhost_proxy.revocations.poll()
+        self.assertTrue(self.stub.paths[-1].startswith('/prod/sessions/revocations?since='))
+        calls = self.stub.calls
+        self.get('revoked')
+        self.get('active')
+        self.assertEqual(calls + 1, self.stub.calls)
+
+    def test_all_pages_read(self):
+        self.stub.revocation_page_size = 2
+        for token in ['a', 'b', 'c', 'd', 'e']:
+            self.get(token)
+        self.stub.revoked.extend(['x', 'a', 'c', 'y', 'e'])
+        self.assertEqual(3, localhost_proxy.revocations.poll())
+        self.assertEqual(['/prod/sessions/revocations', '/prod/sessions/revocations?next=2', '/prod/sessions/revocations?next=4'], self.stub.paths[-3:])
+        self.assertIsNotNone(localhost_proxy.revocations.cursor)
+
+    def test_feed_not_cached(self):
+        self.get('token')
+        calls = self.stub.calls
+        for i in range(2):
+            self.assertEqual(200, self.get_path('/prod/sessions/revocations')[0])
+        self.assertEqual(calls + 2, self.stub.calls)
+
+    def get_path(self, path):
+        conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1])
+        result = proxy_get(conn, path=path)
+        conn.close()
+        return result
+
+class TestTrafficCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'capture.jsonl')
+        self.stub = StubUpstream(latency=0.2).start()
+
+    def tearDown(self):
+        localhost_proxy.capture = None
+        self.stub.stop()
+        self.tmpdir.cleanup()
+
+    def records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def capture_requests(self, port):
+        localhost_proxy.capture = TrafficCapture(self.path)
+        def client_get():
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            result = proxy_get(conn, token='secret-token')
+            conn.close()
+            return result
+        TestInflightRequests.run_concurrently(self, 3, client_get)
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        proxy_get(conn, token='secret-token')
+        proxy_get(conn, path='/prod/sessions/2/cluster/a/project/b?roleSessionName=n', token='secret-token')
+        conn.close()
+        # Records are written after the response is sent
+        deadline = time.monotonic() + 5
+        while len(self.records()) < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        records = self.records()
+        self.assertEqual(5, len(records))
+        self.assertEqual(['hit', 'miss', 'miss', 'shared', 'shared'], sorted(record["outcome"] for record in records))
+        self.assertEqual({200}, {record["status"] for record in records})
+        self.assertEqual(1, len({record["session"] for record in records}))
+        for record in records:
+            self.assertEqual(record["outcome"] == 'miss', record["upstream_ms"] is not None)
+        # Ids and query values are hashed, the shape is kept
+        shape = records[-1]["path"].split('/')
+        self.assertEqual(['', 'prod', 'sessions', 'cluster', 'project'], shape[:3] + shape[4:5] + shape[6:7])
+        self.assertTrue(shape[-1].split('?')[1].startswith('roleSessionName='))
+        with open(self.path) as f:
+            content = f.read()
+        self.assertNotIn('secret-token', content)
+        self.assertNotIn('/sessions/1/', content)
+
+    def test_threaded_capture(self):
+        httpd = start_proxy(self.stub)
+        try:
+            self.capture_requests(httpd.server_address[1])
+        finally:
+            stop_proxy(httpd)
+
+    def test_asyncio_capture(self):
+        proxy = AsyncProxy(self.stub)
+        try:
+            self.capture_requests(proxy.port)
+        finally:
+            proxy.stop()
+
+    def test_replay(self):
+        httpd = start_proxy(self.stub)
+        try:
+            self.capture_requests(httpd.server_address[1])
+        finally:
+            stop_proxy(httpd)
+        result = replay.replay(replay.read_capture(self.path), speed=0)
+        self.assertEqual(5, result["requests"])
+        self.assertEqual(0, result["errors"])
+        # The same two credentials are requested as in the capture
+        self.assertEqual(2, result["upstream_calls"])
+        self.assertEqual(2, result["captured_outcomes"]["miss"])
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubUpstream(latency=0.1).start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def worker_pids(self, proxy):
+        proc = subprocess.run(['pgrep', '-P', str(proxy.pid)], capture_output=True, text=True)
+        return [int(pid) for pid in proc.stdout.split()]
+
+    def check_workers(self, server_mode):
+        proxy, port = start_proxy_process(['--upstream_scheme', 'http', '--hostname', self.stub.hostname, '--workers', '3', '--server_mode', server_mode])
+        try:
+            pids = self.worker_pids(proxy)
+            self.assertEqual(3, len(pids))
+            def client_get(i):
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                result = proxy_get(conn, token='token{}'.format(i % 4))
+                conn.close()
+                return result
+            counter = itertools.count()
+            results = TestInflightRequests.run_concurrently(self, 40, lambda: client_get(next(counter)))
+            self.assertEqual({200}, {status for status, body in results})
+            # Workers share the parent's cache, each token is fetched from the API once
+            self.assertEqual(4, self.stub.calls)
+        finally:
+            stop_proxy_process(proxy)
+        for pid in pids:
+            self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+
+    def test_worker_reads_refresh_shared_cache_ahead(self):
+        self.stub.stop()
+        # Credentials from the stub expire in 4 seconds and are refreshed after 2
+        self.stub = StubUpstream(lifetime=4).start()
+        proxy, port = start_proxy_process(['--upstream_scheme', 'http', '--hostname', self.stub.hostname, '--workers', '2',
+                                           '--refresh_ahead_fraction', '0.5', '--refresh_ahead_jitter', '0', '--expiry_margin', '0'])
+        try:
+            # Both reads reach the same worker on one connection, the second one is served from its cache
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            self.assertEqual(200, proxy_get(conn)[0])
+            self.assertEqual(200, proxy_get(conn)[0])
+            conn.close()
+            self.assertEqual(1, self.stub.calls)
+            time.sleep(2.5)
+            self.assertEqual(2, self.stub.calls)
+        finally:
+            stop_proxy_process(proxy)
+
+    def test_threaded_workers_share_cache(self):
+        self.check_workers('threaded')
+
+    def test_asyncio_workers_share_cache(self):
+        self.check_workers('asyncio')
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+import sys
+
+# The Lambda handlers are deployed from src and authorizer as top-level modules, and read their table
+# names from the environment when they are imported
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(root, 'src'))
+sys.path.insert(0, os.path.join(root, 'authorizer'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('SESSIONS_TABLE_NAME', 'SessionsTable')
+os.environ.setdefault('IAM_ROLE_MAPPING_TABLE_NAME', 'IamRoleMappingTable')
+
+class FakeSessionsTable():
+    # SessionsTable items in a list, with the reads and writes of the handlers. Reads of the table itself,
+    # not of an index, that are not strongly consistent are counted in inconsistent_reads.
+    def __init__(self, items=None):
+        self.items = items if items is not None else []
+        self.queries = 0
+        self.token_queries = 0
+        self.inconsistent_reads = 0
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, IndexName=None, ConsistentRead=False, ScanIndexForward=True, Limit=None, **kwargs):
+        if IndexName == 'SessionTokenGSI':
+            self.token_queries += 1
+            return {'Items': [item for item in self.items if item['SessionToken'] == ExpressionAttributeValues[':token']]}
+        self.queries += 1
+        self.inconsistent_reads += not ConsistentRead
+        key = ExpressionAttributeValues[':clusterNameSessionId']
+        items = sorted((item for item in self.items if item['ClusterNameSessionId'] == key), key=lambda item: item['SubmittedTime'], reverse=not ScanIndexForward)
+        return {'Items': items[:Limit]}
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.inconsistent_reads += not ConsistentRead
+        for item in self.items:
+            if item['ClusterNameSessionId'] == Key['ClusterNameSessionId'] and item['SubmittedTime'] == Key['SubmittedTime']:
+                return {'Item': item}
+        return {}
+
+    def put_item(self, Item, ConditionExpression=None):
+        # Replaces the item with the same key, with a copy as the handlers may change theirs after writing it
+        self.items = [item for item in self.items if (item['ClusterNameSessionId'], item['SubmittedTime']) != (Item['ClusterNameSessionId'], Item['SubmittedTime'])]
+        self.items.append(dict(Item))
+
+class FakeLookupTable():
+    # SessionTokenLookupTable items by TokenHash
+    def __init__(self, items):
+        self.items = {item['TokenHash']: item for item in items}
+
+    def get_item(self, Key, ConsistentRead):
+        assert ConsistentRead
+        item = self.items.get(Key['TokenHash'])
+        return {'Item': item} if item is not None else {}
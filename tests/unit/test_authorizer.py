@@ -0,0 +1,119 @@
+import hashlib
+from decimal import Decimal
+
+import pytest
+
+import authorizer
+from .conftest import FakeLookupTable, FakeSessionsTable
+
+METHOD_ARN = 'arn:aws:execute-api:us-east-1:123456789012:apiid/prod/GET/sessions/1/cluster/cluster/project/project'
+
+def lookup_item(token):
+    return {'TokenHash': hashlib.sha256(token.encode('UTF-8')).hexdigest(), 'ClusterNameSessionId': 'cluster-1', 'SubmittedTime': Decimal(1700000000)}
+
+def session_item(status='ACTIVE'):
+    return {
+        'ClusterNameSessionId': 'cluster-1',
+        'SessionId': '1',
+        'ProjectId': 'project',
+        'ClusterName': 'cluster',
+        'SessionToken': 'token',
+        'Status': status,
+        'SubmittedTime': Decimal(1700000000),
+    }
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeSessionsTable([session_item()])
+    monkeypatch.setattr(authorizer, 'sessions_table', table)
+    monkeypatch.setattr(authorizer.handler, 'head_node_secret', 'secret')
+    monkeypatch.setattr(authorizer, 'token_cache', authorizer.TokenCache(2, 30, 5))
+    yield table
+    assert table.inconsistent_reads == 0
+
+def authorize(token):
+    return authorizer.handler({'authorizationToken': token, 'methodArn': METHOD_ARN}, None)
+
+def effects(response):
+    return {statement['Effect'] for statement in response['policyDocument']['Statement']}
+
+def test_session_cached(table):
+    first = authorize('token')
+    table.items = [session_item(status='INVALIDATED')]
+    second = authorize('token')
+    assert table.token_queries == 1
+    assert first == second
+    # The context still says when the session was read, so get_credentials reads it again once that is too old
+    assert second['context']['Status'] == 'ACTIVE'
+    assert second['context']['SessionReadAt'] == first['context']['SessionReadAt']
+
+@pytest.mark.parametrize('enabled', [False, True])
+def test_latest_session_checked_only_for_context(table, monkeypatch, enabled):
+    monkeypatch.setattr(authorizer, 'session_context_enabled', enabled)
+    context = authorize('token')['context']
+    assert table.queries == (1 if enabled else 0)
+    assert ('IsLatest' in context) == enabled
+
+def test_unknown_token_cached_briefly(table, monkeypatch):
+    for i in range(3):
+        assert effects(authorize('bad')) == {'Deny'}
+    assert table.token_queries == 1
+    now = authorizer.time.monotonic()
+    monkeypatch.setattr(authorizer.time, 'monotonic', lambda: now + 6)
+    authorize('bad')
+    assert table.token_queries == 2
+
+def test_cache_bounded(table):
+    for token in ['token', 'a', 'b']:
+        authorize(token)
+    assert list(authorizer.token_cache.entries) == ['a', 'b']
+    authorize('token')
+    assert table.token_queries == 4
+
+def built_policy(principal_id, *methods):
+    policy = authorizer.AuthPolicy(principal_id, '123456789012')
+    policy.restApiId = 'apiid'
+    policy.region = 'us-east-1'
+    policy.stage = 'prod'
+    for verb, resource in methods:
+        policy.allow_method(verb, resource)
+    return policy.build()
+
+def test_policies_match_auth_policy(table):
+    response = authorize('token')
+    del response['context']
+    assert response == built_policy('token', ('GET', 'sessions/1/*'), ('GET', 'sessions/revocations'))
+    head_node_methods = [('POST', 'sessions'), ('POST', 'sessions/'), ('PUT', 'sessions/*'), ('DELETE', 'sessions/*'), ('GET', 'sessions/revocations')]
+    assert authorize('secret') == built_policy('secret', *head_node_methods)
+    denied = authorizer.AuthPolicy('bad', '123456789012')
+    denied.restApiId = 'apiid'
+    denied.region = 'us-east-1'
+    denied.stage = 'prod'
+    denied.deny_all_methods()
+    assert authorize('bad') == denied.build()
+
+def test_invalid_session_id_rejected(table):
+    table.items[0]['SessionId'] = '1 2'
+    with pytest.raises(NameError):
+        authorize('token')
+
+def test_token_lookup_without_gsi(table, monkeypatch):
+    monkeypatch.setattr(authorizer, 'token_lookup_table', FakeLookupTable([lookup_item('token')]))
+    response = authorize('token')
+    assert effects(response) == {'Allow'}
+    assert response['context']['SessionId'] == '1'
+    assert table.token_queries == 0
+
+def test_token_lookup_falls_back_to_gsi(table, monkeypatch):
+    # Sessions created before the lookup table existed have no lookup item until the backfill ran
+    monkeypatch.setattr(authorizer, 'token_lookup_table', FakeLookupTable([]))
+    assert effects(authorize('token')) == {'Allow'}
+    assert table.token_queries == 1
+    monkeypatch.setattr(authorizer, 'token_lookup_gsi_fallback', False)
+    assert effects(authorize('a')) == {'Deny'}
+    assert table.token_queries == 1
+
+def test_token_lookup_checks_token(table, monkeypatch):
+    other = lookup_item('other')
+    monkeypatch.setattr(authorizer, 'token_lookup_table', FakeLookupTable([other]))
+    assert effects(authorize('other')) == {'Deny'}
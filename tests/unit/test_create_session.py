@@ -0,0 +1,47 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import create_session
+import role_mappings
+import token_lookup
+from .conftest import FakeSessionsTable
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/project'
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeSessionsTable()
+    monkeypatch.setattr(create_session, 'table', table)
+    monkeypatch.setattr(token_lookup, 'table_name', None)
+    return table
+
+def create(project='project'):
+    return create_session.handler({
+        'body': json.dumps({'sessionId': '1', 'projectId': project, 'clusterName': 'cluster', 'clusterUser': 'user', 'submittedTime': '2024-01-01T00:00:00'}),
+        'requestContext': {'domainName': 'api.example.com', 'path': '/prod/sessions'},
+    }, None)
+
+def test_role_and_version_stored(table, monkeypatch):
+    monkeypatch.setattr(role_mappings, 'get_role_arn', lambda project_id: ROLE_ARN)
+    monkeypatch.setattr(role_mappings, 'current_version', lambda: Decimal(4))
+    assert create()['statusCode'] == 200
+    [item] = table.items
+    assert item['RoleArn'] == ROLE_ARN
+    assert item['RoleMappingVersion'] == Decimal(4)
+
+def test_no_version_without_version_item(table, monkeypatch):
+    monkeypatch.setattr(role_mappings, 'get_role_arn', lambda project_id: ROLE_ARN)
+    monkeypatch.setattr(role_mappings, 'current_version', lambda: None)
+    assert create()['statusCode'] == 200
+    [item] = table.items
+    assert item['RoleArn'] == ROLE_ARN
+    assert 'RoleMappingVersion' not in item
+
+def test_nothing_stored_without_mapping(table, monkeypatch):
+    monkeypatch.setattr(role_mappings, 'get_role_arn', lambda project_id: None)
+    monkeypatch.setattr(role_mappings, 'current_version', lambda: pytest.fail('version read'))
+    assert create()['statusCode'] == 200
+    [item] = table.items
+    assert 'RoleArn' not in item and 'RoleMappingVersion' not in item
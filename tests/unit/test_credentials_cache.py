@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta, timezone
+
+import credentials_cache
+
+SESSION = {
+    "ClusterNameSessionId": "cluster-1",
+    "SubmittedTime": 1700000000,
+    "SessionToken": "token",
+}
+
+def credentials(lifetime):
+    expiration = datetime.now(timezone.utc) + timedelta(seconds=lifetime)
+    return {"AccessKeyId": "ASIA", "Expiration": str(expiration.replace(microsecond=0))}
+
+def setup_function():
+    credentials_cache.entries.clear()
+
+def test_reused_until_margin():
+    key = credentials_cache.cache_key(SESSION, "arn:aws:iam::123456789012:role/a", "name")
+    fresh = credentials(3600)
+    credentials_cache.put(key, fresh)
+    assert credentials_cache.get(key) == fresh
+    credentials_cache.put(key, credentials(credentials_cache.margin_seconds - 10))
+    assert credentials_cache.get(key) is None
+    assert key not in credentials_cache.entries
+
+def test_key_covers_session_role_and_name():
+    key = credentials_cache.cache_key(SESSION, "arn:aws:iam::123456789012:role/a", "name")
+    assert key != credentials_cache.cache_key(SESSION, "arn:aws:iam::123456789012:role/b", "name")
+    assert key != credentials_cache.cache_key(SESSION, "arn:aws:iam::123456789012:role/a", "other")
+    assert key != credentials_cache.cache_key(dict(SESSION, SessionToken="new"), "arn:aws:iam::123456789012:role/a", "name")
+    assert "token" not in key
+
+def test_least_recently_used_evicted():
+    max_entries = credentials_cache.max_entries
+    credentials_cache.max_entries = 2
+    try:
+        for key in ["a", "b"]:
+            credentials_cache.put(key, credentials(3600))
+        credentials_cache.get("a")
+        credentials_cache.put("c", credentials(3600))
+        assert list(credentials_cache.entries) == ["a", "c"]
+    finally:
+        credentials_cache.max_entries = max_entries
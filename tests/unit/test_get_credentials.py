@@ -0,0 +1,173 @@
+import time
+from decimal import Decimal
+
+import pytest
+
+import authorizer
+import credentials_cache
+import get_credentials
+import update_session
+from .conftest import FakeSessionsTable
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/project'
+
+def session_item(token='token', status='ACTIVE', submitted_time=1700000000):
+    return {
+        'ClusterNameSessionId': 'cluster-1',
+        'SessionId': '1',
+        'ProjectId': 'project',
+        'ClusterName': 'cluster',
+        'ClusterUser': 'user',
+        'SessionToken': token,
+        'Status': status,
+        'SubmittedTime': Decimal(submitted_time),
+        'LastUpdatedTime': Decimal(submitted_time),
+    }
+
+def authorizer_context(item, is_latest, read_at=None):
+    context = authorizer.session_context(item, is_latest)
+    if read_at is not None:
+        context['SessionReadAt'] = read_at
+    # API Gateway passes context values to the integration as strings
+    return {name: str(value).lower() if isinstance(value, bool) else str(value) for name, value in context.items()}
+
+def event(context=None, token='token', project='project'):
+    request_context = {'authorizer': dict(context, principalId=token)} if context is not None else {}
+    return {
+        'pathParameters': {'sessionId': '1', 'clusterId': 'cluster', 'projectId': project},
+        'queryStringParameters': {'roleSessionName': 'name'},
+        'headers': {'Authorization': token},
+        'requestContext': request_context,
+    }
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeSessionsTable([])
+    monkeypatch.setattr(get_credentials, 'sessions_table', table)
+    monkeypatch.setattr(get_credentials, 'authorizer_context_max_age_seconds', 30)
+    monkeypatch.setattr(get_credentials.role_mappings, 'current_version', lambda: None)
+    monkeypatch.setattr(get_credentials.role_mappings, 'get_role_arn', lambda project_id: ROLE_ARN)
+    table.assumed = 0
+    def assume_iam_role(args):
+        table.assumed += 1
+        return {"AccessKeyId": "ASIA", "Expiration": "2099-01-01 00:00:00+00:00", "RoleArn": args["RoleArn"]}
+    monkeypatch.setattr(get_credentials, 'assume_iam_role', assume_iam_role)
+    credentials_cache.entries.clear()
+    yield table
+    assert table.inconsistent_reads == 0
+
+def check_same_result(table, items, expected_status, project='project'):
+    # The session read by the authorizer gives the same result as reading it again. Only cached credentials
+    # are returned without reading it again.
+    table.items = items
+    token_item = next(item for item in items if item["SessionToken"] == 'token')
+    latest = max(items, key=lambda item: item["SubmittedTime"])
+    without_context = get_credentials.handler(event(project=project), None)
+    assert table.queries == 1
+    with_context = get_credentials.handler(event(authorizer_context(token_item, latest is token_item), project=project), None)
+    assert table.queries == (1 if expected_status == 200 else 2)
+    assert without_context == with_context
+    assert with_context['statusCode'] == expected_status
+
+def test_active_session(table):
+    check_same_result(table, [session_item()], 200)
+
+@pytest.mark.parametrize('status', ['INVALIDATED', 'COMPLETED'])
+def test_inactive_session(table, status):
+    check_same_result(table, [session_item(status=status)], 403)
+
+def test_other_project(table):
+    check_same_result(table, [session_item()], 400, project='other')
+
+def test_session_replaced_by_newer_one(table):
+    check_same_result(table, [session_item(), session_item(token='newer', submitted_time=1700000100)], 403)
+
+def test_session_role_used(table, monkeypatch):
+    monkeypatch.setattr(get_credentials.role_mappings, 'current_version', lambda: Decimal(2))
+    monkeypatch.setattr(get_credentials.role_mappings, 'get_role_arn', lambda project_id: pytest.fail('mapping looked up'))
+    item = dict(session_item(), RoleArn='arn:aws:iam::123456789012:role/stored', RoleMappingVersion=Decimal(2))
+    table.items = [item]
+    response = get_credentials.handler(event(authorizer_context(item, True)), None)
+    assert 'role/stored' in response['body']
+
+@pytest.mark.parametrize('current_version', [None, Decimal(3)])
+def test_session_role_not_used_without_matching_version(table, monkeypatch, current_version):
+    # Without a version item a removed mapping cannot be told apart from an unchanged one
+    monkeypatch.setattr(get_credentials.role_mappings, 'current_version', lambda: current_version)
+    monkeypatch.setattr(get_credentials.role_mappings, 'get_role_arn', lambda project_id: None)
+    item = dict(session_item(), RoleArn='arn:aws:iam::123456789012:role/stored')
+    if current_version is not None:
+        item['RoleMappingVersion'] = Decimal(2)
+    table.items = [item]
+    response = get_credentials.handler(event(), None)
+    assert response['statusCode'] == 404
+
+def test_cache_read_once_on_miss(table, monkeypatch):
+    # Each read may be a GetItem on the shared tier
+    reads = []
+    get = credentials_cache.get
+    monkeypatch.setattr(credentials_cache, 'get', lambda key: reads.append(key) or get(key))
+    table.items = [session_item()]
+    response = get_credentials.handler(event(authorizer_context(session_item(), True)), None)
+    assert response['statusCode'] == 200
+    assert table.assumed == 1
+    assert len(reads) == 1
+
+def test_context_not_trusted_for_new_credentials(table):
+    # Invalidated after the authorizer read the session, new credentials would not be covered by the revocation policy
+    table.items = [session_item(status='INVALIDATED')]
+    response = get_credentials.handler(event(authorizer_context(session_item(), True)), None)
+    assert table.queries == 1
+    assert table.assumed == 0
+    assert response['statusCode'] == 403
+
+def test_context_serves_cached_credentials(table):
+    table.items = [session_item()]
+    get_credentials.handler(event(), None)
+    response = get_credentials.handler(event(authorizer_context(session_item(), True)), None)
+    assert response['statusCode'] == 200
+    assert table.queries == 1
+    assert table.assumed == 1
+
+def test_old_context_not_trusted(table):
+    table.items = [session_item(status='INVALIDATED')]
+    old = int((time.time() - get_credentials.authorizer_context_max_age_seconds - 1) * 1000)
+    response = get_credentials.handler(event(authorizer_context(session_item(), True, read_at=old)), None)
+    assert table.queries == 1
+    assert response['statusCode'] == 403
+
+def test_context_ignored_by_default(table, monkeypatch):
+    monkeypatch.setattr(get_credentials, 'authorizer_context_max_age_seconds', 0)
+    table.items = [session_item()]
+    get_credentials.handler(event(), None)
+    response = get_credentials.handler(event(authorizer_context(session_item(), True)), None)
+    assert response['statusCode'] == 200
+    assert table.queries == 2
+
+@pytest.mark.parametrize('max_age, expected_status', [(0, 403), (30, 200)])
+def test_invalidated_session_within_cache_ttl(table, monkeypatch, max_age, expected_status):
+    # The authorizer read the session, and API Gateway cached its context, before the session was invalidated
+    monkeypatch.setattr(get_credentials, 'authorizer_context_max_age_seconds', max_age)
+    monkeypatch.setattr(update_session, 'table', table)
+    table.items = [session_item()]
+    context = authorizer_context(session_item(), True)
+    assert get_credentials.handler(event(context), None)['statusCode'] == 200
+    response = update_session.handler({'body': '{"status": "INVALIDATED"}', 'pathParameters': {'clusterId': 'cluster', 'sessionId': '1'}}, None)
+    assert response['statusCode'] == 200
+    # Only with authorizer_context_max_age set are cached credentials returned until the context is too old
+    response = get_credentials.handler(event(context), None)
+    assert response['statusCode'] == expected_status
+    assert table.assumed == 1
+
+def test_context_without_latest_check_not_trusted(table):
+    # The authorizer only checks for newer sessions when the context is used
+    table.items = [session_item()]
+    get_credentials.handler(event(), None)
+    get_credentials.handler(event(authorizer_context(session_item(), None)), None)
+    assert table.queries == 2
+
+def test_context_of_other_session_not_trusted(table):
+    other = dict(session_item(), ClusterNameSessionId='other-1')
+    response = get_credentials.handler(event(authorizer_context(other, True)), None)
+    assert table.queries == 1
+    assert response['statusCode'] == 404
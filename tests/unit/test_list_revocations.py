@@ -0,0 +1,74 @@
+import hashlib
+import json
+from decimal import Decimal
+
+import pytest
+
+import list_revocations
+import session_status
+
+NOW = 1700000000
+
+class FakeTable():
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+
+    def query(self, IndexName, KeyConditionExpression, ExpressionAttributeValues, ProjectionExpression, Limit, ExclusiveStartKey=None):
+        self.queries.append((ExpressionAttributeValues[':bucket'], Limit))
+        matches = [item for item in self.items if item.get('RevokedHour') == ExpressionAttributeValues[':bucket'] and item['LastUpdatedTime'] >= ExpressionAttributeValues[':since']]
+        start = 0
+        if ExclusiveStartKey is not None:
+            start = [item['SessionToken'] for item in matches].index(ExclusiveStartKey['SessionToken']) + 1
+        page = matches[start:start + Limit]
+        response = {'Items': [{'SessionToken': item['SessionToken'], 'LastUpdatedTime': item['LastUpdatedTime']} for item in page]}
+        if start + Limit < len(matches):
+            last = page[-1]
+            response['LastEvaluatedKey'] = {'RevokedHour': last['RevokedHour'], 'LastUpdatedTime': last['LastUpdatedTime'], 'SessionToken': last['SessionToken']}
+        return response
+
+def session(token, status, age=10):
+    item = {'SessionToken': token}
+    session_status.set_status(item, status, Decimal(NOW - age))
+    return item
+
+@pytest.fixture
+def table(monkeypatch):
+    # NOW is 800 seconds into its hour, a and b were revoked the hour before
+    table = FakeTable([session('a', 'INVALIDATED', 1000), session('b', 'COMPLETED', 900), session('c', 'INVALIDATED'), session('d', 'COMPLETED'), session('e', 'ACTIVE'), session('f', 'INVALIDATED', 5000)])
+    monkeypatch.setattr(list_revocations, 'table', table)
+    monkeypatch.setattr(list_revocations, 'PAGE_SIZE', 2)
+    monkeypatch.setattr(list_revocations, 'get_current_epoch_time', lambda: NOW)
+    return table
+
+def list_page(**params):
+    response = list_revocations.handler({'queryStringParameters': params}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+def test_pages_cover_all_buckets(table, monkeypatch):
+    since = str(NOW - 2000)
+    status, first = list_page(since=since)
+    assert status == 200
+    assert len(first['Revocations']) == 2
+    assert first['Cursor'] == NOW - list_revocations.CURSOR_LAG_SECONDS
+    # Later pages keep the cursor of the first one
+    monkeypatch.setattr(list_revocations, 'get_current_epoch_time', lambda: NOW + 300)
+    status, second = list_page(since=since, next=first['NextCursor'])
+    assert 'NextCursor' not in second
+    assert second['Cursor'] == first['Cursor']
+    hashes = [revocation['TokenHash'] for revocation in first['Revocations'] + second['Revocations']]
+    assert hashes == [hashlib.sha256(token.encode('UTF-8')).hexdigest() for token in ['a', 'b', 'c', 'd']]
+    assert all(limit <= 2 for bucket, limit in table.queries)
+    assert {bucket for bucket, limit in table.queries} == {session_status.revoked_hour(NOW) - 1, session_status.revoked_hour(NOW)}
+
+def test_invalid_next_rejected(table):
+    assert list_page(next='not-a-cursor')[0] == 400
+    # A position in a bucket before since would query every hour since then
+    before_since = list_revocations.encode_position({"Bucket": 0, "Key": None, "Cursor": NOW})
+    assert list_page(since=str(NOW - 100), next=before_since)[0] == 400
+
+def test_only_revoked_sessions_indexed():
+    item = session('a', 'INVALIDATED')
+    assert item['RevokedHour'] == session_status.revoked_hour(NOW - 10)
+    session_status.set_status(item, 'ACTIVE', NOW)
+    assert 'RevokedHour' not in item
@@ -0,0 +1,80 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import resync_session_roles
+import role_mappings
+
+VERSION = Decimal(5)
+
+def role(project_id):
+    return 'arn:aws:iam::123456789012:role/' + project_id
+
+class FakeSessionsTable():
+    # Returns one session per page, to go through pagination
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.updates = []
+        self.reads = []
+
+    def page(self, sessions, args):
+        start = args.get('ExclusiveStartKey', 0)
+        response = {'Items': sessions[start:start + 1]}
+        if start + 1 < len(sessions):
+            response['LastEvaluatedKey'] = start + 1
+        return response
+
+    def scan(self, **args):
+        self.reads.append(('scan', args.get('ExclusiveStartKey')))
+        return self.page(self.sessions, args)
+
+    def query(self, **args):
+        project_id = args['ExpressionAttributeValues'][':projectId']
+        self.reads.append(('query', project_id, args.get('ExclusiveStartKey')))
+        return self.page([session for session in self.sessions if session['ProjectId'] == project_id], args)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues):
+        self.updates.append((Key['ClusterNameSessionId'], ExpressionAttributeValues))
+
+def session(name, project_id, role_arn=None, version=None):
+    item = {'ClusterNameSessionId': name, 'SubmittedTime': Decimal(1700000000), 'ProjectId': project_id}
+    if role_arn is not None:
+        item['RoleArn'] = role_arn
+    if version is not None:
+        item['RoleMappingVersion'] = version
+    return item
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeSessionsTable([
+        session('unchanged', 'a', role('a'), VERSION),
+        session('changed', 'b', role('old'), Decimal(4)),
+        session('missing', 'gone', role('gone'), Decimal(4)),
+        session('unset', 'a'),
+    ])
+    monkeypatch.setattr(resync_session_roles, 'sessions_table', table)
+    monkeypatch.setattr(role_mappings, 'current_version', lambda: VERSION)
+    monkeypatch.setattr(role_mappings, 'get_role_arn', lambda project_id: role(project_id) if project_id in ['a', 'b'] else None)
+    return table
+
+def test_all_sessions_resynced(table):
+    response = resync_session_roles.handler({}, None)
+    assert json.loads(response['body']) == {"updatedSessions": 2, "projectsWithoutMapping": ["gone"]}
+    assert table.updates == [
+        ('changed', {':roleArn': role('b'), ':version': VERSION}),
+        ('unset', {':roleArn': role('a'), ':version': VERSION}),
+    ]
+    # One page per session
+    assert table.reads == [('scan', None), ('scan', 1), ('scan', 2), ('scan', 3)]
+
+def test_projects_resynced(table):
+    response = resync_session_roles.handler({"projectIds": ["a"]}, None)
+    assert json.loads(response['body'])["updatedSessions"] == 1
+    assert table.updates == [('unset', {':roleArn': role('a'), ':version': VERSION})]
+    assert table.reads == [('query', 'a', None), ('query', 'a', 1)]
+
+def test_version_removed_when_there_is_none(table, monkeypatch):
+    monkeypatch.setattr(role_mappings, 'current_version', lambda: None)
+    resync_session_roles.handler({"projectIds": ["b"]}, None)
+    assert table.updates == [('changed', {':roleArn': role('b')})]
@@ -0,0 +1,90 @@
+import pytest
+
+import role_mappings
+
+class FakeTable():
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    def get_item(self, Key):
+        self.calls.append(('get_item', Key['ProjectId']))
+        item = self.items.get(Key['ProjectId'])
+        return {'Item': item} if item is not None else {}
+
+class FakeDynamoDB():
+    def __init__(self, items):
+        self.table = FakeTable(items)
+        self.unprocessed = 0
+
+    def Table(self, name):
+        return self.table
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[role_mappings.table_name]['Keys']
+        self.table.calls.append(('batch_get_item', len(keys)))
+        # Leaves the last key unprocessed once, like a throttled read
+        unprocessed = {}
+        if self.unprocessed:
+            self.unprocessed -= 1
+            unprocessed = {role_mappings.table_name: dict(RequestItems[role_mappings.table_name], Keys=keys[-1:])}
+            keys = keys[:-1]
+        items = [self.table.items[key['ProjectId']] for key in keys if key['ProjectId'] in self.table.items]
+        return {'Responses': {role_mappings.table_name: items}, 'UnprocessedKeys': unprocessed}
+
+def mapping(project_id):
+    return {'ProjectId': project_id, 'RoleArn': 'arn:aws:iam::123456789012:role/' + project_id}
+
+def use_table(monkeypatch, items):
+    dynamodb = FakeDynamoDB(items)
+    monkeypatch.setattr(role_mappings.aws_clients, 'resource', lambda service_name: dynamodb)
+    monkeypatch.setattr(role_mappings.time, 'sleep', lambda seconds: None)
+    role_mappings.reset()
+    return dynamodb
+
+def test_cached_until_version_changes(monkeypatch):
+    dynamodb = use_table(monkeypatch, {'a': mapping('a')})
+    assert role_mappings.get_role_arn('a') == mapping('a')['RoleArn']
+    assert role_mappings.get_role_arn('a') == mapping('a')['RoleArn']
+    assert dynamodb.table.calls == [('get_item', '__version__'), ('get_item', 'a')]
+    dynamodb.table.items['__version__'] = {'ProjectId': '__version__', 'Version': 2}
+    dynamodb.table.items['a'] = dict(mapping('a'), RoleArn='changed')
+    role_mappings.version_checked -= role_mappings.version_check_seconds
+    assert role_mappings.get_role_arn('a') == 'changed'
+
+def test_reset_reads_table_again(monkeypatch):
+    dynamodb = use_table(monkeypatch, {'a': mapping('a')})
+    role_mappings.get_role_arn('a')
+    # Changed without a version change, only seen after a reset
+    dynamodb.table.items['a'] = dict(mapping('a'), RoleArn='changed')
+    assert role_mappings.get_role_arn('a') == mapping('a')['RoleArn']
+    role_mappings.reset()
+    assert role_mappings.get_role_arn('a') == 'changed'
+    assert dynamodb.table.calls[-2:] == [('get_item', '__version__'), ('get_item', 'a')]
+
+def test_missing_mapping_not_cached(monkeypatch):
+    dynamodb = use_table(monkeypatch, {})
+    assert role_mappings.get_role_arn('a') is None
+    dynamodb.table.items['a'] = mapping('a')
+    assert role_mappings.get_role_arn('a') == mapping('a')['RoleArn']
+
+def test_many_projects_batched(monkeypatch):
+    dynamodb = use_table(monkeypatch, {str(i): mapping(str(i)) for i in range(150)})
+    dynamodb.unprocessed = 1
+    role_arns = role_mappings.get_role_arns([str(i) for i in range(150)] + ['none'])
+    assert len(role_arns) == 150
+    assert [call for call in dynamodb.table.calls if call[0] == 'batch_get_item'] == [('batch_get_item', 100), ('batch_get_item', 1), ('batch_get_item', 51)]
+    # Served from the cache now
+    calls = len(dynamodb.table.calls)
+    role_mappings.get_role_arns([str(i) for i in range(150)])
+    assert len(dynamodb.table.calls) == calls
+
+def test_required_mappings_read_past_cache(monkeypatch):
+    dynamodb = use_table(monkeypatch, {'a': mapping('a'), 'b': mapping('b')})
+    role_mappings.get_role_arns(['a', 'b'])
+    # Changed within the cache TTL without a version bump, revocations still use the current role
+    dynamodb.table.items['a'] = dict(mapping('a'), RoleArn='changed')
+    assert sorted(role_mappings.require_role_arns(['a', 'b'])) == sorted(['changed', mapping('b')['RoleArn']])
+    assert role_mappings.get_role_arn('a') == 'changed'
+    with pytest.raises(Exception):
+        role_mappings.require_role_arns(['a', 'none'])
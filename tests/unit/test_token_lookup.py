@@ -0,0 +1,89 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import backfill_token_lookup
+import create_session
+import role_mappings
+import token_lookup
+
+class FakeClient():
+    def __init__(self):
+        self.transactions = []
+
+    def transact_write_items(self, TransactItems):
+        self.transactions.append(TransactItems)
+
+class FakeBatchWriter():
+    def __init__(self, items):
+        self.items = items
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item):
+        self.items.append(Item)
+
+class FakeTable():
+    def __init__(self, pages=None):
+        self.pages = pages or []
+        self.items = []
+
+    def scan(self, ProjectionExpression, ExclusiveStartKey=None):
+        page = self.pages[ExclusiveStartKey or 0]
+        response = {'Items': page}
+        if (ExclusiveStartKey or 0) + 1 < len(self.pages):
+            response['LastEvaluatedKey'] = (ExclusiveStartKey or 0) + 1
+        return response
+
+    def batch_writer(self):
+        return FakeBatchWriter(self.items)
+
+class FakeDynamoDB():
+    def __init__(self, table):
+        self.table = table
+        self.meta = type('meta', (), {'client': FakeClient()})()
+
+    def Table(self, name):
+        return self.table
+
+def session(token, submitted_time=1700000000):
+    return {'ClusterNameSessionId': 'cluster-1', 'SubmittedTime': Decimal(submitted_time), 'SessionToken': token}
+
+@pytest.fixture
+def lookup_table_name(monkeypatch):
+    monkeypatch.setattr(token_lookup, 'table_name', 'SessionTokenLookupTable')
+    return token_lookup.table_name
+
+def test_create_session_writes_lookup_item(lookup_table_name, monkeypatch):
+    dynamodb = FakeDynamoDB(FakeTable())
+    monkeypatch.setattr(create_session, 'dynamodb', dynamodb)
+    monkeypatch.setattr(role_mappings, 'get_role_arn', lambda project_id: None)
+    response = create_session.handler({
+        'body': json.dumps({'sessionId': '1', 'projectId': 'project', 'clusterName': 'cluster', 'clusterUser': 'user', 'submittedTime': '2024-01-01T00:00:00'}),
+        'requestContext': {'domainName': 'api.example.com', 'path': '/prod/sessions'},
+    }, None)
+    assert response['statusCode'] == 200
+    token = json.loads(response['body'])['AWS_CONTAINER_AUTHORIZATION_TOKEN']
+    [transaction] = dynamodb.meta.client.transactions
+    session_put, lookup_put = transaction[0]['Put'], transaction[1]['Put']
+    assert session_put['Item']['SessionToken'] == token
+    assert lookup_put['TableName'] == lookup_table_name
+    assert lookup_put['Item'] == {
+        'TokenHash': token_lookup.token_hash(token),
+        'ClusterNameSessionId': 'cluster-1',
+        'SubmittedTime': session_put['Item']['SubmittedTime'],
+    }
+
+def test_backfill_writes_all_pages(lookup_table_name, monkeypatch):
+    sessions_table = FakeTable([[session('a'), session('b', 1700000001)], [session('c', 1700000002), {'ClusterNameSessionId': 'cluster-2', 'SubmittedTime': Decimal(1)}]])
+    lookup_table = FakeTable()
+    monkeypatch.setattr(backfill_token_lookup, 'sessions_table', sessions_table)
+    monkeypatch.setattr(backfill_token_lookup, 'dynamodb', FakeDynamoDB(lookup_table))
+    response = backfill_token_lookup.handler({}, None)
+    assert json.loads(response['body']) == {'writtenItems': 3}
+    assert [item['TokenHash'] for item in lookup_table.items] == [token_lookup.token_hash(token) for token in ['a', 'b', 'c']]